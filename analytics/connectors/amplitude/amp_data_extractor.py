@@ -7,16 +7,38 @@ File: amp_data_extractor.py
 Creation: 2017/08/08
 '''
 
+import datetime
 import fnmatch
 import ConfigParser
+import json
+import logging
 import os
 import requests
 import shutil
+import sys
+import threading
+import time
 import zipfile
 
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
 from requests.auth import HTTPBasicAuth
 from shutil import copyfile
 
+from amp_event_converter import convert_files, DedupIndex
+
+logger = logging.getLogger()
+
+# Date formats of the export range, by length: YYYYMMDD, or YYYYMMDDTHH for hour windows
+DATE_FORMATS = {8: "%Y%m%d", 11: "%Y%m%dT%H"}
+
+
+class AmpNoDataError(Exception):
+    '''
+    Amplitude has no data for the requested range
+    '''
+    pass
+
 class AmpDataExtractor(object):
 
     def __init__(self, config_file):
@@ -30,78 +52,342 @@ class AmpDataExtractor(object):
         self._output_path = self._config.get("AMP", "OUTPUT_PATH")
 
         self._temp_zip_file = "test_requests.zip"
-        self._temp_unzipped_path = "temp_unzipped_files"
         self._file_formats = (".gz")
+        self._s3_client = None
+
+        # download: bytes buffered per write, retries resuming from the bytes already on disk, socket timeout
+        self._chunk_size = self.__get_int_option("CHUNK_SIZE", 1024 * 1024)
+        self._max_retries = self.__get_int_option("MAX_RETRIES", 5)
+        self._timeout = self.__get_int_option("TIMEOUT", 300)
+
+        # the range is exported in day or hour windows, downloaded by concurrent workers
+        self._window = self.__get_option("WINDOW", "day")
+        self._workers = self.__get_int_option("WORKERS", 4)
+
+        # optional conversion of the export files to event-time partitions, see amp_event_converter
+        self._converted_path = self.__get_option("CONVERTED_PATH", None)
+        self._converted_format = self.__get_option("CONVERTED_FORMAT", "ndjson")
+        self._convert_processes = self.__get_int_option("CONVERT_PROCESSES", 0) or None
+        self._dedup_index = self.__get_option("DEDUP_INDEX", None)
+        self._dedup_retention_days = self.__get_int_option("DEDUP_RETENTION_DAYS", 7)
+
+        # incremental sync: last fully exported hour, hours Amplitude needs to finish an hour, hours per process()
+        self._checkpoint_file = self.__get_option("CHECKPOINT_FILE", "amp_checkpoint.json")
+        self._export_lag_hours = self.__get_int_option("EXPORT_LAG_HOURS", 3)
+        self._sync_batch_hours = self.__get_int_option("SYNC_BATCH_HOURS", 24)
+
+        # connections are reused across requests
+        self._session = requests.Session()
+        self._session.auth = HTTPBasicAuth(self._api_key, self._api_secret)
+        self._session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=16))
+
+    def __get_option(self, name, default):
+        '''
+        :objective: this sub-function will return an optional setting of the AMP section
+        :param name: setting name
+        :param default: value used when the setting is missing
+        :return: the setting value
+        '''
+        if self._config.has_option("AMP", name):
+            return self._config.get("AMP", name)
+        return default
+
+    def __get_int_option(self, name, default):
+        '''
+        :objective: this sub-function will return an optional integer setting of the AMP section
+        :param name: setting name
+        :param default: value used when the setting is missing
+        :return: the setting value
+        '''
+        if self._config.has_option("AMP", name):
+            return self._config.getint("AMP", name)
+        return default
 
     def process(self, start_date, end_date):
 
-        # step 1: get response from Amplitude API
-        resp = self.__get_response_from_amp_api(start_date, end_date)
+        # step 1: split the range into day or hour windows
+        windows = self.__split_windows(start_date, end_date)
 
-        # step 2: write response to temporary zip file
-        self.__write_resp_to_temp_zip_file(resp, self._temp_zip_file)
+        # step 2: stream the windows from Amplitude API to their temporary zip files, concurrently
+        temp_zip_files = self.__download_windows(windows)
 
-        # step 3: unzip the temp_zip_file and extract files into temp_unzipped_path
-        self.__unzip_extract_file(self._temp_zip_file, self._temp_unzipped_path)
+        # step 3: create the output paths
+        if not self._output_path.startswith("s3://"):
+            self.__create_output_path(self._output_path)
+        elif self._converted_path:
+            raise Exception("Converting the export needs a local OUTPUT_PATH.")
 
-        # step 4: extract gz_files from the unzipped_path
-        gz_files = self.__get_gz_files_from_unzipped_path(self._temp_unzipped_path, self._file_formats)
+        gz_files = []
+        for temp_zip_file in temp_zip_files:
+            if temp_zip_file is None:
+                continue
 
-        # step 5: create the output paths
-        self.__create_output_path(self._output_path)
+            # step 4: stream the gz members of the temp_zip_file to their renamed output paths
+            gz_files.extend(self.__extract_gz_members(temp_zip_file, self._file_formats, self._output_path))
 
-        # step 6: move the gz files into the output path and remove temporary path
-        self.__move_files_and_remove_temp_path(gz_files, self._temp_unzipped_path, self._output_path)
+            # step 5: removes the temporary zip file
+            self.__remove_temp_zip_file(temp_zip_file)
 
-        # step 7: removes the temporary zip file
-        self.__remove_temp_zip_file(self._temp_zip_file)
+        # step 6: convert the gz files to event-time partitions, in a process pool
+        if self._converted_path:
+            if self._dedup_index:
+                index = DedupIndex(self._dedup_index)
+                index.prune(self._dedup_retention_days)
+                index.close()
 
-    def __get_response_from_amp_api(self, start_date, end_date):
+            stats = convert_files(gz_files, self._converted_path, output_format=self._converted_format,
+                                  processes=self._convert_processes, dedup_index=self._dedup_index)
+            logger.info("Converted %s events into %s files, dropped %s, %s duplicates" %
+                        (stats["events"], len(stats["files"]), stats["dropped"], stats["duplicates"]))
+
+    def sync(self, now=None):
+        '''
+        :objective: this function will export the hours after the checkpoint, up to the last hour Amplitude has
+        :           finished, in batches of SYNC_BATCH_HOURS, moving the checkpoint after each batch
+        :param now: UTC datetime, now by default
+        :return: the number of hours exported
+        '''
+        now = now or datetime.datetime.utcnow()
+        hour = datetime.timedelta(hours=1)
+        last_hour = (now - datetime.timedelta(hours=self._export_lag_hours)).replace(minute=0, second=0,
+                                                                                      microsecond=0)
+
+        checkpoint = self.__read_checkpoint()
+        if checkpoint:
+            start = datetime.datetime.strptime(checkpoint, DATE_FORMATS[11]) + hour
+        elif self._config.has_option("AMP", "START"):
+            start = datetime.datetime.strptime(self._config.get("AMP", "START"), DATE_FORMATS[11])
+        else:
+            start = last_hour - datetime.timedelta(hours=self._sync_batch_hours) + hour
+
+        hours = 0
+        while start <= last_hour:
+            end = min(last_hour, start + datetime.timedelta(hours=self._sync_batch_hours) - hour)
+            self.process(start.strftime(DATE_FORMATS[11]), end.strftime(DATE_FORMATS[11]))
+            self.__write_checkpoint(end.strftime(DATE_FORMATS[11]))
+            hours += int((end - start).total_seconds() // 3600) + 1
+            start = end + hour
+
+        return hours
+
+    def __read_checkpoint(self):
+        '''
+        :objective: this sub-function will read the last fully exported hour
+        :return: YYYYMMDDTHH, None before the first sync
+        '''
+        if not os.path.exists(self._checkpoint_file):
+            return None
+        with open(self._checkpoint_file) as f:
+            return json.load(f).get("last_exported_hour")
+
+    def __write_checkpoint(self, last_exported_hour):
+        '''
+        :objective: this sub-function will record the last fully exported hour, atomically
+        :param last_exported_hour: YYYYMMDDTHH
+        '''
+        temp_file = self._checkpoint_file + ".tmp"
+        with open(temp_file, "w") as f:
+            json.dump({"last_exported_hour": last_exported_hour}, f)
+        os.rename(temp_file, self._checkpoint_file)
+
+    def __split_windows(self, start_date, end_date):
+        '''
+        :objective: this sub-function will split the range into consecutive day or hour windows
+        :param start_date: YYYYMMDD, or YYYYMMDDTHH
+        :param end_date: YYYYMMDD, or YYYYMMDDTHH, inclusive
+        :return: a list of (start_date, end_date) in the format of the range
         '''
-        :objective: this sub-function will return the response from the amplitude api
+        date_format = DATE_FORMATS.get(len(start_date))
+        if date_format is None or len(end_date) != len(start_date):
+            raise Exception("Unsupported export range %s-%s." % (start_date, end_date))
+        if self._window == "hour" and "T" not in date_format:
+            raise Exception("Hour windows need a YYYYMMDDTHH range.")
+
+        start = datetime.datetime.strptime(start_date, date_format)
+        end = datetime.datetime.strptime(end_date, date_format)
+        step = datetime.timedelta(hours=1) if self._window == "hour" else datetime.timedelta(days=1)
+
+        windows = []
+        while start <= end:
+            if self._window == "hour":
+                window_end = start
+            else:
+                # a day window ends on the same day, at the last hour of the day or of the range
+                window_end = min(end, start.replace(hour=23) if "T" in date_format else start)
+            windows.append((start.strftime(date_format), window_end.strftime(date_format)))
+            start = (start.replace(hour=0) if self._window != "hour" else start) + step
+
+        return windows
+
+    def __download_windows(self, windows):
+        '''
+        :objective: this sub-function will download the windows concurrently, each to its own temporary zip file
+        :param windows: a list of (start_date, end_date)
+        :return: a list of temporary zip files in the order of the windows, None for windows without data
+        '''
+        name, ext = os.path.splitext(self._temp_zip_file)
+        temp_zip_files = ["%s_%s_%s%s" % (name, start, end, ext) for start, end in windows]
+
+        def download(window, temp_zip_file):
+            try:
+                self.__download_to_temp_zip_file(window[0], window[1], temp_zip_file)
+                return temp_zip_file
+            except AmpNoDataError:
+                logger.warning("No Amplitude data for %s-%s" % window)
+                return None
+
+        pool = ThreadPoolExecutor(max_workers=self._workers)
+        try:
+            futures = [pool.submit(download, w, f) for w, f in zip(windows, temp_zip_files)]
+            errors = [f.exception() for f in futures if f.exception() is not None]
+        finally:
+            pool.shutdown(wait=True)
+
+        if errors:
+            for temp_zip_file in temp_zip_files:
+                if os.path.exists(temp_zip_file):
+                    os.remove(temp_zip_file)
+            raise errors[0]
+
+        return [f.result() for f in futures]
+
+    def __download_to_temp_zip_file(self, start_date, end_date, temp_zip_file):
+        '''
+        :objective: this sub-function will stream the export to the temporary zip file. After a network
+        :           failure, the download resumes from the bytes already written with an HTTP Range request
+        :param start_date: YYYYMMDD
+        :param end_date: YYYYMMDD
+        :param temp_zip_file: temporary zip file
+        :return: writes the export to file, raises an exception on a non-200 response or after max retries
+        '''
+        if os.path.exists(temp_zip_file):
+            os.remove(temp_zip_file)
+
+        attempt = 0
+        while True:
+            offset = os.path.getsize(temp_zip_file) if os.path.exists(temp_zip_file) else 0
+            try:
+                resp = self.__get_response_from_amp_api(start_date, end_date, offset)
+                if self.__write_resp_to_temp_zip_file(resp, temp_zip_file, offset):
+                    return
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout,
+                    requests.exceptions.ChunkedEncodingError) as e:
+                logger.warning("Amplitude export %s-%s interrupted: %s" % (start_date, end_date, e))
+
+            attempt += 1
+            if attempt > self._max_retries:
+                raise Exception("Amplitude export %s-%s failed after %s retries." %
+                                (start_date, end_date, self._max_retries))
+            time.sleep(min(60, 2 ** attempt))
+
+    def __get_response_from_amp_api(self, start_date, end_date, offset=0):
+        '''
+        :objective: this sub-function will return the streamed response from the amplitude api
         :param start_date: YYYYMMDD
         :param end_date: YYYYMMDD
+        :param offset: bytes already downloaded, requested to be skipped
         :return: the response from the amplitude api
         '''
         url = self._url % (start_date, end_date)
-        resp = requests.get(url, auth=HTTPBasicAuth(self._api_key,
-                                                    self._api_secret))
-        return resp
+        headers = {"Range": "bytes=%s-" % offset} if offset else {}
+        return self._session.get(url, headers=headers, stream=True, timeout=self._timeout)
 
-    def __write_resp_to_temp_zip_file(self, resp, temp_zip_file):
+    def __write_resp_to_temp_zip_file(self, resp, temp_zip_file, offset=0):
         '''
-        :objective: this sub-function will write the response to temporary zip file
-        :param resp: response from the Amplitude API
-        :return: writes the response to file
+        :objective: this sub-function will stream the response to temporary zip file, chunk by chunk
+        :param resp: streamed response from the Amplitude API
+        :param temp_zip_file: temporary zip file
+        :param offset: bytes already in the file
+        :return: True if the file is complete, False if the response ended early
         '''
-        if resp.status_code == 200:
-            with open(temp_zip_file, "wb") as code:
-                code.write(resp.content)
+        try:
+            if resp.status_code == 416 and offset:
+                # nothing left after the offset
+                return True
+            if resp.status_code == 404:
+                raise AmpNoDataError(resp.text[:200])
+            if resp.status_code not in (200, 206):
+                raise Exception("Amplitude export failed with HTTP %s: %s" % (resp.status_code, resp.text[:200]))
+
+            # a server ignoring the Range header sends the whole export again
+            append = resp.status_code == 206
+            expected = resp.headers.get("Content-Length")
+            expected = int(expected) + (offset if append else 0) if expected is not None else None
 
-    def __unzip_extract_file(self, temp_zip_file, temp_unzipped_path):
+            with open(temp_zip_file, "ab" if append else "wb") as code:
+                for chunk in resp.iter_content(chunk_size=self._chunk_size):
+                    code.write(chunk)
+        finally:
+            resp.close()
+
+        return expected is None or os.path.getsize(temp_zip_file) >= expected
+
+    def __extract_gz_members(self, temp_zip_file, file_formats, output_path):
         '''
-        :objective: this sub-function will unzip and extract files from the temp_zip_file and
-        :           save into temp_unzipped_path
-        :param temp_zip_file:
-        :param temp_unzipped_path:
-        :return: saves the extract files from temp_zip_file
+        :objective: this sub-function will stream every gz member of the temp_zip_file straight to its renamed
+        :           output path, or S3 for an s3://bucket/prefix output path, members in parallel. Other members
+        :           are never extracted
+        :param temp_zip_file: temporary zip file
+        :param file_formats: set of file formats
+        :param output_path: the final output path
+        :return: a list of the output paths
         '''
         zip_ref = zipfile.ZipFile(temp_zip_file)
-        zip_ref.extractall(temp_unzipped_path)
+        members = [m for m in zip_ref.infolist() if m.filename.endswith(file_formats)]
+        zip_ref.close()
 
-    def __get_gz_files_from_unzipped_path(self, temp_unzipped_path, file_formats):
+        local = threading.local()
+        zip_refs = []
+
+        def extract(member):
+            # a ZipFile is not thread-safe, every thread reads through its own
+            if not hasattr(local, "zip_ref"):
+                local.zip_ref = zipfile.ZipFile(temp_zip_file)
+                zip_refs.append(local.zip_ref)
+            return self.__stream_member(local.zip_ref, member, output_path)
+
+        pool = ThreadPoolExecutor(max_workers=self._workers)
+        try:
+            return list(pool.map(extract, members))
+        finally:
+            pool.shutdown(wait=True)
+            for zip_ref in zip_refs:
+                zip_ref.close()
+
+    def __stream_member(self, zip_ref, member, output_path):
         '''
-        :objective: this sub-function will recursively walk the unzipped path and extract all gz files
-        :param temp_unzipped_path: the temporary unzipped path
-        :param file_formats: set of file formats
-        :return: a list of gz file paths
+        :objective: this sub-function will copy one zip member, chunk by chunk, to its renamed output path
+        :param zip_ref: the zip file
+        :param member: the ZipInfo of the member
+        :param output_path: the final output path, local or s3://bucket/prefix
+        :return: the output path of the member
         '''
-        matches = []
-        for root, dir_name, file_names in os.walk(temp_unzipped_path):
-            for file_name in file_names:
-                if file_name.endswith(file_formats):
-                    matches.append( os.path.join(".", root, file_name))
-        return matches
+        new_f = self.__get_output_file_name(member.filename)
+        src = zip_ref.open(member)
+        try:
+            if output_path.startswith("s3://"):
+                bucket, _, prefix = output_path[len("s3://"):].partition("/")
+                key = "/".join(p for p in (prefix.strip("/"), new_f) if p)
+                # upload_fileobj switches to a multipart upload for large members
+                self.__get_s3_client().upload_fileobj(src, bucket, key)
+                return "s3://%s/%s" % (bucket, key)
+
+            new_f = os.path.join(".", output_path, new_f)
+            with open(new_f, "wb") as dst:
+                shutil.copyfileobj(src, dst, self._chunk_size)
+            return new_f
+        finally:
+            src.close()
+
+    def __get_s3_client(self):
+        '''
+        :objective: this sub-function will return the boto3 s3 client, created once
+        :return: boto3 s3 client
+        '''
+        if self._s3_client is None:
+            import boto3
+            self._s3_client = boto3.client("s3")
+        return self._s3_client
 
     def __create_output_path(self, output_path):
         '''
@@ -112,25 +398,19 @@ class AmpDataExtractor(object):
         if not os.path.exists(output_path):
             os.makedirs(output_path)
 
-    def __move_files_and_remove_temp_path(self, matched_files, temp_path, output_path):
+    def __get_output_file_name(self, member_name):
         '''
-        :objective: this sub-function will modify the file names of the list of matched files
-        :param matched_files: list of matched files
-        :param temp_path: the temporary unzipped path
-        :param output_path: the final output path
-        :return: list of renamed matched files
+        :objective: this sub-function will modify the file name of a matched file
+        :param member_name: name of the zip member, e.g. 165789/165789_2017-08-01_0#47.json.gz
+        :return: the renamed file name, e.g. AMP_2017-08-01_0.json.gz
         '''
         amp_id, amp_name, amp_blacklist = "165789", "AMP", "#47"
         rename_patterns = [ (amp_id, amp_name),
                             (amp_blacklist, "")]
-        for f in matched_files:
-            new_f = f.split("/")[-1].strip()
-            for val, replace_val in rename_patterns:
-                new_f = new_f.replace(val, replace_val)
-            new_f = os.path.join(".", output_path, new_f)
-            shutil.move(f, new_f)
-
-        shutil.rmtree(temp_path)
+        new_f = member_name.split("/")[-1].strip()
+        for val, replace_val in rename_patterns:
+            new_f = new_f.replace(val, replace_val)
+        return new_f
 
     def __remove_temp_zip_file(self, temp_zip_file):
         '''
@@ -151,7 +431,9 @@ def unit_test(start_date, end_date):
     AmpDataExtractor(config_file = "amp.cfg").process(start_date, end_date)
 
 if __name__ == "__main__":
-    unit_test(
-        start_date="20170801",
-        end_date="20170808"
-    )
\ No newline at end of file
+    # scheduled runs export the hours after the checkpoint, a range is only given to backfill it:
+    #   python amp_data_extractor.py 20170801 20170808
+    if len(sys.argv) == 3:
+        unit_test(start_date=sys.argv[1], end_date=sys.argv[2])
+    else:
+        AmpDataExtractor(config_file = "amp.cfg").sync()
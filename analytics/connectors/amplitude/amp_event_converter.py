@@ -0,0 +1,302 @@
+#! /usr/bin/python
+#-*- coding:utf-8 -*-
+
+'''
+File: amp_event_converter.py
+
+Converts the raw Amplitude export files (gzipped JSON lines, one file per upload hour) into event-time
+partitions laid out like the naboo data: {converted_path}/year=2017/month=8/day=1/hour=0/{file}.json.gz
+Only the projected fields are kept. Files are converted in parallel, each by its own process.
+
+With a dedup index, events already converted from another export file, e.g. late events exported again by an
+overlapping run, are dropped. Events are identified by $insert_id, or uuid when it is missing.
+'''
+
+import datetime
+import gzip
+import json
+import os
+import sqlite3
+
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+# Projected fields and their column types, "$" prefixes are dropped from the column names
+DEFAULT_FIELDS = [
+    ("uuid", "string"),
+    ("$insert_id", "string"),
+    ("event_type", "string"),
+    ("event_time", "string"),
+    ("server_upload_time", "string"),
+    ("amplitude_id", "int"),
+    ("user_id", "string"),
+    ("device_id", "string"),
+    ("session_id", "int"),
+    ("platform", "string"),
+    ("os_name", "string"),
+    ("country", "string"),
+    ("city", "string"),
+    ("event_properties", "json"),
+    ("user_properties", "json"),
+]
+
+FORMATS = ("ndjson", "parquet")
+
+# Events read between two commits of the dedup index
+DEDUP_BATCH_SIZE = 5000
+
+
+class DedupIndex(object):
+    '''
+    SQLite index of the event ids already converted, and the export file each came from. Converting the same
+    file again, e.g. on a retry, keeps its events, as its output files are replaced.
+    '''
+
+    def __init__(self, path):
+        self._conn = sqlite3.connect(path, timeout=300)
+        self._conn.execute("CREATE TABLE IF NOT EXISTS events "
+                           "(id TEXT PRIMARY KEY, source TEXT NOT NULL, day TEXT NOT NULL) WITHOUT ROWID")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS events_day ON events (day)")
+        self._conn.commit()
+
+    def add_batch(self, keys, source):
+        '''
+        :objective: this function will record a batch of event ids, in one transaction
+        :param keys: list of (event id, day YYYY-MM-DD)
+        :param source: name of the export file
+        :return: set of the event ids already converted from another export file
+        '''
+        duplicates = set()
+        with self._conn:
+            for event_id, day in keys:
+                cursor = self._conn.execute("INSERT OR IGNORE INTO events (id, source, day) VALUES (?, ?, ?)",
+                                            (event_id, source, day))
+                if cursor.rowcount == 0:
+                    row = self._conn.execute("SELECT source FROM events WHERE id = ?", (event_id,)).fetchone()
+                    if row and row[0] != source:
+                        duplicates.add(event_id)
+        return duplicates
+
+    def prune(self, retention_days):
+        '''
+        :objective: this function will forget the events older than the retention before the newest event,
+        :           late events are not exported again after it. Relative to the newest event, so backfills of
+        :           old days are deduplicated too
+        :param retention_days: number of days kept
+        '''
+        newest = self._conn.execute("SELECT MAX(day) FROM events").fetchone()[0]
+        if not newest:
+            return
+        oldest = (datetime.datetime.strptime(newest, "%Y-%m-%d") -
+                  datetime.timedelta(days=retention_days)).strftime("%Y-%m-%d")
+        with self._conn:
+            self._conn.execute("DELETE FROM events WHERE day < ?", (oldest,))
+
+    def close(self):
+        self._conn.close()
+
+
+def event_id(event):
+    return event.get("$insert_id") or event.get("uuid")
+
+
+def event_day(event):
+    '''
+    :return: YYYY-MM-DD of the time the event is partitioned by
+    '''
+    return (event.get("event_time") or event.get("server_upload_time"))[:10]
+
+
+def column_name(field):
+    return field.lstrip("$")
+
+
+def partition_of(event):
+    '''
+    :objective: this function will return the event-time partition of an event
+    :param event: Amplitude event, with an event_time such as "2017-08-01 00:12:34.567000" (UTC)
+    :return: "year=2017/month=8/day=1/hour=0", None without a usable time
+    '''
+    event_time = event.get("event_time") or event.get("server_upload_time")
+    if not event_time or len(event_time) < 13:
+        return None
+    try:
+        return "year=%d/month=%d/day=%d/hour=%d" % (
+            int(event_time[0:4]), int(event_time[5:7]), int(event_time[8:10]), int(event_time[11:13]))
+    except ValueError:
+        return None
+
+
+def project(event, fields):
+    '''
+    :objective: this function will keep the projected fields of an event
+    :param event: Amplitude event
+    :param fields: list of (field, type)
+    :return: dict of column name to value, json fields serialized
+    '''
+    row = {}
+    for field, field_type in fields:
+        value = event.get(field)
+        if field_type == "json" and value is not None:
+            value = json.dumps(value, sort_keys=True)
+        elif field_type == "int" and value is not None:
+            try:
+                value = int(value)
+            except (TypeError, ValueError):
+                value = None
+        elif field_type == "string" and value is not None and not isinstance(value, type(u"")):
+            value = u"%s" % (value,)
+        row[column_name(field)] = value
+    return row
+
+
+class NdjsonPartitionWriter(object):
+
+    def __init__(self, path, fields):
+        self.fp = gzip.open(path, "wb")
+
+    def write(self, row):
+        self.fp.write((json.dumps(row, sort_keys=True) + "\n").encode("utf-8"))
+
+    def close(self):
+        self.fp.close()
+
+
+class ParquetPartitionWriter(object):
+    '''
+    Rows are buffered per partition, the partitions of one export file are small
+    '''
+
+    TYPES = {"string": "string", "json": "string", "int": "int64"}
+
+    def __init__(self, path, fields):
+        self.path = path
+        self.schema = pyarrow.schema([(column_name(f), getattr(pyarrow, self.TYPES[t])()) for f, t in fields])
+        self.rows = []
+
+    def write(self, row):
+        self.rows.append(row)
+
+    def close(self):
+        arrays = [pyarrow.array([row[field.name] for row in self.rows], type=field.type) for field in self.schema]
+        pyarrow.parquet.write_table(pyarrow.Table.from_arrays(arrays, schema=self.schema), self.path,
+                                    compression="snappy")
+
+
+def convert_file(path, converted_path, fields=None, output_format="ndjson", dedup_index=None):
+    '''
+    :objective: this function will stream-parse one export file into its event-time partitions
+    :param path: raw export file, gzipped JSON lines
+    :param converted_path: root of the partitions
+    :param fields: list of (field, type), DEFAULT_FIELDS by default
+    :param output_format: ndjson or parquet
+    :param dedup_index: path of the SQLite dedup index, no deduplication without it
+    :return: dict of counts and the list of files written
+    '''
+    fields = fields or DEFAULT_FIELDS
+    writer_class = ParquetPartitionWriter if output_format == "parquet" else NdjsonPartitionWriter
+    ext = ".parquet" if output_format == "parquet" else ".json.gz"
+    source = os.path.basename(path)
+    stem = source.split(".")[0]
+    index = DedupIndex(dedup_index) if dedup_index else None
+
+    writers = {}
+    stats = {"events": 0, "dropped": 0, "duplicates": 0, "files": []}
+
+    def write_batch(batch):
+        duplicates = set()
+        if index is not None:
+            duplicates = index.add_batch([(event_id(e), event_day(e)) for _, e in batch if event_id(e)], source)
+
+        for partition, event in batch:
+            if duplicates and event_id(event) in duplicates:
+                stats["duplicates"] += 1
+                continue
+
+            writer = writers.get(partition)
+            if writer is None:
+                partition_dir = os.path.join(converted_path, partition)
+                if not os.path.isdir(partition_dir):
+                    try:
+                        os.makedirs(partition_dir)
+                    except OSError:
+                        if not os.path.isdir(partition_dir):
+                            raise
+                file_path = os.path.join(partition_dir, stem + ext)
+                writer = writers[partition] = writer_class(file_path, fields)
+                stats["files"].append(file_path)
+
+            writer.write(project(event, fields))
+            stats["events"] += 1
+
+    try:
+        batch = []
+        with gzip.open(path, "rb") as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                try:
+                    event = json.loads(line.decode("utf-8"))
+                except ValueError:
+                    stats["dropped"] += 1
+                    continue
+
+                partition = partition_of(event)
+                if partition is None:
+                    stats["dropped"] += 1
+                    continue
+
+                batch.append((partition, event))
+                if len(batch) >= DEDUP_BATCH_SIZE:
+                    write_batch(batch)
+                    batch = []
+
+        write_batch(batch)
+    finally:
+        for writer in writers.values():
+            writer.close()
+        if index is not None:
+            index.close()
+
+    return stats
+
+
+def convert_files(paths, converted_path, fields=None, output_format="ndjson", processes=None, dedup_index=None):
+    '''
+    :objective: this function will convert export files in parallel, one process per file at a time
+    :param paths: raw export files
+    :param converted_path: root of the partitions
+    :param fields: list of (field, type), DEFAULT_FIELDS by default
+    :param output_format: ndjson or parquet
+    :param processes: size of the process pool, the number of CPUs by default
+    :param dedup_index: path of the SQLite dedup index, no deduplication without it
+    :return: dict of counts and the list of files written, over every file
+    '''
+    if output_format not in FORMATS:
+        raise Exception("Unknown output format %s, expected one of %s." % (output_format, ", ".join(FORMATS)))
+    if output_format == "parquet" and pyarrow is None:
+        raise Exception("pyarrow is required for the parquet output format.")
+
+    if dedup_index:
+        # the table is created once, before the workers share it
+        DedupIndex(dedup_index).close()
+
+    totals = {"events": 0, "dropped": 0, "duplicates": 0, "files": []}
+    pool = ProcessPoolExecutor(max_workers=processes)
+    try:
+        futures = [pool.submit(convert_file, path, converted_path, fields, output_format, dedup_index)
+                   for path in paths]
+        for future in futures:
+            stats = future.result()
+            for count in ("events", "dropped", "duplicates"):
+                totals[count] += stats[count]
+            totals["files"].extend(stats["files"])
+    finally:
+        pool.shutdown(wait=True)
+
+    return totals
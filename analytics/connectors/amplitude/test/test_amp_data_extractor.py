@@ -0,0 +1,70 @@
+import datetime
+import json
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+from amp_data_extractor import AmpDataExtractor
+
+
+class TestAmpDataExtractorSync(TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.checkpoint_file = os.path.join(self.temp_dir, "amp_checkpoint.json")
+        self.now = datetime.datetime(2017, 8, 2, 10, 30)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def extractor(self, **options):
+        config_file = os.path.join(self.temp_dir, "amp.cfg")
+        options.setdefault("CHECKPOINT_FILE", self.checkpoint_file)
+        with open(config_file, "w") as f:
+            f.write("[AMP]\nURL = https://amplitude.com/api/2/export\nAPI_KEY = key\nAPI_SECRET = secret\n"
+                    "OUTPUT_PATH = %s\n" % self.temp_dir)
+            for name, value in options.items():
+                f.write("%s = %s\n" % (name, value))
+
+        extractor = AmpDataExtractor(config_file)
+        extractor.ranges = []
+        extractor.process = lambda start_date, end_date: extractor.ranges.append((start_date, end_date))
+        return extractor
+
+    def checkpoint(self):
+        with open(self.checkpoint_file) as f:
+            return json.load(f)["last_exported_hour"]
+
+    def test_first_sync_exports_the_last_batch(self):
+        extractor = self.extractor(SYNC_BATCH_HOURS=24, EXPORT_LAG_HOURS=3)
+
+        # 10:30 less 3 hours of lag: 07 is the last finished hour
+        self.assertEqual(extractor.sync(now=self.now), 24)
+        self.assertEqual(extractor.ranges, [("20170801T08", "20170802T07")])
+        self.assertEqual(self.checkpoint(), "20170802T07")
+
+    def test_sync_resumes_after_the_checkpoint_in_batches(self):
+        extractor = self.extractor(SYNC_BATCH_HOURS=10, EXPORT_LAG_HOURS=3, START="20170801T00")
+
+        self.assertEqual(extractor.sync(now=self.now), 32)
+        self.assertEqual(extractor.ranges, [("20170801T00", "20170801T09"), ("20170801T10", "20170801T19"),
+                                            ("20170801T20", "20170802T05"), ("20170802T06", "20170802T07")])
+        self.assertEqual(self.checkpoint(), "20170802T07")
+
+        # nothing new within the same hour, then only the next finished hour
+        extractor.ranges = []
+        self.assertEqual(extractor.sync(now=self.now), 0)
+        self.assertEqual(extractor.sync(now=self.now + datetime.timedelta(hours=1)), 1)
+        self.assertEqual(extractor.ranges, [("20170802T08", "20170802T08")])
+
+    def test_failed_batch_keeps_the_checkpoint(self):
+        extractor = self.extractor(SYNC_BATCH_HOURS=10, EXPORT_LAG_HOURS=3, START="20170801T00")
+
+        def process(start_date, end_date):
+            if start_date == "20170801T10":
+                raise IOError("export failed")
+        extractor.process = process
+
+        self.assertRaises(IOError, extractor.sync, now=self.now)
+        self.assertEqual(self.checkpoint(), "20170801T09")
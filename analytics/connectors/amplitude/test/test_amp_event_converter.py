@@ -0,0 +1,37 @@
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+from amp_event_converter import DedupIndex
+
+
+class TestDedupIndex(TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.index = DedupIndex(os.path.join(self.temp_dir, "dedup.sqlite"))
+
+    def tearDown(self):
+        self.index.close()
+        shutil.rmtree(self.temp_dir)
+
+    def test_add_batch(self):
+        keys = [("a", "2017-08-01"), ("b", "2017-08-01")]
+        self.assertEqual(self.index.add_batch(keys, "AMP_2017-08-01_0.json.gz"), set())
+
+        # the same file converted again keeps its events
+        self.assertEqual(self.index.add_batch(keys, "AMP_2017-08-01_0.json.gz"), set())
+
+        # events exported again in another file are duplicates
+        self.assertEqual(self.index.add_batch([("b", "2017-08-01"), ("c", "2017-08-01")],
+                                              "AMP_2017-08-01_1.json.gz"), set(["b"]))
+
+    def test_prune_is_relative_to_the_newest_event(self):
+        self.index.prune(7)
+
+        self.index.add_batch([("old", "2017-07-20"), ("kept", "2017-07-25"), ("new", "2017-08-01")], "first")
+        self.index.prune(7)
+
+        self.assertEqual(self.index.add_batch([("old", "2017-07-20"), ("kept", "2017-07-25"),
+                                               ("new", "2017-08-01")], "second"), set(["kept", "new"]))
@@ -0,0 +1,86 @@
+"""
+    Startup-time benchmark of the Google Analytics extractor.
+
+    Compares, over a number of runs, the time to get an authorized service object ready to call the API:
+    - network: key file parsed and discovery document downloaded on every run (the former cold start)
+    - cold: key file parsed and service object built from the local discovery document
+    - warm: cached service object and access token reused, as in a warm Lambda invocation
+
+    Usage:
+        python benchmark_startup.py Loop-a298a758fb8f.json --runs 10 [--network] [--token]
+
+    --network downloads the discovery document, --token also fetches an access token, both need network access.
+"""
+from __future__ import print_function
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'extractor'))
+
+from apiclient.discovery import build, build_from_document
+from oauth2client.service_account import ServiceAccountCredentials
+import ga_extractor
+
+SCOPES = ['https://www.googleapis.com/auth/analytics.readonly']
+
+
+def _time_runs(runs, fn):
+    timings = []
+    for _ in range(runs):
+        start = time.time()
+        fn()
+        timings.append((time.time() - start) * 1000)
+    return timings
+
+
+def _report(name, timings):
+    timings = sorted(timings)
+    print("%-8s runs=%-4d min=%8.1fms median=%8.1fms max=%8.1fms" % (
+        name, len(timings), timings[0], timings[len(timings) // 2], timings[-1]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the GA extractor startup time.')
+    parser.add_argument('key_file', help='Service account key file')
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--network', action='store_true', help='Include building from the network')
+    parser.add_argument('--token', action='store_true', help='Include fetching an access token')
+    args = parser.parse_args()
+
+    def network():
+        credentials = ServiceAccountCredentials.from_json_keyfile_name(args.key_file, SCOPES)
+        build('analyticsreporting', 'v4', credentials=credentials, cache_discovery=False)
+        if args.token:
+            credentials.get_access_token()
+
+    def cold():
+        credentials = ServiceAccountCredentials.from_json_keyfile_name(args.key_file, SCOPES)
+        build_from_document(ga_extractor.load_discovery_document(), credentials=credentials)
+        if args.token:
+            credentials.get_access_token()
+
+    class Extractor(ga_extractor.GAHourlyUsersPageviewsByPagepath):
+        KEY_FILE_LOCATION = args.key_file
+
+        def __init__(self):
+            self.analytics_context = self.create_analytics_context()
+
+    def warm():
+        extractor = Extractor()
+        if args.token:
+            extractor.refresh_access_token()
+
+    if args.network:
+        _report('network', _time_runs(args.runs, network))
+    _report('cold', _time_runs(args.runs, cold))
+
+    # the first warm run fills the cache, like the cold start of a container
+    warm()
+    _report('warm', _time_runs(args.runs, warm))
+
+
+if __name__ == '__main__':
+    main()
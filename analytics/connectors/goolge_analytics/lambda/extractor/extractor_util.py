@@ -1,14 +1,30 @@
 """Common extractor utility libraries.
 """
 import datetime
+import re
+import threading
+import time
+
+# bundled with the Lambda (requirements.txt), optional elsewhere: values are then converted one at a time
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 
 class ExtractorUtil(object):
     """Static or class utility functions
     """
 
-    @staticmethod
-    def google_analytics_date_to_athena_date(date):
+    # Athena dates and dates by Google Analytics date, a report has few distinct dates and many rows
+    _athena_dates = {}
+    _dates = {}
+
+    # Hive partition keys of the uploaded files, a column of the files can not have the same name
+    PARTITION_KEYS = ('date', 'hour')
+
+    @classmethod
+    def google_analytics_date_to_athena_date(cls, date):
         """
         Convert a Google Analytics day YYYYMMDD to an Athena (hive) date YYYY-MM-DD
 
@@ -16,10 +32,26 @@ class ExtractorUtil(object):
         :return: Athena-supported (Hive) date, which is YYYY-MM-DD
         """
 
-        return datetime.datetime.strptime(date, "%Y%m%d").strftime('%Y-%m-%d')
+        athena_date = cls._athena_dates.get(date)
+        if athena_date is None:
+            athena_date = datetime.datetime.strptime(date, "%Y%m%d").strftime('%Y-%m-%d')
+            cls._athena_dates[date] = athena_date
+        return athena_date
+
+    @staticmethod
+    def notset_to_unknown(value):
+        return value if value != '(not set)' else 'Unknown'
 
     @classmethod
-    def parse_ga_field_value(cls, header, value):
+    def round_decimal(cls, value):
+        try:
+            value = "%.1f" % round(float(value), 1) if '.' in value else value
+        except:
+            pass
+        return cls.notset_to_unknown(value)
+
+    @classmethod
+    def get_ga_field_parser(cls, header):
         """
         Rules for process Google Analytics values.
 
@@ -27,26 +59,236 @@ class ExtractorUtil(object):
         - Convert "(not set)" to "Unknown"
         - Round decimals to 1
 
+        :param header: Name of the field
+        :return: Function converting a value of the given field
+        """
+
+        if header == 'ga:date':
+            return cls.google_analytics_date_to_athena_date
+        if header == 'ga:socialNetwork':
+            return cls.notset_to_unknown
+        return cls.round_decimal
+
+    @classmethod
+    def get_ga_field_parsers(cls, headers):
+        """
+        Compile the converters of a report once, instead of looking them up for every value.
+
+        :param headers: Names of the fields, in column order
+        :return: list of functions, one per field
+        """
+
+        return [cls.get_ga_field_parser(header) for header in headers]
+
+    @classmethod
+    def google_analytics_date_to_date(cls, date):
+        """
+        :param date: Google Analytics date, which is YYYYMMDD
+        :return: datetime.date
+        """
+
+        parsed = cls._dates.get(date)
+        if parsed is None:
+            parsed = datetime.datetime.strptime(date, "%Y%m%d").date()
+            cls._dates[date] = parsed
+        return parsed
+
+    @staticmethod
+    def to_int(value):
+        try:
+            return int(value)
+        except ValueError:
+            return int(float(value))
+
+    @staticmethod
+    def get_ga_field_type(header, metric_type=None):
+        """
+        Column type of a field in the typed output formats.
+
+        :param header: Name of the field
+        :param metric_type: Reporting API V4 type of a metric, e.g. INTEGER, None for dimensions
+        :return: date, int, float or string
+        """
+
+        if header == 'ga:date':
+            return 'date'
+        if header == 'ga:hour':
+            return 'int'
+        if metric_type == 'INTEGER':
+            return 'int'
+        if metric_type in ('FLOAT', 'CURRENCY', 'PERCENT', 'TIME'):
+            return 'float'
+        return 'string'
+
+    @classmethod
+    def get_ga_column_name(cls, header):
+        """
+        Column name of a field in the typed output formats, ga:date is ga_date as date= is a partition key.
+
+        :param header: Name of the field, e.g. ga:pageviews
+        :return: The name without its ga: prefix, unless it is a partition key
+        """
+
+        name = header.replace('ga:', '')
+        return 'ga_' + name if name in cls.PARTITION_KEYS else name
+
+    @classmethod
+    def get_ga_typed_field_parser(cls, field_type):
+        """
+        :param field_type: see get_ga_field_type
+        :return: Function converting a value to the given type
+        """
+
+        if field_type == 'date':
+            return cls.google_analytics_date_to_date
+        if field_type == 'int':
+            return cls.to_int
+        if field_type == 'float':
+            return float
+        return cls.notset_to_unknown
+
+    @classmethod
+    def convert_metric_values(cls, rows, field_types=None):
+        """
+        Convert the metric values of a report page a column at a time, with NumPy when it is installed. The
+        result is the same as converting every value with get_ga_field_parser (CSV) or get_ga_typed_field_parser.
+
+        :param rows: list of the metric values of each row, strings
+        :param field_types: Types of the metrics for the typed output formats, see get_ga_field_type, repeated
+                            for every date range. None for the CSV rules
+        :return: list of the converted values of each row
+        """
+
+        width = len(rows[0]) if rows else 0
+        types = [field_types[j % len(field_types)] if field_types else None for j in range(width)]
+
+        if numpy is None or any(len(row) != width for row in rows):
+            parsers = [cls.get_ga_typed_field_parser(t) if t else cls.round_decimal for t in types]
+            return [[parse(value) for parse, value in zip(parsers, row)] for row in rows]
+
+        values = numpy.array(rows, dtype=numpy.str_).reshape(len(rows), width)
+        columns = [cls._convert_metric_column(values[:, j], t) for j, t in enumerate(types)]
+        return [list(row) for row in zip(*columns)]
+
+    @classmethod
+    def _convert_metric_column(cls, column, field_type):
+        """
+        :param column: numpy array of strings
+        :param field_type: int, float, string, or None for the CSV rules
+        :return: list of converted values
+        """
+
+        try:
+            if field_type == 'int':
+                try:
+                    return column.astype(numpy.int64).tolist()
+                except ValueError:
+                    return column.astype(numpy.float64).astype(numpy.int64).tolist()
+            if field_type == 'float':
+                return column.astype(numpy.float64).tolist()
+        except (ValueError, OverflowError):
+            parse = cls.get_ga_typed_field_parser(field_type)
+            return [parse(value) for value in column.tolist()]
+
+        converted = numpy.where(column == '(not set)', 'Unknown', column).astype(object)
+        if field_type is None:
+            # decimals are rounded to 1 with round(), like round_decimal: formatting alone rounds ties to even,
+            # round() of Python 2 rounds them away from zero
+            decimals = numpy.char.find(column, '.') >= 0
+            if decimals.any():
+                try:
+                    converted[decimals] = ['%.1f' % round(value, 1)
+                                           for value in column[decimals].astype(numpy.float64).tolist()]
+                except ValueError:
+                    return [cls.round_decimal(value) for value in column.tolist()]
+        return converted.tolist()
+
+    @classmethod
+    def parse_ga_field_value(cls, header, value):
+        """
         :param header: Name of the field
         :param value: Value of the given field
-        :return: Converted value if any.
+        :return: Converted value if any, see get_ga_field_parser.
         """
 
-        def notset_to_unknown(v):
-            return v if v != '(not set)' else 'Unknown'
+        return cls.get_ga_field_parser(header)(value)
+
+    @staticmethod
+    def resolve_ga_date(date, today=None):
+        """
+        Resolve a Google Analytics date to an absolute date.
+
+        :param date: YYYY-MM-DD, 'today', 'yesterday' or 'NdaysAgo'
+        :param today: datetime.date to resolve relative dates against, defaults to today (UTC)
+        :return: datetime.date
+        """
+        today = today or datetime.datetime.utcnow().date()
+
+        if date == 'today':
+            return today
+        if date == 'yesterday':
+            return today - datetime.timedelta(days=1)
+
+        days_ago = re.match(r'^(\d+)daysAgo$', date)
+        if days_ago:
+            return today - datetime.timedelta(days=int(days_ago.group(1)))
+
+        return datetime.datetime.strptime(date, '%Y-%m-%d').date()
+
+    @classmethod
+    def split_date_range(cls, start_date, end_date, days=1, today=None):
+        """
+        Split a Google Analytics date range into consecutive sub-ranges.
+
+        :param start_date: Start of the range, see resolve_ga_date
+        :param end_date: End of the range (inclusive), see resolve_ga_date
+        :param days: Number of days per sub-range
+        :param today: datetime.date to resolve relative dates against
+        :return: list of {'startDate': YYYY-MM-DD, 'endDate': YYYY-MM-DD}
+        """
+        start = cls.resolve_ga_date(start_date, today)
+        end = cls.resolve_ga_date(end_date, today)
+
+        ranges = []
+        while start <= end:
+            sub_end = min(end, start + datetime.timedelta(days=days - 1))
+            ranges.append({'startDate': start.strftime('%Y-%m-%d'), 'endDate': sub_end.strftime('%Y-%m-%d')})
+            start = sub_end + datetime.timedelta(days=1)
+
+        return ranges
+
+
+class RateLimiter(object):
+    """Thread-safe token bucket, shared by every thread calling the same API quota.
+    """
+
+    def __init__(self, rate, burst=1):
+        """
+        :param rate: Requests per second
+        :param burst: Requests allowed at once after an idle period
+        """
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.tokens = float(burst)
+        self.updated_at = time.time()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Block until a request is allowed.
+        """
+        while True:
+            with self.lock:
+                now = time.time()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+                self.updated_at = now
 
-        def default(v):
-            try:
-                v = "%.1f" % round(float(v), 1) if '.' in v else v
-            except:
-                pass
-            return notset_to_unknown(v)
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
 
-        parser = {
-            'ga:date': cls.google_analytics_date_to_athena_date,
-            'ga:socialNetwork': notset_to_unknown
-        }
+                wait = (1 - self.tokens) / self.rate
 
-        return parser.get(header, default)(value)
+            time.sleep(wait)
 
 
@@ -0,0 +1,165 @@
+"""
+    Backfill of historical Google Analytics data.
+
+    The date range is sharded into day or week chunks, extracted by parallel workers that share the process-wide
+    rate limiter and GA_MAX_CONCURRENT_REQUESTS calls in flight of the Reporting API, and written to the same
+    partitioned output as the scheduled extraction.
+    Failed chunks are retried with exponential backoff. Completed chunks are recorded in a checkpoint file, so an
+    interrupted backfill resumes where it stopped.
+
+    Usage:
+        python ga_backfill.py GAHourlyUsersPageviewsByPagepath 2017-01-01 2017-12-31 --chunk week --workers 4
+"""
+from __future__ import print_function
+
+import argparse
+import json
+import logging
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import ga_extractor
+from extractor_util import ExtractorUtil, RateLimiter
+
+CHUNK_DAYS = {'day': 1, 'week': 7}
+
+logger = logging.getLogger()
+
+
+class Checkpoint(object):
+    """
+    JSON file of the chunks already extracted, e.g. {"done": ["2017-01-01..2017-01-07"]}
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.done = set()
+        if os.path.exists(path):
+            with open(path) as f:
+                self.done = set(json.load(f).get('done', []))
+
+    @staticmethod
+    def chunk_id(chunk):
+        return chunk['startDate'] + '..' + chunk['endDate']
+
+    def is_done(self, chunk):
+        return self.chunk_id(chunk) in self.done
+
+    def mark_done(self, chunk):
+        with self.lock:
+            self.done.add(self.chunk_id(chunk))
+            temp_path = self.path + '.tmp'
+            with open(temp_path, 'w') as f:
+                json.dump({'done': sorted(self.done)}, f, indent=2)
+            os.rename(temp_path, self.path)
+
+
+def get_report_class(name):
+    """
+    :param name: Name of a GoogleAnalyticsAPIExtractorBase subclass in ga_extractor
+    :return: The class
+    """
+    report_class = getattr(ga_extractor, name, None)
+    if not (isinstance(report_class, type) and
+            issubclass(report_class, ga_extractor.GoogleAnalyticsAPIExtractorBase) and
+            report_class is not ga_extractor.GoogleAnalyticsAPIExtractorBase):
+        raise Exception('%s is not a Google Analytics extractor.' % name)
+    return report_class
+
+
+def extract_chunk(report_class, chunk, dev_mode=False, max_retries=3, backoff=2.0):
+    """
+    Extract and push the data of one chunk, retrying with exponential backoff.
+
+    :param report_class: GoogleAnalyticsAPIExtractorBase subclass
+    :param chunk: {'startDate': YYYY-MM-DD, 'endDate': YYYY-MM-DD}
+    :param dev_mode: Do not upload
+    :param max_retries: Retries after the first failure
+    :param backoff: Seconds before the first retry, doubled on every retry
+    """
+    attempt = 0
+    while True:
+        extractor = report_class(ga_extractor.SimpleDatetimeOutputWriter(dev_mode))
+        extractor.date_range = chunk
+        try:
+            ga_extractor.ReportScheduler([extractor]).run()
+            return
+        except Exception as e:
+            extractor.output_writer.clean_up()
+            if attempt >= max_retries:
+                raise
+
+            pause = backoff * (2 ** attempt) * (1 + random.random())
+            logger.warning("Chunk %s failed, retrying in %.1fs: %s" % (Checkpoint.chunk_id(chunk), pause, e))
+            time.sleep(pause)
+            attempt += 1
+
+
+def backfill(report_name, start_date, end_date, chunk='day', workers=4, checkpoint_path=None, dev_mode=False,
+             max_retries=3, requests_per_second=None):
+    """
+    :param report_name: Name of a GoogleAnalyticsAPIExtractorBase subclass in ga_extractor
+    :param start_date: First date, YYYY-MM-DD or a relative Google Analytics date
+    :param end_date: Last date (inclusive)
+    :param chunk: day or week
+    :param workers: Number of chunks extracted at once
+    :param checkpoint_path: Checkpoint file, /tmp/ga_backfill_{report_name}.json by default
+    :param dev_mode: Do not upload
+    :param max_retries: Retries of a failed chunk
+    :param requests_per_second: Rate limit of the Reporting API shared by every worker, GA_REQUESTS_PER_SECOND
+                                by default
+    :return: list of chunks that failed
+    """
+    report_class = get_report_class(report_name)
+    checkpoint = Checkpoint(checkpoint_path or '/tmp/ga_backfill_%s.json' % report_name)
+    if requests_per_second:
+        ga_extractor.ReportFetcher.rate_limiter = RateLimiter(requests_per_second,
+                                                              burst=ga_extractor.GA_MAX_CONCURRENT_REQUESTS)
+
+    chunks = ExtractorUtil.split_date_range(start_date, end_date, CHUNK_DAYS[chunk])
+    pending = [c for c in chunks if not checkpoint.is_done(c)]
+    logger.info("Backfilling %s: %s chunks, %s already done" % (report_name, len(chunks), len(chunks) - len(pending)))
+
+    failed = []
+    pool = ThreadPoolExecutor(max_workers=workers)
+    try:
+        futures = dict((pool.submit(extract_chunk, report_class, c, dev_mode, max_retries), c) for c in pending)
+        for future in as_completed(futures):
+            chunk_range = futures[future]
+            try:
+                future.result()
+            except Exception as e:
+                logger.error("Chunk %s failed: %s" % (Checkpoint.chunk_id(chunk_range), e))
+                failed.append(chunk_range)
+                continue
+
+            checkpoint.mark_done(chunk_range)
+            logger.info("Chunk %s done" % Checkpoint.chunk_id(chunk_range))
+    finally:
+        pool.shutdown(wait=True)
+
+    return failed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Backfill Google Analytics reports.')
+    parser.add_argument('report', help='Extractor class, e.g. GAHourlyUsersPageviewsByPagepath')
+    parser.add_argument('start_date', help='YYYY-MM-DD')
+    parser.add_argument('end_date', help='YYYY-MM-DD, inclusive')
+    parser.add_argument('--chunk', choices=sorted(CHUNK_DAYS), default='day')
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--checkpoint', help='Checkpoint file, /tmp/ga_backfill_{report}.json by default')
+    parser.add_argument('--max-retries', type=int, default=3)
+    parser.add_argument('--requests-per-second', type=float)
+    parser.add_argument('--dev', action='store_true', help='Do not upload')
+    args = parser.parse_args()
+
+    failed_chunks = backfill(args.report, args.start_date, args.end_date, chunk=args.chunk, workers=args.workers,
+                             checkpoint_path=args.checkpoint, dev_mode=args.dev, max_retries=args.max_retries,
+                             requests_per_second=args.requests_per_second)
+    if failed_chunks:
+        raise SystemExit('%s chunks failed, run again to resume.' % len(failed_chunks))
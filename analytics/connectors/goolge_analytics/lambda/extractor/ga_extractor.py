@@ -6,37 +6,83 @@
     TODO Move to 3.6
 """
 from __future__ import print_function
-from apiclient.discovery import build
+from apiclient.discovery import build_from_document, DISCOVERY_URI
 from oauth2client.service_account import ServiceAccountCredentials
 from collections import OrderedDict, defaultdict
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 import boto3
+from boto3.s3.transfer import TransferConfig
+import copy
+import hashlib
+import re
+import httplib2
+import threading
+import uuid
 import os, sys, errno, io
 from abc import ABCMeta, abstractmethod, abstractproperty
 from time import gmtime, strftime
 import csv, gzip
 import ast, json
 import logging
-from extractor_util import ExtractorUtil
+from extractor_util import ExtractorUtil, RateLimiter
+from lambda_profiler import profiled
+from watermark_store import WatermarkStore, finalized_through
+from output_format import create_output_format
+from response_cache import ResponseCache
+from rollup import Rollup
 
 ENV = os.environ.get('ENV', 'DEV')
 DEV_MODE = True if ENV == 'DEV' else False
+
+# Reporting API V4 quotas are 100 requests per 100 seconds per user and 10 concurrent requests per view
+GA_REQUESTS_PER_SECOND = float(os.environ.get('GA_REQUESTS_PER_SECOND', 1))
+GA_MAX_CONCURRENT_REQUESTS = int(os.environ.get('GA_MAX_CONCURRENT_REQUESTS', 4))
+
+# Largest number of partition files a writer keeps open, backfills over long ranges write thousands of them
+GA_MAX_OPEN_FILES = int(os.environ.get('GA_MAX_OPEN_FILES', 64))
+
+# csv, or parquet for typed columns (pyarrow is not in requirements.txt), see output_format
+GA_OUTPUT_FORMAT = os.environ.get('GA_OUTPUT_FORMAT', 'csv')
+
+# Files uploaded at once, and the multipart transfer config of each upload
+GA_MAX_CONCURRENT_UPLOADS = int(os.environ.get('GA_MAX_CONCURRENT_UPLOADS', 8))
+GA_MULTIPART_CHUNKSIZE = int(os.environ.get('GA_MULTIPART_CHUNKSIZE', 16 * 1024 * 1024))
+
+# Discovery document shipped with the code, and where it is cached when it has to be downloaded
+DISCOVERY_DOCUMENT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'analyticsreporting.v4.json')
+DISCOVERY_DOCUMENT_CACHE = '/tmp/analyticsreporting.v4.json'
+
+# Cache of report pages, disabled with a TTL of 0, see response_cache
+GA_RESPONSE_CACHE_DIR = os.environ.get('GA_RESPONSE_CACHE_DIR', '/tmp/ga_response_cache')
+GA_RESPONSE_CACHE_TTL = int(os.environ.get('GA_RESPONSE_CACHE_TTL', 3600))
+GA_RESPONSE_CACHE_MAX_BYTES = int(os.environ.get('GA_RESPONSE_CACHE_MAX_BYTES', 256 * 1024 * 1024))
+
+# Watermarks of the incremental extraction, in S3, or in a local file in DEV mode
+GA_WATERMARK_S3_BUCKET = os.environ.get('GA_WATERMARK_S3_BUCKET', 'loop-logs')
+GA_WATERMARK_S3_KEY = os.environ.get('GA_WATERMARK_S3_KEY', 'google_analytics/_watermarks.json')
+GA_WATERMARK_FILE = os.environ.get('GA_WATERMARK_FILE', '/tmp/ga_watermarks.json')
+
+# Reports derived locally from the rows of another report, see rollup, and the page paths kept per day
+GA_ROLLUPS_ENABLED = os.environ.get('GA_ROLLUPS_ENABLED', 'True') == 'True'
+GA_TOP_PAGE_PATHS = int(os.environ.get('GA_TOP_PAGE_PATHS', 100))
 logging.basicConfig()
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
 
+@profiled()
 def handler(event, context):
     logger.setLevel(logging.INFO)
 
     try:
         try:
+            watermark_store = create_watermark_store(DEV_MODE)
             extractors = [
-                GADailyUsersNewUsersBounceRateBySocialNetwork(SimpleDatetimeOutputWriter(DEV_MODE)),
-                GAHourlyUsersPageviewsByPagepath(SimpleDatetimeOutputWriter(DEV_MODE))
+                GADailyUsersNewUsersBounceRateBySocialNetwork(SimpleDatetimeOutputWriter(DEV_MODE), watermark_store),
+                GAHourlyUsersPageviewsByPagepath(SimpleDatetimeOutputWriter(DEV_MODE), watermark_store)
             ]
 
-            for analytics in extractors:
-                analytics.process()
+            ReportScheduler(extractors).run()
 
         except Exception as e:
             logger.error("Google Analytics Extractor failed.")
@@ -50,15 +96,71 @@ def handler(event, context):
     return True
 
 
+def create_watermark_store(dev_mode=False):
+    """
+    :param dev_mode: Keep the watermarks in a local file instead of S3
+    :return: WatermarkStore
+    """
+
+    if dev_mode:
+        return WatermarkStore(path=GA_WATERMARK_FILE)
+    return WatermarkStore(s3_bucket=GA_WATERMARK_S3_BUCKET, s3_key=GA_WATERMARK_S3_KEY,
+                          s3_client=SimpleDatetimeOutputWriter.s3_client)
+
+
+def load_discovery_document():
+    """
+    Read the Analytics Reporting API V4 discovery document shipped with the code. If it is missing, it is
+    downloaded once and cached in /tmp for the next cold starts of the same container.
+
+    :return: The discovery document, a JSON string
+    """
+
+    for path in (DISCOVERY_DOCUMENT, DISCOVERY_DOCUMENT_CACHE):
+        if os.path.exists(path):
+            with open(path) as f:
+                return f.read()
+
+    logger.warning("No local discovery document found, downloading it.")
+    uri = DISCOVERY_URI.replace('{api}', 'analyticsreporting').replace('{apiVersion}', 'v4')
+    resp, content = httplib2.Http().request(uri)
+    if resp.status >= 400:
+        raise Exception('Failed to download the discovery document: %s' % resp.status)
+
+    content = content.decode('utf-8') if isinstance(content, bytes) else content
+    with open(DISCOVERY_DOCUMENT_CACHE, 'w') as f:
+        f.write(content)
+    return content
+
+
 class GoogleAnalyticsAPIExtractorBase:
     __metaclass__ = ABCMeta
 
-    def __init__(self, writer):
+    # Service objects and credentials by key file and scopes, shared by every extractor of the process
+    analytics_contexts = {}
+
+    # First date fetched when a report has no watermark yet
+    DEFAULT_START_DATE = '2daysAgo'
+
+    # Keyword arguments of the rollups derived from the report, see rollup.Rollup
+    ROLLUPS = ()
+
+    def __init__(self, writer, watermark_store=None):
+        """
+        :param writer: SimpleDatetimeOutputWriter
+        :param watermark_store: WatermarkStore. Without it the whole DEFAULT_START_DATE..today window is fetched
+                                and written on every run
+        """
 
         # set up context and clean up
         self.analytics_context = self.create_analytics_context()
         self.output_writer = writer
         self.output_writer.clean_up()
+        self.watermark_store = watermark_store
+        self.date_range = None
+        self.golden_dates = set()
+        self.mutable_dates = set()
+        self.rollups = [Rollup(**config) for config in self.ROLLUPS] if GA_ROLLUPS_ENABLED else []
 
     @abstractproperty
     def report_type(self):
@@ -68,19 +170,45 @@ class GoogleAnalyticsAPIExtractorBase:
     def get_api_query(self):
         pass
 
-    def process(self):
+    def get_date_range(self):
+        """
+        The window still to fetch: from the day after the last finalized date, or DEFAULT_START_DATE on the first
+        run, to today. It is resolved once per run, so the watermark is moved against the window actually fetched.
+
+        :return: {'startDate': YYYY-MM-DD, 'endDate': YYYY-MM-DD}
+        """
 
-        # Call Google Analytics API
-        response = self.fetch_report_data()
+        if self.date_range is None:
+            start_date = self.DEFAULT_START_DATE
+            if self.watermark_store is not None:
+                start_date = self.watermark_store.get_start_date(self.report_type, self.DEFAULT_START_DATE)
 
-        # Parse results
-        self.format_and_save_report_data(response)
+            today = ExtractorUtil.resolve_ga_date('today')
+            start = min(ExtractorUtil.resolve_ga_date(start_date, today), today)
+            self.date_range = {'startDate': start.strftime('%Y-%m-%d'), 'endDate': today.strftime('%Y-%m-%d')}
 
-        # Push to S3 for downstream uses (Athena, QuickInsights, etc)
-        self.push_data()
+        return self.date_range
 
-        # clean up temporary files
-        self.output_writer.clean_up()
+    def mark_finalized(self, report_request, report):
+        """
+        Keep track of the dates Google Analytics reports as golden, i.e. that will not change anymore.
+
+        :param report_request: The ReportRequest of the report page
+        :param report: A report page
+        """
+
+        date_range = report_request['dateRanges'][0]
+        dates = self.golden_dates if report.get('data', {}).get('isDataGolden') else self.mutable_dates
+        for sub_range in ExtractorUtil.split_date_range(date_range['startDate'], date_range['endDate']):
+            dates.add(sub_range['startDate'])
+
+    def process(self):
+        """
+        Call Google Analytics API, parse results page by page as they arrive, and push them to S3 for downstream
+        uses (Athena, QuickInsights, etc). Use ReportScheduler to process several extractors together.
+        """
+
+        ReportScheduler([self]).run()
 
     def format_and_save_report_data(self, response):
         """
@@ -97,37 +225,50 @@ class GoogleAnalyticsAPIExtractorBase:
         for report in response.get('reports', []):
             column_header = report.get('columnHeader', {})
             dimension_headers = column_header.get('dimensions', [])
-            metric_headers = column_header.get('metricHeader', {}).get('metricHeaderEntries', [])
-
-            tabular_data = OrderedDict((d, []) for d in dimension_headers)
-            for m in metric_headers:
-                tabular_data[m['name']] = []
-            logger.debug(tabular_data)
-
-            for row in report.get('data', {}).get('rows', []):
-                dimensions = row.get('dimensions', [])
-                date_range_values = row.get('metrics', [])
-
-                # Dimensions
-                for header, dimension in zip(dimension_headers, dimensions):
-                    tabular_data[header].append(ExtractorUtil.parse_ga_field_value(header, dimension))
-
-                # Metrics
-                for i, values in enumerate(date_range_values):
-                    for header, value in zip(metric_headers, values.get('values')):
-                        tabular_data[header.get('name')].append(ExtractorUtil.parse_ga_field_value(header.get('name'), value))
-
-            logger.debug(" ".join(tabular_data.keys()))
-            num_of_rows = len(tabular_data[dimension_headers[0]])
-            for i in range(num_of_rows):
-                row = [tabular_data[k][i] for k in tabular_data.keys()]
-                date = tabular_data['ga:date'][i] if 'ga:date' in tabular_data else None
-                hour = tabular_data['ga:hour'][i] if 'ga:hour' in tabular_data else None
-
-                self.output_writer.write_data(row,
-                                              self.report_type,
-                                              date=date,
-                                              hour=hour)
+            metric_entries = column_header.get('metricHeader', {}).get('metricHeaderEntries', [])
+            metric_headers = [m['name'] for m in metric_entries]
+
+            rows = report.get('data', {}).get('rows', [])
+            date_range_count = max([len(row.get('metrics', [])) for row in rows] or [1])
+
+            # dimension converters are compiled once per report, metrics are converted a column at a time
+            metric_types = None
+            if self.output_writer.typed:
+                dimension_types = [ExtractorUtil.get_ga_field_type(h) for h in dimension_headers]
+                metric_types = [ExtractorUtil.get_ga_field_type(m['name'], m.get('type')) for m in metric_entries]
+                # the metrics of the date ranges after the first are suffixed, e.g. pageviews_range2
+                columns = [(ExtractorUtil.get_ga_column_name(h), t) for h, t in zip(dimension_headers, dimension_types)]
+                for n in range(date_range_count):
+                    suffix = '_range%d' % (n + 1) if n else ''
+                    columns.extend((ExtractorUtil.get_ga_column_name(h) + suffix, t)
+                                   for h, t in zip(metric_headers, metric_types))
+                self.output_writer.set_columns(columns)
+                dimension_parsers = [ExtractorUtil.get_ga_typed_field_parser(t) for t in dimension_types]
+            else:
+                dimension_parsers = ExtractorUtil.get_ga_field_parsers(dimension_headers)
+
+            date_index = dimension_headers.index('ga:date') if 'ga:date' in dimension_headers else None
+            hour_index = dimension_headers.index('ga:hour') if 'ga:hour' in dimension_headers else None
+            to_athena_date = ExtractorUtil.google_analytics_date_to_athena_date
+            write_data = self.output_writer.write_data
+            report_type = self.report_type
+
+            dimension_rows = [row.get('dimensions', []) for row in rows]
+            # Metrics, of every date range
+            metric_rows = [[value for values in row.get('metrics', []) for value in values.get('values')]
+                           for row in rows]
+
+            for dimensions, metrics in zip(dimension_rows,
+                                           ExtractorUtil.convert_metric_values(metric_rows, metric_types)):
+                data = [parse(value) for parse, value in zip(dimension_parsers, dimensions)]
+                data.extend(metrics)
+                date = to_athena_date(dimensions[date_index]) if date_index is not None else None
+                hour = dimensions[hour_index] if hour_index is not None else None
+
+                write_data(data, report_type, date=date, hour=hour)
+
+            for rollup in self.rollups:
+                rollup.add(dimension_headers, metric_entries, dimension_rows, metric_rows)
 
     def push_data(self):
         """
@@ -137,37 +278,274 @@ class GoogleAnalyticsAPIExtractorBase:
         TODO Check to see if we need some kind of cron lock
         """
 
-        self.output_writer.push_data(self.report_type)
+        self.push_rollups()
+        if self.watermark_store is None:
+            self.output_writer.push_data(self.report_type)
+            return
+
+        # partitions whose rows are the same as on the last run are not written again
+        digests = self.output_writer.get_partition_digests()
+        unchanged = set(partition for partition, digest in digests.items()
+                        if self.watermark_store.get_partition_digest(self.report_type, partition) == digest)
+        self.output_writer.push_data(self.report_type, skip_partitions=unchanged)
+
+        for partition, digest in digests.items():
+            self.watermark_store.set_partition_digest(self.report_type, partition, digest)
+
+        finalized_date = finalized_through(self.get_date_range()['startDate'], self.golden_dates - self.mutable_dates)
+        if finalized_date:
+            self.watermark_store.set_finalized_date(self.report_type, finalized_date)
         # self.output_writer.clean_up()
 
+    def push_rollups(self):
+        """
+        Write and upload the rollups of the report, each as a report of its own, one partition per date.
+        """
+
+        for rollup in self.rollups:
+            writer = SimpleDatetimeOutputWriter(self.output_writer.dev_mode, self.output_writer.output_format)
+            try:
+                if writer.typed:
+                    writer.set_columns(rollup.columns())
+                for date, data in rollup.rows(typed=writer.typed):
+                    writer.write_data(data, rollup.report_type,
+                                      date=ExtractorUtil.google_analytics_date_to_athena_date(date))
+                writer.push_data(rollup.report_type)
+            finally:
+                writer.clean_up()
+
+    @property
+    def context_key(self):
+        return self.KEY_FILE_LOCATION, tuple(self.SCOPES)
+
     def create_analytics_context(self):
         """Initializes an Analytics Reporting API V4 service object.
+        The key file is read and the service object built once per process for each key file and scopes, from
+        a local discovery document. Warm invocations reuse both, and the access token until it expires.
 
         Returns:
           An authorized Analytics Reporting API V4 service object.
         """
 
-        credentials = ServiceAccountCredentials.from_json_keyfile_name(
-            self.KEY_FILE_LOCATION, self.SCOPES)
+        if self.context_key not in self.analytics_contexts:
+            credentials = ServiceAccountCredentials.from_json_keyfile_name(
+                self.KEY_FILE_LOCATION, self.SCOPES)
+
+            # Build the service object.
+            analytics = build_from_document(load_discovery_document(), credentials=credentials)
 
-        # Build the service object.
-        analytics = build('analyticsreporting', 'v4', credentials=credentials)
+            self.analytics_contexts[self.context_key] = (analytics, credentials)
 
+        (analytics, self.credentials) = self.analytics_contexts[self.context_key]
         return analytics
 
+    def refresh_access_token(self):
+        """
+        Get an access token up front, unless the cached one is still valid, so concurrent requests share it
+        instead of each getting a 401 and refreshing on their own.
+        """
+
+        if not self.credentials.access_token or self.credentials.access_token_expired:
+            self.credentials.get_access_token()
+
     def fetch_report_data(self):
         """
         Wrapping metrics and dimensions needed for the query to fetch for the google analytics data.
+        Every page of every report is fetched, see ReportFetcher.
 
         Returns:
-          The Analytics Reporting API V4 response.
+          A generator of Analytics Reporting API V4 responses, one per page of a report, as they arrive.
+        """
+
+        fetcher = ReportFetcher(self.analytics_context, self.credentials)
+        for _, _, report in fetcher.fetch(self.get_api_query()):
+            yield {'reports': [report]}
+
+
+class ReportScheduler(object):
+    """
+    Run several extractors together: one service object per key file, and the report requests of every
+    extractor fetched through shared batchGet calls. Each returned report page is routed back to the extractor
+    that asked for it, then every extractor pushes its data and the watermarks are saved.
+    """
+
+    def __init__(self, extractors):
+        self.extractors = extractors
+
+    def run(self):
+        by_context = OrderedDict()
+        for extractor in self.extractors:
+            by_context.setdefault(extractor.context_key, []).append(extractor)
+
+        for extractors in by_context.values():
+            owners, report_requests = [], []
+            for extractor in extractors:
+                for report_request in extractor.get_api_query():
+                    owners.append(extractor)
+                    report_requests.append(report_request)
+
+            extractors[0].refresh_access_token()
+            fetcher = ReportFetcher(extractors[0].analytics_context, extractors[0].credentials)
+            for i, request, report in fetcher.fetch(report_requests):
+                owners[i].format_and_save_report_data({'reports': [report]})
+                owners[i].mark_finalized(request, report)
+
+        for extractor in self.extractors:
+            # Push to S3 for downstream uses (Athena, QuickInsights, etc)
+            extractor.push_data()
+
+            # clean up temporary files
+            extractor.output_writer.clean_up()
+
+        watermark_stores = []
+        for extractor in self.extractors:
+            if extractor.watermark_store is not None and extractor.watermark_store not in watermark_stores:
+                watermark_stores.append(extractor.watermark_store)
+        for watermark_store in watermark_stores:
+            watermark_store.save()
+
+
+class ReportFetcher(object):
+    """
+    Fetch complete reports: the date range of a request is split into sub-ranges, compatible requests are
+    grouped into shared batchGet calls, and every page of a report is followed through nextPageToken. Calls run
+    concurrently on a bounded pool, under a rate limiter and a limit of calls in flight shared by every fetcher of
+    the process, as the Reporting API allows 10 concurrent requests per view.
+    """
+    # Largest page size the Reporting API V4 returns
+    PAGE_SIZE = 100000
+    # Largest number of report requests in a batchGet
+    MAX_REQUESTS_PER_BATCH = 5
+    DAYS_PER_REQUEST = 1
+    NUM_RETRIES = 3
+
+    # Fields that must be the same for every request of a batchGet
+    BATCH_KEY_FIELDS = ('viewId', 'dateRanges', 'samplingLevel', 'segments', 'cohortGroup')
+
+    rate_limiter = RateLimiter(GA_REQUESTS_PER_SECOND, burst=GA_MAX_CONCURRENT_REQUESTS)
+    request_slots = threading.BoundedSemaphore(GA_MAX_CONCURRENT_REQUESTS)
+    response_cache = ResponseCache(GA_RESPONSE_CACHE_DIR, GA_RESPONSE_CACHE_TTL,
+                                   GA_RESPONSE_CACHE_MAX_BYTES) if GA_RESPONSE_CACHE_TTL > 0 else None
+
+    def __init__(self, analytics_context, credentials, max_workers=GA_MAX_CONCURRENT_REQUESTS,
+                 days_per_request=DAYS_PER_REQUEST, response_cache=None):
+        """
+        :param analytics_context: Analytics Reporting API V4 service object
+        :param credentials: Credentials of the service object, to authorize one http object per thread
+        :param max_workers: Number of calls in flight of this fetcher, request_slots bounds those of the process
+        :param days_per_request: Number of days of each date sub-range
+        :param response_cache: ResponseCache, the one shared by every fetcher of the process by default
         """
+        self.analytics_context = analytics_context
+        self.credentials = credentials
+        self.max_workers = max_workers
+        self.days_per_request = days_per_request
+        self.local = threading.local()
+        if response_cache is not None:
+            self.response_cache = response_cache
+
+    def split_request(self, report_request):
+        """
+        Split a report request into one request per date sub-range, with the largest page size.
+        Only requests broken down by ga:date are split: the rows of other requests aggregate the whole range, and
+        metrics such as ga:users or rates do not add up across sub-ranges. Requests with more than one date range
+        are compared across ranges and are not split either.
+
+        :param report_request: A Reporting API V4 ReportRequest
+        :return: list of ReportRequests
+        """
+        date_ranges = report_request.get('dateRanges', [])
+        by_date = any(d.get('name') == 'ga:date' for d in report_request.get('dimensions', []))
+        if len(date_ranges) != 1 or not by_date:
+            sub_ranges = [date_ranges]
+        else:
+            sub_ranges = [[r] for r in ExtractorUtil.split_date_range(
+                date_ranges[0]['startDate'], date_ranges[0]['endDate'], self.days_per_request)]
+
+        requests = []
+        for sub_range in sub_ranges:
+            request = copy.deepcopy(report_request)
+            request['dateRanges'] = sub_range
+            request['pageSize'] = self.PAGE_SIZE
+            requests.append(request)
+
+        return requests
 
-        return self.analytics_context.reports().batchGet(
-            body={
-                'reportRequests': self.get_api_query()
-            }
-        ).execute()
+    def group_requests(self, report_requests):
+        """
+        :param report_requests: list of (index, ReportRequest)
+        :return: list of batches, lists of up to MAX_REQUESTS_PER_BATCH (index, ReportRequest) that can share
+                 a batchGet
+        """
+        groups = OrderedDict()
+        for i, request in report_requests:
+            key = json.dumps([request.get(f) for f in self.BATCH_KEY_FIELDS], sort_keys=True)
+            groups.setdefault(key, []).append((i, request))
+
+        return [group[n:n + self.MAX_REQUESTS_PER_BATCH]
+                for group in groups.values()
+                for n in range(0, len(group), self.MAX_REQUESTS_PER_BATCH)]
+
+    def fetch(self, report_requests):
+        """
+        :param report_requests: list of Reporting API V4 ReportRequests
+        :return: A generator of (index of the report request, ReportRequest of the page, report page), in the
+                 order pages arrive.
+        """
+        pool = ThreadPoolExecutor(max_workers=self.max_workers)
+        try:
+            split_requests = [(i, request)
+                              for i, report_request in enumerate(report_requests)
+                              for request in self.split_request(report_request)]
+            pending = set(pool.submit(self.fetch_batch, batch) for batch in self.group_requests(split_requests))
+
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    next_pages = []
+                    for i, request, report in future.result():
+                        next_page_token = report.get('nextPageToken')
+                        if next_page_token:
+                            next_pages.append((i, dict(request, pageToken=next_page_token)))
+
+                        yield i, request, report
+
+                    if next_pages:
+                        pending.add(pool.submit(self.fetch_batch, next_pages))
+        finally:
+            pool.shutdown(wait=False)
+
+    def fetch_batch(self, batch):
+        """
+        :param batch: list of (index, ReportRequest) sharing a batchGet
+        :return: list of (index, ReportRequest, report)
+        """
+        reports = [self.response_cache.get(request) if self.response_cache else None for _, request in batch]
+        missing = [(n, request) for n, ((_, request), report) in enumerate(zip(batch, reports)) if report is None]
+
+        if missing:
+            with self.request_slots:
+                self.rate_limiter.acquire()
+                response = self.analytics_context.reports().batchGet(
+                    body={
+                        'reportRequests': [request for _, request in missing]
+                    }
+                ).execute(http=self._http(), num_retries=self.NUM_RETRIES)
+
+            for (n, request), report in zip(missing, response['reports']):
+                reports[n] = report
+                if self.response_cache:
+                    self.response_cache.put(request, report)
+
+        return [(i, request, report) for (i, request), report in zip(batch, reports)]
+
+    def _http(self):
+        """
+        httplib2 is not thread-safe, every thread gets its own authorized http object.
+        """
+        if not hasattr(self.local, 'http'):
+            self.local.http = self.credentials.authorize(httplib2.Http())
+        return self.local.http
 
 
 class GAHourlyUsersPageviewsByPagepath(GoogleAnalyticsAPIExtractorBase):
@@ -176,9 +554,22 @@ class GAHourlyUsersPageviewsByPagepath(GoogleAnalyticsAPIExtractorBase):
     KEY_FILE_LOCATION = 'Loop-a298a758fb8f.json'
     VIEW_ID = '146839166'
 
-    def __init__(self, writer):
+    # Daily reports derived from the hourly rows, instead of being requested from the API on their own.
+    # Sessions are counted in the hour they start in
+    ROLLUPS = (
+        {'report_type': 'GADailyPageviewsSessionsTotals',
+         'group_by': ['ga:date'],
+         'metrics': ['ga:pageviews', 'ga:uniquePageviews', 'ga:sessions']},
+        {'report_type': 'GADailyTopPagepathsByPageviews',
+         'group_by': ['ga:date', 'ga:pagePath'],
+         'metrics': ['ga:pageviews', 'ga:uniquePageviews'],
+         'top': GA_TOP_PAGE_PATHS,
+         'order_by': 'ga:pageviews'},
+    )
+
+    def __init__(self, writer, watermark_store=None):
         # Pass writer to parent
-        super(GAHourlyUsersPageviewsByPagepath, self).__init__(writer)
+        super(GAHourlyUsersPageviewsByPagepath, self).__init__(writer, watermark_store)
 
     @property
     def report_type(self):
@@ -188,7 +579,7 @@ class GAHourlyUsersPageviewsByPagepath(GoogleAnalyticsAPIExtractorBase):
         return [
             {
                 'viewId': self.VIEW_ID,
-                'dateRanges': [{'startDate': '2daysAgo', 'endDate': 'today'}],
+                'dateRanges': [self.get_date_range()],
                 'metrics': [{'expression': 'ga:uniquePageviews'},
                             {'expression': 'ga:sessions'},
                             {"expression": "ga:pageviews"},
@@ -206,9 +597,9 @@ class GADailyUsersNewUsersBounceRateBySocialNetwork(GoogleAnalyticsAPIExtractorB
     KEY_FILE_LOCATION = 'Loop-a298a758fb8f.json'
     VIEW_ID = '146839166'
 
-    def __init__(self, writer):
+    def __init__(self, writer, watermark_store=None):
         # Pass writer to parent
-        super(GADailyUsersNewUsersBounceRateBySocialNetwork, self).__init__(writer)
+        super(GADailyUsersNewUsersBounceRateBySocialNetwork, self).__init__(writer, watermark_store)
 
     @property
     def report_type(self):
@@ -218,7 +609,7 @@ class GADailyUsersNewUsersBounceRateBySocialNetwork(GoogleAnalyticsAPIExtractorB
         return [
             {
                 'viewId': self.VIEW_ID,
-                'dateRanges': [{'startDate': '2daysAgo', 'endDate': 'today'}],
+                'dateRanges': [self.get_date_range()],
                 'metrics': [{"expression": "ga:newUsers"},
                             {"expression": "ga:users"},
                             {'expression': 'ga:bounceRate'}],
@@ -228,102 +619,150 @@ class GADailyUsersNewUsersBounceRateBySocialNetwork(GoogleAnalyticsAPIExtractorB
 
 
 class DatetimeFileHandler(object):
+    """
+    One file per partition (date and hour), in the given output format. At most max_open_files files are kept
+    open: the least recently written one is closed when another is needed. If more of its rows arrive, it is
+    reopened in append mode (a new gzip member for CSV), or a new part file is started for formats that can not
+    be appended to.
+    """
     # TODO move to s3 config
     DATA_FILE_OUTPUT_DIR = '/tmp/'
     DATA_FILE_DEFAULT_PREFIX = 'GA_'
-    DATA_FILE_EXT = '.csv.gz'
 
-    def __init__(self):
+    def __init__(self, max_open_files=GA_MAX_OPEN_FILES, output_format=None):
+        """
+        :param max_open_files: Largest number of files open at once
+        :param output_format: see output_format, CSV by default
+        """
         self.default_date = strftime("%Y%m%d", gmtime())
         self.default_hour = strftime("%H", gmtime())
-        self.data_files = defaultdict(lambda: defaultdict(lambda: None))
-        self.writers = defaultdict(lambda: defaultdict(lambda: None))
+        self.max_open_files = max(1, max_open_files)
+        self.output_format = output_format or create_output_format('csv')
+        # list of (name, type) of the typed output formats
+        self.columns = None
+        # partition: partition writer, least recently used first
+        self.open_files = OrderedDict()
+        # partition: list of file paths, of every file written
+        self.file_paths = OrderedDict()
+        self.digests = defaultdict(int)
+        self.stats = {'opened': 0, 'reopened': 0, 'evicted': 0}
 
     def get_writer(self, report_type='', date=None, hour=None):
         """
         Get the data writer, given the date and hour.
-        Only CSV is supported and returning a csv.writer explicitly
 
         :param report_type: Report type name. This should be different for each analytics query type.
         :param date: String - YYMMDD
         :param hour: String - HH
-        :return: csv.writer
+        :return: partition writer, with writerow(data)
         """
 
-        # if not time-sensitive
-        if not date and not hour:
-            if not self.writers[self.default_date][self.default_hour]:
-                self.writers[self.default_date][self.default_hour] = \
-                    csv.writer(self.__get_file(
-                        report_type=report_type, date=self.default_date, hour=self.default_hour),
-                        lineterminator='\n')
-
-            writer = self.writers[self.default_date][self.default_hour]
+        partition = self._get_partition(date, hour)
+        if partition in self.open_files:
+            # most recently used last
+            writer = self.open_files.pop(partition)
         else:
-            if not self.writers[date][hour]:
-                self.writers[date][hour] = csv.writer(self.__get_file(
-                    report_type=report_type, date=date, hour=hour),
-                    lineterminator='\n')
-            writer = self.writers[date][hour]
+            writer = self.__open_file(partition, report_type=report_type, date=date, hour=hour)
 
+        self.open_files[partition] = writer
         return writer
 
-    def __get_file(self, report_type='', date=None, hour=None):
+    def __open_file(self, partition, report_type='', date=None, hour=None):
         """
-        Get or create the data writer, given the date and hour.
-        File schema is {report_type}_YYMMDDHH.EXTENSION.
+        Create the file of a partition, or reopen it. File schema is {report_type}_YYMMDDHH[-part].EXTENSION.
 
-        :param report_type: Report type name
-        :param date: String - YYMMDD
-        :param hour: String - HH
-        :return: a file object
+        :return: partition writer
         """
 
-        # Check if files are time sensitive or not
-        if not date and not hour:
-            if not self.data_files[self.default_date][self.default_hour]:
-                fp = gzip.open(self._get_file_path(report_type=report_type, date=date, hour=hour), 'wb')
-                self.data_files[self.default_date][self.default_hour] = fp
+        while len(self.open_files) >= self.max_open_files:
+            _, writer = self.open_files.popitem(last=False)
+            writer.close()
+            self.stats['evicted'] += 1
+
+        paths = self.file_paths.setdefault(partition, [])
+        append = bool(paths) and self.output_format.APPENDS
+        if append:
+            path = paths[-1]
         else:
-            if not self.data_files[date][hour]:
-                fp = gzip.open(self._get_file_path(report_type=report_type, date=date, hour=hour), 'wb')
-                self.data_files[date][hour] = fp
+            path = self._get_file_path(report_type=report_type, date=date, hour=hour, part=len(paths))
+            paths.append(path)
 
-        return fp
+        self.stats['reopened' if len(paths) > 1 or append else 'opened'] += 1
+        return self.output_format.open(path, columns=self.columns, append=append)
 
-    def _get_file_path(self, report_type='', date=None, hour=None):
-        file_prefix = report_type + '_' if report_type else self.DATA_FILE_DEFAULT_PREFIX
+    def _get_partition(self, date=None, hour=None):
+        """
+        :return: Partition of the date and hour, e.g. 2018-03-21-05
+        """
         date = self.default_date if not date else date
         hour = '' if not hour else '-' + hour
+        return date + hour
+
+    def _get_file_path(self, report_type='', date=None, hour=None, part=0):
+        file_prefix = report_type + '_' if report_type else self.DATA_FILE_DEFAULT_PREFIX
+        part = '-%d' % part if part else ''
 
         # no directory structure
-        return self.DATA_FILE_OUTPUT_DIR + file_prefix + date + hour + self.DATA_FILE_EXT
+        return (self.DATA_FILE_OUTPUT_DIR + file_prefix + self._get_partition(date, hour) + part +
+                self.output_format.EXTENSION)
 
-    def get_filer_handles(self):
-        return [f for date, h in self.data_files.iteritems() for hour, f in h.iteritems()]
+    def get_file_paths(self):
+        """
+        :return: dict of partition to the list of its file paths, of every file written
+        """
+        return self.file_paths
+
+    def get_partition_digests(self):
+        """
+        Digests do not depend on the order rows were written in, which varies with the order pages arrive.
+
+        :return: dict of partition to the hex digest of its rows
+        """
+        return dict((partition, '%032x' % digest) for partition, digest in self.digests.items())
+
+    def get_stats(self):
+        """
+        :return: dict of the number of files opened, reopened for append and evicted from the open files
+        """
+        return dict(self.stats, files=len(self.file_paths))
 
     def write_row(self, report_type, date, hour, data):
         self.get_writer(report_type, date, hour).writerow(data)
 
+        partition = self._get_partition(date, hour)
+        row_digest = int(hashlib.md5(u'\x1f'.join(u'%s' % (v,) for v in data).encode('utf-8')).hexdigest(), 16)
+        self.digests[partition] = (self.digests[partition] + row_digest) % (1 << 128)
+
+    def close(self):
+        """
+        Flush and close every open file
+        """
+
+        while self.open_files:
+            _, writer = self.open_files.popitem(last=False)
+            writer.close()
+
     def clean_up(self):
         """
         Remove all files this file handler has kept track of
         """
 
-        for date, hour, f in [(date, hour, f) for date, h in self.data_files.iteritems() for hour, f in h.iteritems()]:
-            os.remove(f.name)
+        self.close()
+        for path in [path for paths in self.file_paths.values() for path in paths]:
+            if os.path.exists(path):
+                os.remove(path)
 
-        # less del operations
-        map(lambda key: self.data_files.pop(key), self.data_files.keys())
-        map(lambda key: self.writers.pop(key), self.writers.keys())
+        self.file_paths.clear()
+        self.digests.clear()
+        self.stats = {'opened': 0, 'reopened': 0, 'evicted': 0}
 
     def has_files_to_process(self):
 
-        if not self.data_files:
+        if not self.file_paths:
             print("Nothing uploaded to S3")
             return False
 
-        return len(self.get_filer_handles()) > 0
+        return True
 
 
 class SimpleDatetimeOutputWriter(object):
@@ -332,20 +771,39 @@ class SimpleDatetimeOutputWriter(object):
     """
     S3_GOOGLE_ANALYTICS_BASE_PATH = 'google_analytics'
     S3_LOG_BUCKET = 'loop-logs'
-    s3 = boto3.resource('s3')
     s3_client = boto3.client('s3')
+    transfer_config = TransferConfig(multipart_threshold=GA_MULTIPART_CHUNKSIZE,
+                                     multipart_chunksize=GA_MULTIPART_CHUNKSIZE,
+                                     max_concurrency=4)
 
-    def __init__(self, dev_mode=False):
+    def __init__(self, dev_mode=False, output_format=None):
+        """
+        :param dev_mode: Print rows and do not upload
+        :param output_format: see output_format, GA_OUTPUT_FORMAT by default
+        """
 
-        self.file_handler = DatetimeFileHandler()
+        self.output_format = output_format or create_output_format(GA_OUTPUT_FORMAT)
+        self.file_handler = DatetimeFileHandler(output_format=self.output_format)
         self.dev_mode = dev_mode
 
+    @property
+    def typed(self):
+        """
+        :return: True if rows are written with typed values, see set_columns
+        """
+        return self.output_format.TYPED
+
+    def set_columns(self, columns):
+        """
+        :param columns: list of (name, type) of the rows written next, type being date, int, float or string
+        """
+        self.file_handler.columns = columns
+
     def write_data(self, data, report_type='', date=None, hour=None):
         """
-        The only choice is CVS and no buffering for now.
-        Lazily create the file and csv writer object.
+        Lazily create the file and partition writer object.
 
-        :param data: String list of data to be written to CSV
+        :param data: List of values, strings, or typed values for the typed output formats
         :param report_type:
         :param date: YYYYMMDD of the data getting pulled out from Google Analtyics (not the data generation date)
         :param hour: HH 24-hour based String
@@ -359,40 +817,131 @@ class SimpleDatetimeOutputWriter(object):
             raise Exception('Cannot pass in hour only')
 
         if self.dev_mode:
-            out = ", ".join(data) if isinstance(data, list) else data
+            out = ", ".join(u'%s' % (v,) for v in data) if isinstance(data, list) else data
             sys.stdout.write(out + "\n")
 
         return self.file_handler.write_row(report_type, date, hour, data)
 
-    def push_data(self, report_type=''):
+    def get_partition_digests(self):
+        return self.file_handler.get_partition_digests()
+
+    def push_data(self, report_type='', skip_partitions=()):
         """
-        Purging data to its final destination(s).
+        Purging data to its final destination(s): files are uploaded concurrently to
+        google_analytics/{report_type}/date=YYYY-MM-DD/hour=HH/, then a manifest of the run is written under
+        google_analytics/{report_type}/_manifests/{YYYYMMDDTHHMMSSZ}-{run id}.json in place of listing the bucket.
+        Parts of the uploaded Parquet partitions left by earlier runs are deleted, see delete_stale_parts.
 
-        TODO Create directory structure on S3.
+        :param report_type:
+        :param skip_partitions: Partitions not to upload, e.g. because they did not change since the last run
+        :return: The manifest, None if there was nothing to upload
         """
         if not self.file_handler.has_files_to_process():
             logger.warning("Nothing uploaded to S3")
             return None
 
-        report_type = '/test/' if not report_type else "/" + report_type
+        prefix = self.S3_GOOGLE_ANALYTICS_BASE_PATH + '/' + (report_type or 'test')
+
+        self.file_handler.close()
+        logger.info("%(files)s files written, %(opened)s opened, %(reopened)s reopened, %(evicted)s evicted" %
+                    self.file_handler.get_stats())
+
+        uploads, skipped = [], []
+        for partition, paths in self.file_handler.get_file_paths().items():
+            if partition in skip_partitions:
+                logger.info("Skipping unchanged partition " + partition)
+                skipped.append(partition)
+                continue
+
+            for path in paths:
+                key = prefix + '/' + self.get_partition_path(partition) + os.path.basename(path)
+                uploads.append({'partition': partition, 'key': key, 'path': path, 'size': os.path.getsize(path)})
+
+        # the runs of concurrent workers, e.g. of ga_backfill, start in the same second
+        run_id = uuid.uuid4().hex
+        manifest = {
+            'report_type': report_type,
+            'run_id': run_id,
+            'run_at': strftime("%Y-%m-%dT%H:%M:%SZ", gmtime()),
+            'bucket': self.S3_LOG_BUCKET,
+            'files': [dict((k, u[k]) for k in ('partition', 'key', 'size')) for u in uploads],
+            'skipped_partitions': skipped
+        }
 
-        for f in self.file_handler.get_filer_handles():
-            f.flush()
-            f.close()
+        if self.dev_mode:
+            for upload in uploads:
+                print("MODE: " + str(self.dev_mode) + " " + upload['path'] + " -> " + upload['key'])
+            return manifest
 
-            # TODO Add directory structure and partition later
-            if not self.dev_mode:
-                print("MODE: " + str(self.dev_mode) + " " + f.name)
+        pool = ThreadPoolExecutor(max_workers=GA_MAX_CONCURRENT_UPLOADS)
+        try:
+            for future in [pool.submit(self.upload_file, u['path'], u['key']) for u in uploads]:
+                future.result()
+        finally:
+            pool.shutdown(wait=True)
+
+        # a rerun may write fewer parts of a partition than the last run: its other parts would be read twice
+        if not self.output_format.APPENDS:
+            manifest['deleted_files'] = self.delete_stale_parts(prefix, uploads)
+
+        manifest_key = prefix + '/_manifests/' + strftime("%Y%m%dT%H%M%SZ", gmtime()) + '-' + run_id + '.json'
+        self.s3_client.put_object(Bucket=self.S3_LOG_BUCKET,
+                                  Key=manifest_key,
+                                  Body=json.dumps(manifest, indent=2).encode('utf-8'),
+                                  ContentType='application/json')
+        logger.info("Uploaded %s files to s3://%s/%s" % (len(uploads), self.S3_LOG_BUCKET, prefix))
+
+        return manifest
 
-                self.s3_client.upload_file(f.name,
-                                           self.S3_LOG_BUCKET,
-                                           self.S3_GOOGLE_ANALYTICS_BASE_PATH +
-                                           report_type + '/' + os.path.basename(f.name))
+    def delete_stale_parts(self, prefix, uploads):
+        """
+        Remove the files of the uploaded partitions that were not uploaded by this run. Formats that can not be
+        appended to start a new part file when a partition is reopened, so the number of parts of a partition
+        varies from run to run with the order pages arrive in.
 
-        if not self.dev_mode:
-            bucket = self.s3.Bucket(self.S3_LOG_BUCKET)
-            for key in bucket.objects.filter(Prefix=self.S3_GOOGLE_ANALYTICS_BASE_PATH):
-                logger.debug(key)
+        :param prefix: google_analytics/{report_type}
+        :param uploads: list of {'partition', 'key'} uploaded
+        :return: list of the deleted keys
+        """
+        keys = defaultdict(set)
+        for upload in uploads:
+            keys[prefix + '/' + self.get_partition_path(upload['partition'])].add(upload['key'])
+
+        stale = []
+        paginator = self.s3_client.get_paginator('list_objects_v2')
+        for partition_prefix, uploaded in keys.items():
+            for page in paginator.paginate(Bucket=self.S3_LOG_BUCKET, Prefix=partition_prefix):
+                for item in page.get('Contents', []):
+                    name = item['Key'][len(partition_prefix):]
+                    # only the files of the partition itself, not of nested hour= partitions
+                    if item['Key'] not in uploaded and '/' not in name and \
+                            name.endswith(self.output_format.EXTENSION):
+                        stale.append(item['Key'])
+
+        for start in range(0, len(stale), 1000):
+            self.s3_client.delete_objects(Bucket=self.S3_LOG_BUCKET,
+                                          Delete={'Objects': [{'Key': key} for key in stale[start:start + 1000]]})
+        if stale:
+            logger.info("Deleted %s stale files of s3://%s/%s" % (len(stale), self.S3_LOG_BUCKET, prefix))
+        return stale
+
+    def upload_file(self, path, key):
+        self.s3_client.upload_file(path, self.S3_LOG_BUCKET, key, Config=self.transfer_config)
+
+    @staticmethod
+    def get_partition_path(partition):
+        """
+        :param partition: e.g. 2018-03-21-05, 2018-03-21, or 20180321 for reports without dates
+        :return: Hive partition path, e.g. date=2018-03-21/hour=05/
+        """
+        match = re.match(r'^(\d{4})-?(\d{2})-?(\d{2})(?:-(\d{2}))?$', partition)
+        if not match:
+            return 'partition=' + partition + '/'
+
+        path = 'date=%s-%s-%s/' % match.group(1, 2, 3)
+        if match.group(4):
+            path += 'hour=' + match.group(4) + '/'
+        return path
 
     def clean_up(self):
         self.file_handler.clean_up()
@@ -0,0 +1 @@
+../../../../../datapipes/aws_lambda/cloudwatch_to_firehose/lambda_profiler.py
\ No newline at end of file
@@ -0,0 +1,136 @@
+"""Output formats of the Google Analytics extracts.
+
+    - csv: gzipped CSV of string values, the default
+    - parquet: typed columns, date/int/float/string, compressed with snappy. Needs pyarrow, which is not in
+      requirements.txt: it has to be installed in the Lambda bundle, or a layer, before setting
+      GA_OUTPUT_FORMAT=parquet.
+
+    The format is picked with the GA_OUTPUT_FORMAT environment variable.
+"""
+import csv
+import gzip
+import io
+import sys
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+
+class CsvPartitionWriter(object):
+
+    def __init__(self, path, append=False):
+        self.fp = gzip.open(path, 'ab' if append else 'wb')
+        if sys.version_info[0] >= 3:
+            self.fp = io.TextIOWrapper(self.fp, encoding='utf-8', newline='')
+        self.writer = csv.writer(self.fp, lineterminator='\n')
+
+    def writerow(self, data):
+        self.writer.writerow(data)
+
+    def close(self):
+        self.fp.close()
+
+
+class CsvOutputFormat(object):
+    """
+    Gzipped CSV, appending to a closed file starts a new gzip member.
+    """
+    EXTENSION = '.csv.gz'
+    TYPED = False
+    APPENDS = True
+
+    def open(self, path, columns=None, append=False):
+        """
+        :param path: File path
+        :param columns: list of (name, type), unused, values are written as they are
+        :param append: Append to an existing file
+        :return: A partition writer, with writerow(data) and close()
+        """
+        return CsvPartitionWriter(path, append)
+
+
+class ParquetPartitionWriter(object):
+    """
+    Rows are buffered and written a row group at a time.
+    """
+
+    def __init__(self, path, schema, row_group_size):
+        self.schema = schema
+        self.row_group_size = row_group_size
+        self.writer = pyarrow.parquet.ParquetWriter(path, schema, compression='snappy')
+        self.rows = []
+
+    def writerow(self, data):
+        if len(data) != len(self.schema):
+            raise Exception('Row of %s values does not match the %s columns of %s.' %
+                            (len(data), len(self.schema), self.schema.names))
+        self.rows.append(data)
+        if len(self.rows) >= self.row_group_size:
+            self.flush()
+
+    def flush(self):
+        if not self.rows:
+            return
+
+        columns = list(zip(*self.rows))
+        arrays = [pyarrow.array(values, type=field.type) for field, values in zip(self.schema, columns)]
+        self.writer.write_table(pyarrow.Table.from_arrays(arrays, schema=self.schema))
+        self.rows = []
+
+    def close(self):
+        self.flush()
+        self.writer.close()
+
+
+class ParquetOutputFormat(object):
+    """
+    Typed Parquet. A Parquet file can not be appended to, a closed partition gets a new part file.
+    """
+    EXTENSION = '.parquet'
+    TYPED = True
+    APPENDS = False
+    ROW_GROUP_SIZE = 50000
+
+    def __init__(self, row_group_size=ROW_GROUP_SIZE):
+        if pyarrow is None:
+            raise Exception('pyarrow is required for the parquet output format.')
+
+        self.row_group_size = row_group_size
+        self.types = {
+            'date': pyarrow.date32(),
+            'int': pyarrow.int64(),
+            'float': pyarrow.float64(),
+            'string': pyarrow.string()
+        }
+
+    def open(self, path, columns=None, append=False):
+        """
+        :param path: File path
+        :param columns: list of (name, type), type being one of date, int, float or string
+        :param append: Not supported
+        :return: A partition writer, with writerow(data) and close()
+        """
+        if not columns:
+            raise Exception('Columns are required to write parquet.')
+
+        schema = pyarrow.schema([(name, self.types[column_type]) for name, column_type in columns])
+        return ParquetPartitionWriter(path, schema, self.row_group_size)
+
+
+OUTPUT_FORMATS = {
+    'csv': CsvOutputFormat,
+    'parquet': ParquetOutputFormat
+}
+
+
+def create_output_format(name):
+    """
+    :param name: csv or parquet
+    :return: An output format
+    """
+    if name not in OUTPUT_FORMATS:
+        raise Exception('Unknown output format %s, expected one of %s.' % (name, ', '.join(sorted(OUTPUT_FORMATS))))
+    return OUTPUT_FORMATS[name]()
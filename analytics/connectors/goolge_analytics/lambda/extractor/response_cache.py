@@ -0,0 +1,154 @@
+"""On-disk cache of Google Analytics report pages.
+
+    Re-running an extractor, e.g. after an S3 failure or while developing a report, reads the pages it already
+    fetched instead of calling the Reporting API again. Pages are keyed by the sha256 of the canonical report
+    request (dates resolved, page token included), expire after a TTL, and the least recently written are
+    evicted past a size limit. Only golden pages are cached: pages of requests whose date range reaches today,
+    and pages GA does not mark isDataGolden yet (e.g. yesterday), are still changing.
+"""
+import copy
+import gzip
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+
+from extractor_util import ExtractorUtil
+
+logger = logging.getLogger()
+
+
+class ResponseCache(object):
+    CACHE_FILE_EXT = '.json.gz'
+
+    def __init__(self, cache_dir, ttl, max_bytes):
+        """
+        :param cache_dir: Local directory, e.g. in /tmp on Lambda
+        :param ttl: Seconds a page is kept
+        :param max_bytes: Largest size of the cache on disk
+        """
+        self.cache_dir = cache_dir
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.size = None
+        self.lock = threading.Lock()
+        self.stats = {'hits': 0, 'misses': 0, 'puts': 0, 'evicted': 0}
+
+    @staticmethod
+    def canonical_request(report_request, today=None):
+        """
+        :return: The report request with absolute dates, see ExtractorUtil.resolve_ga_date
+        """
+        request = copy.deepcopy(report_request)
+        request['dateRanges'] = [
+            dict(date_range,
+                 startDate=ExtractorUtil.resolve_ga_date(date_range['startDate'], today).strftime('%Y-%m-%d'),
+                 endDate=ExtractorUtil.resolve_ga_date(date_range['endDate'], today).strftime('%Y-%m-%d'))
+            for date_range in request.get('dateRanges', [])]
+        return request
+
+    def key(self, report_request, today=None):
+        body = json.dumps(self.canonical_request(report_request, today), sort_keys=True, separators=(',', ':'))
+        return hashlib.sha256(body.encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def cacheable(report_request, today=None):
+        """
+        :return: True if no date range of the request reaches today
+        """
+        today = today or ExtractorUtil.resolve_ga_date('today')
+        date_ranges = report_request.get('dateRanges', [])
+        return bool(date_ranges) and all(
+            ExtractorUtil.resolve_ga_date(date_range['endDate'], today) < today for date_range in date_ranges)
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key + self.CACHE_FILE_EXT)
+
+    def get(self, report_request):
+        """
+        :param report_request: A Reporting API V4 ReportRequest
+        :return: The cached report page, None if missing or expired
+        """
+        if not self.cacheable(report_request):
+            return None
+
+        path = self._path(self.key(report_request))
+        try:
+            # expired pages are left to the eviction
+            if time.time() - os.path.getmtime(path) > self.ttl:
+                self.stats['misses'] += 1
+                return None
+
+            with gzip.open(path, 'rb') as f:
+                report = json.loads(f.read().decode('utf-8'))
+        except (IOError, OSError, ValueError):
+            self.stats['misses'] += 1
+            return None
+
+        self.stats['hits'] += 1
+        return report
+
+    def put(self, report_request, report):
+        """
+        :param report_request: A Reporting API V4 ReportRequest
+        :param report: Its report page, cached only if its data is golden
+        """
+        if not self.cacheable(report_request) or not report.get('data', {}).get('isDataGolden'):
+            return
+
+        if not os.path.isdir(self.cache_dir):
+            try:
+                os.makedirs(self.cache_dir)
+            except OSError:
+                if not os.path.isdir(self.cache_dir):
+                    raise
+
+        # written aside then renamed, so a concurrent reader never sees a partial page
+        fd, temp_path = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as raw, gzip.GzipFile(fileobj=raw, mode='wb', compresslevel=1) as f:
+            f.write(json.dumps(report).encode('utf-8'))
+
+        path = self._path(self.key(report_request))
+        size = os.path.getsize(temp_path)
+        with self.lock:
+            self._load_size()
+            if os.path.exists(path):
+                self.size -= os.path.getsize(path)
+            os.rename(temp_path, path)
+            self.size += size
+            self.stats['puts'] += 1
+            if self.size > self.max_bytes:
+                self._evict()
+
+    def _load_size(self):
+        if self.size is None:
+            self.size = sum(os.path.getsize(os.path.join(self.cache_dir, name))
+                            for name in os.listdir(self.cache_dir) if name.endswith(self.CACHE_FILE_EXT))
+
+    def _evict(self):
+        """
+        Remove expired pages, then the least recently written ones until the cache fits in max_bytes.
+        """
+        now = time.time()
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if name.endswith(self.CACHE_FILE_EXT):
+                path = os.path.join(self.cache_dir, name)
+                entries.append((os.path.getmtime(path), os.path.getsize(path), path))
+
+        for mtime, size, path in sorted(entries):
+            if self.size <= self.max_bytes and now - mtime <= self.ttl:
+                break
+            self._remove(path)
+            self.size -= size
+            self.stats['evicted'] += 1
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
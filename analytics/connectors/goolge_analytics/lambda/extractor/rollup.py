@@ -0,0 +1,139 @@
+"""Rollups derived locally from the rows of a report, instead of asking the Reporting API for another report.
+
+    A rollup sums metrics of a report over the rows sharing the same group dimensions, e.g. the daily totals of
+    an hourly report, and optionally keeps the top rows of each date by a metric, e.g. the most viewed page paths.
+    Pages are aggregated as they arrive, with NumPy when it is installed. The rows are written as a report of
+    their own, google_analytics/{report_type}/date=YYYY-MM-DD/.
+
+    Only additive metrics can be summed: users of different hours are not the users of the day.
+"""
+from collections import defaultdict
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    from extractor_util import ExtractorUtil
+except ImportError:
+    from .extractor_util import ExtractorUtil
+
+KEY_SEPARATOR = u'\x1f'
+
+
+class Rollup(object):
+
+    def __init__(self, report_type, group_by, metrics, top=None, order_by=None):
+        """
+        :param report_type: Name of the derived report
+        :param group_by: Dimensions kept, e.g. ['ga:date', 'ga:pagePath']. ga:date is required, it partitions the
+                         output
+        :param metrics: Additive metrics summed, e.g. ['ga:pageviews']
+        :param top: Number of rows kept per date, every row by default
+        :param order_by: Metric the top rows are picked by, the first metric by default
+        """
+        if 'ga:date' not in group_by:
+            raise Exception('Rollup %s must be grouped by ga:date.' % report_type)
+
+        self.report_type = report_type
+        self.group_by = list(group_by)
+        self.metrics = list(metrics)
+        self.top = top
+        self.order_by = self.metrics.index(order_by) if order_by else 0
+        self.metric_types = dict((m, None) for m in self.metrics)
+        self.sums = defaultdict(lambda: [0] * len(self.metrics))
+
+    def add(self, dimension_headers, metric_entries, dimension_rows, metric_rows):
+        """
+        Aggregate a page of a report.
+
+        :param dimension_headers: Names of the dimensions of the report
+        :param metric_entries: Metric header entries of the report, {'name', 'type'}
+        :param dimension_rows: Dimension values of each row
+        :param metric_rows: Metric values of each row, strings, only the first date range is used
+        """
+        if not dimension_rows:
+            return
+
+        metric_headers = [m['name'] for m in metric_entries]
+        for entry in metric_entries:
+            if entry['name'] in self.metric_types:
+                self.metric_types[entry['name']] = entry.get('type')
+
+        group_indexes = [dimension_headers.index(d) for d in self.group_by]
+        metric_indexes = [metric_headers.index(m) for m in self.metrics]
+
+        if numpy is None:
+            for dimensions, values in zip(dimension_rows, metric_rows):
+                sums = self.sums[tuple(dimensions[i] for i in group_indexes)]
+                for j, i in enumerate(metric_indexes):
+                    sums[j] += float(values[i])
+            return
+
+        dimensions = numpy.array(dimension_rows, dtype=numpy.str_)
+        keys = dimensions[:, group_indexes[0]]
+        for i in group_indexes[1:]:
+            keys = numpy.char.add(numpy.char.add(keys, KEY_SEPARATOR), dimensions[:, i])
+        unique_keys, inverse = numpy.unique(keys, return_inverse=True)
+
+        values = numpy.array([[row[i] for i in metric_indexes] for row in metric_rows], dtype=numpy.float64)
+        page_sums = [numpy.bincount(inverse.ravel(), weights=values[:, j], minlength=len(unique_keys))
+                     for j in range(len(metric_indexes))]
+
+        for k, key in enumerate(unique_keys.tolist()):
+            sums = self.sums[tuple(key.split(KEY_SEPARATOR))]
+            for j in range(len(metric_indexes)):
+                sums[j] += page_sums[j][k]
+
+    def columns(self):
+        """
+        :return: list of (name, type) of the rows, see ExtractorUtil.get_ga_field_type
+        """
+        columns = [(ExtractorUtil.get_ga_column_name(d), ExtractorUtil.get_ga_field_type(d)) for d in self.group_by]
+        columns.extend((ExtractorUtil.get_ga_column_name(m), ExtractorUtil.get_ga_field_type(m, self.metric_types[m]))
+                       for m in self.metrics)
+        if self.top:
+            columns.append(('rank', 'int'))
+        return columns
+
+    def rows(self, typed=False):
+        """
+        :param typed: Typed values, or the strings of the CSV output
+        :return: list of (GA date YYYYMMDD, row values), sorted by date then group, or rank for top rollups
+        """
+        date_index = self.group_by.index('ga:date')
+        by_date = defaultdict(list)
+        for key, sums in self.sums.items():
+            by_date[key[date_index]].append((key, sums))
+
+        columns = self.columns()
+        if typed:
+            parsers = [ExtractorUtil.get_ga_typed_field_parser(t) for _, t in columns[:len(self.group_by)]]
+        else:
+            parsers = ExtractorUtil.get_ga_field_parsers(self.group_by)
+        metric_types = [t for _, t in columns[len(self.group_by):len(self.group_by) + len(self.metrics)]]
+
+        rows = []
+        for date in sorted(by_date):
+            groups = by_date[date]
+            if self.top:
+                groups = sorted(groups, key=lambda g: (-g[1][self.order_by], g[0]))[:self.top]
+            else:
+                groups = sorted(groups)
+
+            for rank, (key, sums) in enumerate(groups, 1):
+                data = [parse(value) for parse, value in zip(parsers, key)]
+                data.extend(self._format_metric(value, metric_type, typed)
+                            for value, metric_type in zip(sums, metric_types))
+                if self.top:
+                    data.append(rank)
+                rows.append((date, data))
+        return rows
+
+    @staticmethod
+    def _format_metric(value, metric_type, typed):
+        if metric_type == 'int':
+            value = int(round(value))
+            return value if typed else str(value)
+        return float(value) if typed else '%.1f' % value
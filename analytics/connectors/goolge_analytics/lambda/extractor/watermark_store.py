@@ -0,0 +1,117 @@
+"""Watermarks of incremental Google Analytics extraction.
+"""
+import datetime
+import json
+import os
+
+
+class WatermarkStore(object):
+    """
+    A small JSON document, in S3 or a local file standing in for it, recording for every report type:
+    - the last finalized date: every day up to it was reported golden by Google Analytics, so it will not change
+      anymore and is not fetched again,
+    - a digest of every partition written, so partitions whose rows did not change are not written again.
+
+    {
+        "GAHourlyUsersPageviewsByPagepath": {
+            "finalized_date": "2018-03-20",
+            "partitions": {"2018-03-21-00": "9b2d...", "2018-03-21-01": "41c0..."}
+        }
+    }
+    """
+
+    def __init__(self, path=None, s3_bucket=None, s3_key=None, s3_client=None):
+        """
+        :param path: Local file, used when no S3 bucket is given
+        :param s3_bucket: S3 bucket of the watermarks document
+        :param s3_key: S3 key of the watermarks document
+        :param s3_client: boto3 s3 client
+        """
+        self.path = path
+        self.s3_bucket = s3_bucket
+        self.s3_key = s3_key
+        self.s3_client = s3_client
+        self.watermarks = None
+
+    def load(self):
+        if self.watermarks is not None:
+            return self.watermarks
+
+        self.watermarks = {}
+        if self.s3_bucket:
+            try:
+                body = self.s3_client.get_object(Bucket=self.s3_bucket, Key=self.s3_key)['Body'].read()
+                self.watermarks = json.loads(body.decode('utf-8'))
+            except self.s3_client.exceptions.NoSuchKey:
+                pass
+        elif self.path and os.path.exists(self.path):
+            with open(self.path) as f:
+                self.watermarks = json.load(f)
+
+        return self.watermarks
+
+    def save(self):
+        if self.watermarks is None:
+            return
+
+        body = json.dumps(self.watermarks, indent=2, sort_keys=True)
+        if self.s3_bucket:
+            self.s3_client.put_object(Bucket=self.s3_bucket, Key=self.s3_key, Body=body.encode('utf-8'),
+                                      ContentType='application/json')
+        elif self.path:
+            with open(self.path, 'w') as f:
+                f.write(body)
+
+    def _report(self, report_type):
+        return self.load().setdefault(report_type, {'finalized_date': None, 'partitions': {}})
+
+    def get_finalized_date(self, report_type):
+        """
+        :return: YYYY-MM-DD, None if nothing was finalized yet
+        """
+        return self._report(report_type)['finalized_date']
+
+    def set_finalized_date(self, report_type, date):
+        """
+        Move the finalized date forward, and forget the digests of the partitions up to it.
+
+        :param date: YYYY-MM-DD
+        """
+        report = self._report(report_type)
+        if report['finalized_date'] and report['finalized_date'] >= date:
+            return
+
+        report['finalized_date'] = date
+        report['partitions'] = dict((p, d) for p, d in report['partitions'].items() if p[:10] > date)
+
+    def get_partition_digest(self, report_type, partition):
+        return self._report(report_type)['partitions'].get(partition)
+
+    def set_partition_digest(self, report_type, partition, digest):
+        self._report(report_type)['partitions'][partition] = digest
+
+    def get_start_date(self, report_type, default_start_date):
+        """
+        :param default_start_date: Google Analytics start date used when nothing was finalized yet
+        :return: The first date that is not finalized, YYYY-MM-DD, or the default start date
+        """
+        finalized_date = self.get_finalized_date(report_type)
+        if not finalized_date:
+            return default_start_date
+
+        finalized = datetime.datetime.strptime(finalized_date, '%Y-%m-%d').date()
+        return (finalized + datetime.timedelta(days=1)).strftime('%Y-%m-%d')
+
+
+def finalized_through(start_date, golden_dates):
+    """
+    :param start_date: First date of the fetched window, YYYY-MM-DD
+    :param golden_dates: Set of YYYY-MM-DD of the window reported golden
+    :return: The last date of the run of golden dates starting at start_date, None if start_date is not golden
+    """
+    date = datetime.datetime.strptime(start_date, '%Y-%m-%d').date()
+    last = None
+    while date.strftime('%Y-%m-%d') in golden_dates:
+        last = date.strftime('%Y-%m-%d')
+        date += datetime.timedelta(days=1)
+    return last
@@ -1,3 +1,4 @@
+import datetime
 from unittest import TestCase
 from extractor.extractor_util import ExtractorUtil
 
@@ -9,4 +10,36 @@ class TestExtractorUtil(TestCase):
     def test_parse_ga_field_value(self):
         self.assertEquals(ExtractorUtil.parse_ga_field_value("ga:socialNetwork", "(not set)"), "Unknown")
         self.assertEquals(ExtractorUtil.parse_ga_field_value("ga:someRate", u"99.222"), "99.2")
-        self.assertEquals(ExtractorUtil.parse_ga_field_value("ga:someRate", "99.222"), "99.2")
\ No newline at end of file
+        self.assertEquals(ExtractorUtil.parse_ga_field_value("ga:someRate", "99.222"), "99.2")
+
+    def test_get_ga_field_parsers(self):
+        parsers = ExtractorUtil.get_ga_field_parsers(["ga:date", "ga:socialNetwork", "ga:bounceRate"])
+        self.assertEquals([parse(v) for parse, v in zip(parsers, ["20180808", "(not set)", "99.222"])],
+                          ["2018-08-08", "Unknown", "99.2"])
+
+    def test_get_ga_typed_field_parser(self):
+        types = [ExtractorUtil.get_ga_field_type("ga:date"), ExtractorUtil.get_ga_field_type("ga:hour"),
+                 ExtractorUtil.get_ga_field_type("ga:users", "INTEGER"),
+                 ExtractorUtil.get_ga_field_type("ga:bounceRate", "PERCENT"),
+                 ExtractorUtil.get_ga_field_type("ga:socialNetwork")]
+        self.assertEquals(types, ["date", "int", "int", "float", "string"])
+        self.assertEquals([ExtractorUtil.get_ga_typed_field_parser(t)(v)
+                           for t, v in zip(types, ["20180808", "05", "12", "99.222", "(not set)"])],
+                          [datetime.date(2018, 8, 8), 5, 12, 99.222, "Unknown"])
+
+    def test_get_ga_column_name(self):
+        self.assertEquals([ExtractorUtil.get_ga_column_name(h) for h in ["ga:date", "ga:hour", "ga:pagePath"]],
+                          ["ga_date", "ga_hour", "pagePath"])
+
+    def test_convert_metric_values(self):
+        rows = [["12", "99.222", "(not set)"], ["3", "0.25", "7"]]
+        self.assertEquals(ExtractorUtil.convert_metric_values(rows),
+                          [[ExtractorUtil.parse_ga_field_value("ga:metric", v) for v in row] for row in rows])
+        self.assertEquals(ExtractorUtil.convert_metric_values([["12", "99.222"], ["3.0", "1"]], ["int", "float"]),
+                          [[12, 99.222], [3, 1.0]])
+
+    def test_convert_metric_values_rounds_ties_like_round_decimal(self):
+        # ties of the first decimal, where formatting and round() differ on Python 2
+        rows = [[v] for v in ["0.25", "0.35", "1.45", "2.675", "-0.25", "10.05"]]
+        self.assertEquals(ExtractorUtil.convert_metric_values(rows),
+                          [[ExtractorUtil.round_decimal(row[0])] for row in rows])
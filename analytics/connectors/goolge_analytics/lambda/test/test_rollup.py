@@ -0,0 +1,74 @@
+import ast
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+from extractor import output_format, rollup
+from extractor.rollup import Rollup
+
+
+class TestRollup(TestCase):
+    def setUp(self):
+        with open('test/GAHourlyUsersPageviewsByPagepath_2_days.json') as f:
+            report = ast.literal_eval(f.read())['reports'][0]
+
+        self.dimension_headers = report['columnHeader']['dimensions']
+        self.metric_entries = report['columnHeader']['metricHeader']['metricHeaderEntries']
+        rows = report['data']['rows']
+        self.dimension_rows = [row['dimensions'] for row in rows]
+        self.metric_rows = [[v for values in row['metrics'] for v in values['values']] for row in rows]
+
+    def rollups(self):
+        rollups = [Rollup('GADailyPageviewsSessionsTotals', ['ga:date'], ['ga:pageviews', 'ga:sessions']),
+                   Rollup('GADailyTopPagepathsByPageviews', ['ga:date', 'ga:pagePath'], ['ga:pageviews'], top=5,
+                          order_by='ga:pageviews')]
+        # added in two pages
+        half = len(self.dimension_rows) // 2
+        for r in rollups:
+            r.add(self.dimension_headers, self.metric_entries, self.dimension_rows[:half], self.metric_rows[:half])
+            r.add(self.dimension_headers, self.metric_entries, self.dimension_rows[half:], self.metric_rows[half:])
+        return [(r.rows(), r.rows(typed=True)) for r in rollups]
+
+    def test_daily_totals(self):
+        pageviews = [m['name'] for m in self.metric_entries].index('ga:pageviews')
+        expected = {}
+        for dimensions, metrics in zip(self.dimension_rows, self.metric_rows):
+            expected[dimensions[0]] = expected.get(dimensions[0], 0) + int(metrics[pageviews])
+
+        totals, top = self.rollups()
+        self.assertEqual(dict((date, row[1]) for date, row in totals[1]), expected)
+        self.assertTrue(all(len([d for d, _ in top[0] if d == date]) <= 5 for date in expected))
+        self.assertEqual([row[-1] for date, row in top[0] if date == '20170801'], [1, 2, 3, 4, 5])
+
+    def test_numpy_and_fallback_agree(self):
+        if rollup.numpy is None:
+            self.skipTest('numpy is not installed')
+
+        with_numpy = self.rollups()
+        numpy, rollup.numpy = rollup.numpy, None
+        try:
+            without_numpy = self.rollups()
+        finally:
+            rollup.numpy = numpy
+
+        self.assertEqual(with_numpy, without_numpy)
+
+    def test_parquet_columns_are_not_partition_keys(self):
+        if output_format.pyarrow is None:
+            self.skipTest('pyarrow is not installed')
+        import pyarrow.parquet
+
+        totals = Rollup('GADailyPageviewsSessionsTotals', ['ga:date'], ['ga:pageviews', 'ga:sessions'])
+        totals.add(self.dimension_headers, self.metric_entries, self.dimension_rows, self.metric_rows)
+        self.assertEqual(totals.columns(), [('ga_date', 'date'), ('pageviews', 'int'), ('sessions', 'int')])
+
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'totals.parquet')
+            writer = output_format.ParquetOutputFormat().open(path, totals.columns())
+            for _, row in totals.rows(typed=True):
+                writer.writerow(row)
+            writer.close()
+            self.assertEqual(pyarrow.parquet.read_schema(path).names, ['ga_date', 'pageviews', 'sessions'])
+        finally:
+            shutil.rmtree(directory)
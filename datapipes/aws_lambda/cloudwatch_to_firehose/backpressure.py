@@ -0,0 +1,192 @@
+"""
+    Graceful degradation when Firehose throttles.
+
+    A DeliveryBudget is created per invocation from the Lambda context. Stream routers retry throttled records
+    only while the budget has time left, and hand whatever is still undelivered to the budget, which spills it to
+    S3 (or a local directory standing in for S3) once at the end of the invocation. Returning normally instead of
+    raising keeps Lambda from retrying, and duplicating, the whole CloudWatch batch.
+
+    On Lambda /tmp is lost with the container, so records are only spilled to SPILL_S3_BUCKET there: without it,
+    flushing spilled records raises, and Lambda retries the batch.
+
+    Spilled records are replayed in bulk with:
+        python backpressure.py naboo s3://loop-logs/spill/source=naboo/stream=NabooDevResponseToS3
+        python backpressure.py naboo /tmp/spill
+"""
+from __future__ import print_function
+
+import argparse
+import importlib
+import logging
+import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+
+try:
+    from dead_letter import put_gzip_lines, object_key, read_lines, firehose_batches
+except ImportError:
+    from .dead_letter import put_gzip_lines, object_key, read_lines, firehose_batches
+
+# environment variables
+spill_s3_bucket = os.environ.get('SPILL_S3_BUCKET')
+spill_s3_prefix = os.environ.get('SPILL_S3_PREFIX', 'spill')
+spill_dir = os.environ.get('SPILL_DIR', '/tmp/spill')
+reserved_time_ms = int(os.environ.get('DELIVERY_RESERVED_TIME_MS', 5000))
+running_on_lambda = 'AWS_LAMBDA_FUNCTION_NAME' in os.environ
+
+# Retries of a call when there is no invocation deadline, e.g. in the preprocessor daemon
+DEFAULT_MAX_ATTEMPTS = 8
+
+logger = logging.getLogger()
+
+
+class DeliveryBudget(object):
+    """
+    Time budget of one invocation, and the spill of the records that could not be delivered within it.
+    """
+
+    def __init__(self, source, context=None, reserved_ms=None, max_attempts=DEFAULT_MAX_ATTEMPTS,
+                 s3_bucket=None, s3_prefix=None, local_dir=None):
+        """
+        :param source: Name of the preprocessor, e.g. "naboo"
+        :param context: Lambda context. Without it only max_attempts bounds the retries
+        :param reserved_ms: Time kept back from the deadline for flushing. Defaults to DELIVERY_RESERVED_TIME_MS
+        :param max_attempts: Upper bound of delivery attempts of a single call
+        :param s3_bucket: S3 bucket to spill to. Defaults to SPILL_S3_BUCKET
+        :param s3_prefix: S3 key prefix to spill to. Defaults to SPILL_S3_PREFIX
+        :param local_dir: Local directory to spill to when no bucket is set. Defaults to SPILL_DIR
+        """
+        self.source = source
+        self.max_attempts = max_attempts
+        self.s3_bucket = s3_bucket or spill_s3_bucket
+        self.s3_prefix = s3_prefix or spill_s3_prefix
+        self.local_dir = local_dir or spill_dir
+        self.deadline = None
+        self.spilled = {}
+        self._lock = threading.Lock()
+
+        if context is not None and hasattr(context, 'get_remaining_time_in_millis'):
+            reserved_ms = reserved_time_ms if reserved_ms is None else reserved_ms
+            self.deadline = time.time() + (context.get_remaining_time_in_millis() - reserved_ms) / 1000.0
+
+    def remaining(self):
+        """
+        :return: Seconds left for delivery, None if there is no deadline
+        """
+        if self.deadline is None:
+            return None
+        return max(0.0, self.deadline - time.time())
+
+    def allows(self, attempt, pause):
+        """
+        :param attempt: Number of attempts made so far
+        :param pause: Seconds to wait before the next attempt
+        :return: True if another attempt fits in the budget
+        """
+        if attempt >= self.max_attempts:
+            return False
+        remaining = self.remaining()
+        return remaining is None or remaining > pause
+
+    def spill(self, stream_name, records):
+        """
+        Keep undelivered records until flush().
+
+        :param stream_name: The delivery stream the records were meant for
+        :param records: list of {'Data': json_str}
+        """
+        with self._lock:
+            self.spilled.setdefault(stream_name, []).extend(
+                r['Data'] if r['Data'].endswith("\n") else r['Data'] + "\n" for r in records)
+
+    def flush(self, s3_client=None):
+        """
+        Write the spilled records, one object per delivery stream.
+
+        :return: Number of records spilled
+        :raise: Exception on Lambda if records were spilled and no S3 bucket is set
+        """
+        with self._lock:
+            spilled, self.spilled = self.spilled, {}
+
+        if spilled and running_on_lambda and not self.s3_bucket:
+            raise Exception("%s undelivered records, and no SPILL_S3_BUCKET to spill them to"
+                            % sum(len(lines) for lines in spilled.values()))
+
+        count = 0
+        for stream_name, lines in spilled.items():
+            key = object_key(self.s3_prefix, "source=%s/stream=%s" % (self.source, stream_name))
+            location = put_gzip_lines(lines, key, s3_bucket=self.s3_bucket, local_dir=self.local_dir,
+                                      s3_client=s3_client)
+            logger.warning("Spilled %s undelivered records for %s to %s" % (len(lines), stream_name, location))
+            count += len(lines)
+
+        return count
+
+
+def replay(preprocessor, path, delete=False):
+    """
+    Send spilled records back to the delivery streams they were meant for. Records that still can not be
+    delivered are spilled again.
+
+    :param preprocessor: Module name of the preprocessor that spilled them, e.g. "naboo_preprocessor"
+    :param path: Spill file, directory or s3://bucket/prefix. Records are grouped by the stream= partition
+    :param delete: Remove local spill files once replayed
+    :return: Number of records replayed
+    """
+    module = importlib.import_module(preprocessor)
+    routers = {}
+    for router in module.stream_routers.values():
+        for stream_name in router.stream_names:
+            routers.setdefault(stream_name, router)
+
+    local_path, temp_dir = path, None
+    if path.startswith('s3://'):
+        import boto3
+        bucket_name, _, prefix = path[len('s3://'):].partition('/')
+        temp_dir = tempfile.mkdtemp(prefix='spill_')
+        for obj in boto3.resource('s3').Bucket(bucket_name).objects.filter(Prefix=prefix):
+            target = os.path.join(temp_dir, os.path.dirname(obj.key), os.path.basename(obj.key))
+            if not os.path.isdir(os.path.dirname(target)):
+                os.makedirs(os.path.dirname(target))
+            obj.Object().download_file(target)
+        local_path = temp_dir
+
+    count = 0
+    budget = DeliveryBudget(module.__name__.replace('_preprocessor', ''))
+    try:
+        for root, _, file_names in os.walk(local_path) if os.path.isdir(local_path) else [('', [], [local_path])]:
+            for file_name in sorted(file_names):
+                file_path = os.path.join(root, file_name)
+                match = re.search(r'stream=([^/]+)', file_path)
+                if not match or match.group(1) not in routers:
+                    logger.warning("No delivery stream found for %s" % file_path)
+                    continue
+
+                lines = list(read_lines(file_path))
+                for batch in firehose_batches([line + "\n" for line in lines]):
+                    undelivered = routers[match.group(1)].put_record_batch(module.firehose, batch, budget)
+                    budget.spill(match.group(1), undelivered)
+                count += len(lines)
+                if delete and not temp_dir:
+                    os.remove(file_path)
+    finally:
+        if temp_dir:
+            shutil.rmtree(temp_dir)
+
+    count -= budget.flush()
+    logger.info("Replayed %s spilled records" % count)
+    return count
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Replay records spilled by the preprocessors.')
+    parser.add_argument('preprocessor', choices=['naboo', 'galaxy', 'doubledouble'])
+    parser.add_argument('path', help='Spill file, directory, or s3://bucket/prefix')
+    parser.add_argument('--delete', action='store_true', help='Remove local spill files once replayed')
+    args = parser.parse_args()
+
+    replay(args.preprocessor + '_preprocessor', args.path, delete=args.delete)
@@ -0,0 +1,20 @@
+"""
+    Decoding of CloudWatch Logs subscription payloads, shared by the preprocessors.
+
+    The data is decoded in a single pass over bytes: base64, then gzip with zlib, then JSON parsed straight from
+    the bytes, without intermediate str copies.
+"""
+import base64
+import json
+import zlib
+
+# gzip, as written by CloudWatch Logs, or zlib headers, detected automatically
+AUTO_HEADER_WBITS = 32 + zlib.MAX_WBITS
+
+
+def decode_payload(data):
+    """
+    :param data: awslogs.data of a subscription event, base64 of the gzipped payload, as str or bytes
+    :return: The payload, e.g. {"logGroup": ..., "logStream": ..., "logEvents": [{"id", "timestamp", "message"}]}
+    """
+    return json.loads(zlib.decompress(base64.b64decode(data), AUTO_HEADER_WBITS))
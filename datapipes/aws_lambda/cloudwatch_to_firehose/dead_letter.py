@@ -0,0 +1,233 @@
+from __future__ import print_function
+
+import json
+import gzip
+import io
+import os
+import time
+import uuid
+import logging
+
+# environment variables
+dead_letter_stream_name = os.environ.get('DEAD_LETTER_DELIVERY_STREAM_NAME')
+dead_letter_s3_bucket = os.environ.get('DEAD_LETTER_S3_BUCKET')
+dead_letter_s3_prefix = os.environ.get('DEAD_LETTER_S3_PREFIX', 'dead_letter')
+dead_letter_dir = os.environ.get('DEAD_LETTER_DIR')
+
+# Firehose put_record_batch limits
+FIREHOSE_MAX_BATCH_RECORDS = 500
+FIREHOSE_MAX_BATCH_BYTES = 4 * 1024 * 1024
+
+# Untagged lines following an invalid line are kept as possible continuations of a truncated message
+MAX_CONTINUATION_LINES = 8
+
+logger = logging.getLogger()
+
+
+class DeadLetterBatch(object):
+    """
+    Collects log lines that carry a tag of interest but could not be parsed, together with enough context to
+    re-run them later. Nothing is sent until flush(), which is called once per invocation, so the per-line cost
+    is a single list append.
+
+    Each dead letter is a JSON object:
+    {
+        "tag": "response_log=",
+        "log_group": "logging",
+        "log_stream": "hibiki-prod",
+        "event_id": "33800085991367471500975998592917336325415151522589114370",
+        "timestamp": 1515648275000,
+        "message": "2018-01-11 05:24:35.918 request_id=h660ptntri278mlr4p8l7s4hc4uftpqb [info] response_log={\"use",
+        "continuation": ["r_agent\":\"Mozilla/5.0\", ...}"]
+    }
+    """
+
+    def __init__(self, source, stream_name=None, s3_bucket=None, s3_prefix=None, local_dir=None):
+        """
+        :param source: Name of the preprocessor producing the dead letters, e.g. "naboo"
+        :param stream_name: Firehose delivery stream for dead letters. Defaults to DEAD_LETTER_DELIVERY_STREAM_NAME
+        :param s3_bucket: S3 bucket for dead letters. Defaults to DEAD_LETTER_S3_BUCKET
+        :param s3_prefix: S3 key prefix for dead letters. Defaults to DEAD_LETTER_S3_PREFIX
+        :param local_dir: Local directory standing in for S3. Defaults to DEAD_LETTER_DIR
+        """
+        self.source = source
+        self.stream_name = stream_name or dead_letter_stream_name
+        self.s3_bucket = s3_bucket or dead_letter_s3_bucket
+        self.s3_prefix = s3_prefix or dead_letter_s3_prefix
+        self.local_dir = local_dir or dead_letter_dir
+        self.letters = []
+        self._open_letter = None
+
+    def __len__(self):
+        return len(self.letters)
+
+    def add(self, tag, message, payload, log_event):
+        """
+        Record an invalid log line.
+
+        :param tag: The tag found in the line
+        :param message: The log line
+        :param payload: The decoded CloudWatch payload the line belongs to
+        :param log_event: The CloudWatch log event of the line
+        """
+        self._open_letter = {
+            'source': self.source,
+            'tag': tag,
+            'log_group': payload.get('logGroup'),
+            'log_stream': payload.get('logStream'),
+            'event_id': log_event.get('id'),
+            'timestamp': log_event.get('timestamp'),
+            'message': message,
+            'continuation': []
+        }
+        self.letters.append(self._open_letter)
+
+    def add_continuation(self, message):
+        """
+        Attach an untagged line to the most recent dead letter, in case the original line was split into
+        multiple log events. Only the lines directly following an invalid line are considered.
+
+        :param message: The log line
+        :return: True if the line was attached, False otherwise.
+        """
+        if self._open_letter is None or len(self._open_letter['continuation']) >= MAX_CONTINUATION_LINES:
+            self._open_letter = None
+            return False
+
+        self._open_letter['continuation'].append(message)
+        return True
+
+    def close(self):
+        """
+        Stop attaching continuation lines to the most recent dead letter.
+        """
+        self._open_letter = None
+
+    def flush(self, firehose_client=None, s3_client=None):
+        """
+        Send every collected dead letter to the configured destination, in as few requests as possible.
+
+        :param firehose_client: boto3 firehose client, required when a dead letter stream is configured
+        :param s3_client: boto3 s3 client, created lazily when a dead letter bucket is configured
+        :return: Number of dead letters flushed
+        """
+        self._open_letter = None
+        if not self.letters:
+            return 0
+
+        count = len(self.letters)
+        lines = [json.dumps(letter) + "\n" for letter in self.letters]
+        self.letters = []
+
+        if self.stream_name and firehose_client is not None:
+            for batch in firehose_batches(lines):
+                firehose_client.put_record_batch(DeliveryStreamName=self.stream_name, Records=batch)
+            logger.warning("Sent %s dead letters to %s" % (count, self.stream_name))
+        elif self.s3_bucket or self.local_dir:
+            location = put_gzip_lines(lines, object_key(self.s3_prefix, 'source=' + self.source),
+                                      s3_bucket=self.s3_bucket, local_dir=self.local_dir, s3_client=s3_client)
+            logger.warning("Wrote %s dead letters to %s" % (count, location))
+        else:
+            for line in lines:
+                logger.warning("Invalid json found: " + line.rstrip("\n"))
+
+        return count
+
+
+def read_dead_letters(path):
+    """
+    Read dead letters back from a file written by DeadLetterBatch.flush, or from a directory of them.
+
+    :param path: a .json.gz file or a directory
+    :return: generator of dead letter dicts
+    """
+    for line in read_lines(path):
+        yield json.loads(line)
+
+
+def read_lines(path):
+    """
+    Read the lines of a file written by put_gzip_lines, or of a directory of them.
+
+    :param path: a .json.gz file or a directory
+    :return: generator of non-empty lines, without trailing newline
+    """
+    if os.path.isdir(path):
+        for root, _, file_names in os.walk(path):
+            for file_name in sorted(file_names):
+                if file_name.endswith('.json.gz') or file_name.endswith('.json'):
+                    for line in read_lines(os.path.join(root, file_name)):
+                        yield line
+        return
+
+    opener = gzip.open if path.endswith('.gz') else open
+    with opener(path, 'rb') as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                yield line.decode('utf-8')
+
+
+def object_key(prefix, partition):
+    """
+    :param prefix: S3 prefix, e.g. "dead_letter"
+    :param partition: Partition path under the prefix, e.g. "source=naboo"
+    :return: A unique key under the prefix, partitioned by the current day
+    """
+    date = time.gmtime()
+    return "%s/%s/year=%d/month=%d/day=%d/%s-%s.json.gz" % (
+        prefix, partition, date.tm_year, date.tm_mon, date.tm_mday, time.strftime("%H%M%S", date), uuid.uuid4().hex)
+
+
+def put_gzip_lines(lines, key, s3_bucket=None, local_dir=None, s3_client=None):
+    """
+    Write lines as a single gzipped object to S3, or to a local directory standing in for S3.
+
+    :param lines: list of strings ending with a newline
+    :param key: Object key, see object_key
+    :param s3_bucket: S3 bucket. The local directory is used if not given
+    :param local_dir: Local directory standing in for S3
+    :param s3_client: boto3 s3 client, created lazily if not given
+    :return: The location written to
+    """
+    body = _gzip_lines(lines)
+    if s3_bucket:
+        if s3_client is None:
+            import boto3
+            s3_client = boto3.client('s3')
+        s3_client.put_object(Bucket=s3_bucket, Key=key, Body=body, ContentEncoding='gzip')
+        return "S3:%s/%s" % (s3_bucket, key)
+
+    path = os.path.join(local_dir, key)
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    with open(path, 'wb') as f:
+        f.write(body)
+    return path
+
+
+def _gzip_lines(lines):
+    buf = io.BytesIO()
+    with gzip.GzipFile(fileobj=buf, mode='wb') as gz:
+        for line in lines:
+            gz.write(line.encode('utf-8'))
+    return buf.getvalue()
+
+
+def firehose_batches(lines):
+    """
+    Split record lines into put_record_batch sized batches.
+
+    :param lines: list of strings
+    :return: generator of lists of {'Data': line}
+    """
+    batch, batch_bytes = [], 0
+    for line in lines:
+        size = len(line.encode('utf-8'))
+        if batch and (len(batch) >= FIREHOSE_MAX_BATCH_RECORDS or batch_bytes + size > FIREHOSE_MAX_BATCH_BYTES):
+            yield batch
+            batch, batch_bytes = [], 0
+        batch.append({'Data': line})
+        batch_bytes += size
+    if batch:
+        yield batch
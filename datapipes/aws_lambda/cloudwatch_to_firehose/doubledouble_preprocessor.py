@@ -1,38 +1,57 @@
 from __future__ import print_function
 
 import json
-import zlib
 import boto3
 import os
 import logging
 
+try:
+    from backpressure import DeliveryBudget
+    from cloudwatch_logs import decode_payload
+    from dead_letter import DeadLetterBatch
+    from event_time import event_time_field
+    from lambda_profiler import profiled
+    from log_filter import compile_filter
+    from stream_router import StreamRouter
+except ImportError:
+    from .backpressure import DeliveryBudget
+    from .cloudwatch_logs import decode_payload
+    from .dead_letter import DeadLetterBatch
+    from .event_time import event_time_field
+    from .lambda_profiler import profiled
+    from .log_filter import compile_filter
+    from .stream_router import StreamRouter
+
 log_config = {
     'response_log=': {
         'stream_name': os.environ.get('RESPONSE_DELIVERY_STREAM_NAME', "DoubleDoubleSandboxResponseToS3"),
+        'shard_strategy': os.environ.get('RESPONSE_SHARD_STRATEGY', 'round_robin'),
+        'shard_key': os.environ.get('RESPONSE_SHARD_KEY'),
         'batch_size': os.environ.get('DELIVERY_STREAM_BATCH_SIZE', 499)
     },
     'event_tracking=': {
         'stream_name': os.environ.get('EVENT_TRACKING_DELIVERY_STREAM_NAME', "DoubleDoubleSandboxTrackingToS3"),
+        'shard_strategy': os.environ.get('EVENT_TRACKING_SHARD_STRATEGY', 'round_robin'),
+        'shard_key': os.environ.get('EVENT_TRACKING_SHARD_KEY'),
         'batch_size': os.environ.get('DELIVERY_STREAM_BATCH_SIZE', 499)
     }
 }
+# prefix the records with their event time, see event_time.py. Only for streams delivered through a partitioner
+# that strips it, like naboo_partitioner
+event_time_field_enabled = os.environ.get('EVENT_TIME_FIELD', "False") == "True"
+stream_routers = dict((t, StreamRouter.from_config(c)) for t, c in log_config.items())
+
 HEALTH_CHECK = 'health_check'
+log_filter = compile_filter({
+    'log_streams': ['hibiki-prod'],
+    'exclude_substrings': [HEALTH_CHECK]
+})
 firehose = boto3.client('firehose')
 
 logging.basicConfig()
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
-def stream_gzip_decompress(stream):
-    dec = zlib.decompressobj(32 + zlib.MAX_WBITS)
-    buf = ''
-    for chunk in stream:
-        rv = dec.decompress(chunk)
-        if rv:
-            buf += rv
-    return buf
-
-
 def extract_controller_json_str(log_line):
     """
     Log format:
@@ -85,22 +104,24 @@ def extract_controller_json_str(log_line):
 
     :param log_line: a JSON string log line sent from ASG
     :return: A tuple or None if not found. Returns tag for the json, and the json part of the line.
+             The json part is None if the tagged json is invalid, so the caller can dead-letter the line.
     """
     
     json_log = (None, None)
 
-    if HEALTH_CHECK not in log_line:
-        tag = _log_has_tags_of_interest(log_config.keys(), log_line)
+    tag = _log_has_tags_of_interest(log_config.keys(), log_line)
 
-        if tag:
-            (_, _, json_str) = log_line.partition(tag)
+    if tag:
+        (log_prefix, _, json_str) = log_line.partition(tag)
 
-            # make sure it's a valid json
-            try:
-                json.loads(json_str)
-                json_log = (tag, json_str + "\n")
-            except ValueError:
-                logger.warn("Invalid json found: " + log_line)
+        # make sure it's a valid json
+        try:
+            record = json.loads(json_str)
+            if event_time_field_enabled:
+                json_str = event_time_field(record, log_prefix) + json_str
+            json_log = (tag, json_str + "\n")
+        except ValueError:
+            json_log = (tag, None)
 
     return json_log
 
@@ -120,6 +141,7 @@ def _log_has_tags_of_interest(tags, line):
     return None
 
 
+@profiled()
 def lambda_handler(event, context):
     """
     :param event:
@@ -135,42 +157,58 @@ def lambda_handler(event, context):
         return
 
     stream = event['awslogs']['data']
-    payload = json.loads(stream_gzip_decompress(stream.decode('base64')))
+    payload = decode_payload(stream)
     records = dict((t, []) for t in log_config.keys())
     
-    if not payload["logStream"] or "hibiki-prod" != payload["logStream"]:
+    if not log_filter.accepts_stream(payload.get("logGroup"), payload.get("logStream")):
         return
+    dead_letters = DeadLetterBatch('doubledouble')
+    budget = DeliveryBudget('doubledouble', context)
 
     for log_event in payload['logEvents']:
+        if log_filter.drops(log_event['message']):
+            continue
+
         json_log = extract_controller_json_str(log_event['message'])
 
         if all(json_log):
-            logger.info("====" + str(json_log))
+            logger.debug("====" + str(json_log))
 
+            dead_letters.close()
             (tag, json_str) = json_log
             records[tag].append({'Data': json_str})
             records[tag] = write_records(
-                                log_config[tag]['stream_name'],
+                                stream_routers[tag],
                                 records[tag],
-                                log_config[tag]['batch_size'])
+                                log_config[tag]['batch_size'],
+                                budget)
+        elif json_log[0]:
+            dead_letters.add(json_log[0], log_event['message'], payload, log_event)
+        else:
+            dead_letters.add_continuation(log_event['message'])
 
     # Flush
     for tag in log_config.keys():
         write_records(
-            log_config[tag]['stream_name'],
+            stream_routers[tag],
             records[tag],
-            0)
+            0,
+            budget)
+    dead_letters.flush(firehose)
+    budget.flush()
 
     return True
 
 
-def write_records(stream_name, records, batch_size):
+def write_records(stream_router, records, batch_size, budget=None):
     leftover = records
-    if len(records) > batch_size:
-        firehose.put_record_batch(
-            DeliveryStreamName=stream_name,
-            Records=records
-        )
+    if len(records) > int(batch_size):
+        undelivered = stream_router.put_record_batch(firehose, records, budget)
+        if undelivered and budget is not None:
+            budget.spill(stream_router.stream_names[0], undelivered)
+        elif undelivered:
+            logger.warning("%s records could not be delivered to %s" % (len(undelivered),
+                                                                         ",".join(stream_router.stream_names)))
         leftover = []
 
     return leftover
@@ -0,0 +1,107 @@
+"""
+    Event time of the records, found once by the preprocessors and carried to the partitioner in a fixed-width
+    leading field, so the partitioner places a record without parsing its JSON:
+
+        1520903537594 2018031301\t{"ts":"2018-03-13T01:12:17.594577Z",...}
+
+    Epoch milliseconds, a space, the UTC hour YYYYMMDDHH, a tab, then the record. The time is the ts of the
+    record, or its requested_at, or the date and time in the prefix of the log line, before its tag. Records
+    without any are sent without the field.
+
+    The module lives in cloudwatch_to_firehose and is linked into firehose_to_s3.
+"""
+import calendar
+import re
+import time
+
+try:
+    string_types = basestring
+except NameError:
+    string_types = str
+
+FIELD_WIDTH = 25
+
+# ISO 8601, e.g. 2018-03-13T01:12:17.594577Z, or the "2018-01-11 05:24:35.918" prefix of the log lines (UTC)
+_TIME_PATTERN = re.compile(r'(\d{4})-(\d{2})-(\d{2})[T ](\d{2}):(\d{2}):(\d{2})(?:\.(\d{1,9}))?'
+                           r'(Z|[+-]\d{2}:?\d{2})?')
+_RECORD_TIME_KEYS = ('ts', 'requested_at')
+# epoch of the start of the days seen, the records of a batch share a few days
+_day_starts = {}
+
+
+def parse_time(value, anchored=True):
+    """
+    :param value: ISO 8601 date time, UTC unless it has an offset
+    :param anchored: The time must start the value
+    :return: Epoch milliseconds, None if the value is not a date time
+    """
+    match = _TIME_PATTERN.match(value) if anchored else _TIME_PATTERN.search(value)
+    if not match:
+        return None
+
+    year, month, day, hour, minute, second, fraction, offset = match.groups()
+    day_start = _day_starts.get((year, month, day))
+    if day_start is None:
+        try:
+            day_start = calendar.timegm((int(year), int(month), int(day), 0, 0, 0))
+        except ValueError:
+            return None
+        if len(_day_starts) >= 1024:
+            _day_starts.clear()
+        _day_starts[(year, month, day)] = day_start
+
+    epoch = day_start + int(hour) * 3600 + int(minute) * 60 + int(second)
+
+    millis = int((fraction or '0')[:3].ljust(3, '0'))
+    if offset and offset != 'Z':
+        sign = -1 if offset[0] == '+' else 1
+        epoch += sign * (int(offset[1:3]) * 3600 + int(offset[-2:]) * 60)
+    return epoch * 1000 + millis
+
+
+def event_time(record, log_prefix=None):
+    """
+    :param record: The parsed JSON record
+    :param log_prefix: The part of the log line before the tag, e.g. "2018-01-11 05:24:35.918 request_id=... [info] "
+    :return: Epoch milliseconds of the event, None if unknown
+    """
+    if isinstance(record, dict):
+        for key in _RECORD_TIME_KEYS:
+            value = record.get(key)
+            if isinstance(value, string_types):
+                epoch_ms = parse_time(value)
+                if epoch_ms is not None:
+                    return epoch_ms
+
+    if log_prefix:
+        return parse_time(log_prefix, anchored=False)
+
+    return None
+
+
+def format_field(epoch_ms):
+    """
+    :return: The leading field of a record, see the module docstring
+    """
+    year, month, day, hour = time.gmtime(epoch_ms // 1000)[:4]
+    return '%013d %04d%02d%02d%02d\t' % (epoch_ms, year, month, day, hour)
+
+
+def event_time_field(record, log_prefix=None):
+    """
+    :return: The leading field for a record, empty if its event time is unknown
+    """
+    epoch_ms = event_time(record, log_prefix)
+    return format_field(epoch_ms) if epoch_ms is not None and epoch_ms >= 0 else ''
+
+
+def split_field(data):
+    """
+    :param data: A record, with or without the leading field
+    :return: (epoch milliseconds, (year, month, day, hour), record without the field), the first two None
+             without the field
+    """
+    if len(data) > FIELD_WIDTH and data[FIELD_WIDTH - 1] == '\t' and data[13] == ' ' and data[:13].isdigit():
+        hour = data[14:24]
+        return int(data[:13]), (int(hour[0:4]), int(hour[4:6]), int(hour[6:8]), int(hour[8:10])), data[FIELD_WIDTH:]
+    return None, None, data
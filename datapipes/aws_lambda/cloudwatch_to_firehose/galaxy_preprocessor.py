@@ -1,42 +1,61 @@
 from __future__ import print_function
 
 import json
-import zlib
 import boto3
 import os
 import logging
 
+try:
+    from backpressure import DeliveryBudget
+    from cloudwatch_logs import decode_payload
+    from dead_letter import DeadLetterBatch
+    from event_time import event_time_field
+    from lambda_profiler import profiled
+    from log_filter import compile_filter
+    from stream_router import StreamRouter
+except ImportError:
+    from .backpressure import DeliveryBudget
+    from .cloudwatch_logs import decode_payload
+    from .dead_letter import DeadLetterBatch
+    from .event_time import event_time_field
+    from .lambda_profiler import profiled
+    from .log_filter import compile_filter
+    from .stream_router import StreamRouter
+
 # GALAXY_CONTROLLER_TAGS = ('response_log=', 'event_tracking=')
 log_config = {
     'response_log=': {
         'stream_name': os.environ.get('RESPONSE_DELIVERY_STREAM_NAME', "SandboxResponseToS3"),
+        'shard_strategy': os.environ.get('RESPONSE_SHARD_STRATEGY', 'round_robin'),
+        'shard_key': os.environ.get('RESPONSE_SHARD_KEY'),
         'batch_size': os.environ.get('DELIVERY_STREAM_BATCH_SIZE', 499)
     },
     'event_tracking=': {
         'stream_name': os.environ.get('EVENT_TRACKING_DELIVERY_STREAM_NAME', "SandboxTrackingToS3"),
+        'shard_strategy': os.environ.get('EVENT_TRACKING_SHARD_STRATEGY', 'round_robin'),
+        'shard_key': os.environ.get('EVENT_TRACKING_SHARD_KEY'),
         'batch_size': os.environ.get('DELIVERY_STREAM_BATCH_SIZE', 499)
     }
 }
+# prefix the records with their event time, see event_time.py. Only for streams delivered through a partitioner
+# that strips it, like naboo_partitioner
+event_time_field_enabled = os.environ.get('EVENT_TIME_FIELD', "False") == "True"
+stream_routers = dict((t, StreamRouter.from_config(c)) for t, c in log_config.items())
+
 HEALTH_CHECK = 'health_check'
+# applied by extract_controller_json_str to the log of the FluentD envelopes
+log_filter = compile_filter({
+    'exclude_substrings': [HEALTH_CHECK]
+})
+filters_in_extraction = True
 firehose = boto3.client('firehose')
 
 logging.basicConfig()
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
-def stream_gzip_decompress(stream):
-    dec = zlib.decompressobj(32 + zlib.MAX_WBITS)
-    buf = ''
-    for chunk in stream:
-        rv = dec.decompress(chunk)
-        if rv:
-            buf += rv
-    return buf
-
-
 def extract_controller_json_str(log_line):
     """
-    Exclude health check later
     FluentD format:
     {
         "log": "2017-07-31 21:27:14.326 request_id=8ilinul11ucajst6qcpqeqjlurdsaihd [info] response_log={\"status\":200,\"requested_at\":\"2017-07-31T21:27:14.326013Z\",\"request_id\":\"8ilinul11ucajst6qcpqeqjlurdsaihd\",\"remote_ip\":\"10.42.52.226\",\"path\":\"/health_check\",\"params\":{},\"method\":\"GET\"}\n",
@@ -47,23 +66,33 @@ def extract_controller_json_str(log_line):
 
     :param log_line: a JSON string log line sent from FluentD
     :return: A tuple or None if not found. Returns tag for the json, and the json part of the line.
+             The json part is None if the tagged json is invalid, so the caller can dead-letter the line.
     """
     json_log = (None, None)
     fluentd_log_key = "log"
+
+    # tags are plain ascii, unchanged by the JSON encoding of the envelope: most lines have none, and their
+    # envelope is not parsed at all
+    if not _log_has_tags_of_interest(log_config.keys(), log_line):
+        return json_log
+
     log_dict = json.loads(log_line)
 
-    if fluentd_log_key in log_dict and HEALTH_CHECK not in log_dict[fluentd_log_key]:
+    # filtered on the log itself, not on the metadata of the envelope (container name, stream)
+    if fluentd_log_key in log_dict and not log_filter.drops(log_dict[fluentd_log_key]):
         tag = _log_has_tags_of_interest(log_config.keys(), log_dict[fluentd_log_key])
 
         if tag:
-            (_, _, json_str) = log_dict[fluentd_log_key].partition(tag)
+            (log_prefix, _, json_str) = log_dict[fluentd_log_key].partition(tag)
 
             # make sure it's a valid json
             try:
-                json.loads(json_str)
+                record = json.loads(json_str)
+                if event_time_field_enabled:
+                    json_str = event_time_field(record, log_prefix) + json_str
                 json_log = (tag, json_str)
             except ValueError:
-                logger.warn("Invalid json found: " + log_dict[fluentd_log_key])
+                json_log = (tag, None)
 
     return json_log
 
@@ -83,6 +112,7 @@ def _log_has_tags_of_interest(tags, line):
     return None
 
 
+@profiled()
 def lambda_handler(event, context):
     """
     :param event:
@@ -98,9 +128,11 @@ def lambda_handler(event, context):
         return
 
     stream = event['awslogs']['data']
-    payload = json.loads(stream_gzip_decompress(stream.decode('base64')))
+    payload = decode_payload(stream)
     # logger.debug(json.dumps(payload, indent=4, sort_keys=True))
     records = dict((t, []) for t in log_config.keys())
+    dead_letters = DeadLetterBatch('galaxy')
+    budget = DeliveryBudget('galaxy', context)
 
     for log_event in payload['logEvents']:
         json_log = extract_controller_json_str(log_event['message'])
@@ -108,30 +140,41 @@ def lambda_handler(event, context):
         if all(json_log):
             logger.debug("====" + str(json_log))
 
+            dead_letters.close()
             (tag, json_str) = json_log
             records[tag].append({'Data': json_str})
             records[tag] = write_records(
-                                log_config[tag]['stream_name'],
+                                stream_routers[tag],
                                 records[tag],
-                                log_config[tag]['batch_size'])
+                                log_config[tag]['batch_size'],
+                                budget)
+        elif json_log[0]:
+            dead_letters.add(json_log[0], log_event['message'], payload, log_event)
+        else:
+            dead_letters.add_continuation(log_event['message'])
 
     # Flush
     for tag in log_config.keys():
         write_records(
-            log_config[tag]['stream_name'],
+            stream_routers[tag],
             records[tag],
-            0)
+            0,
+            budget)
+    dead_letters.flush(firehose)
+    budget.flush()
 
     return True
 
 
-def write_records(stream_name, records, batch_size):
+def write_records(stream_router, records, batch_size, budget=None):
     leftover = records
-    if len(records) > batch_size:
-        firehose.put_record_batch(
-            DeliveryStreamName=stream_name,
-            Records=records
-        )
+    if len(records) > int(batch_size):
+        undelivered = stream_router.put_record_batch(firehose, records, budget)
+        if undelivered and budget is not None:
+            budget.spill(stream_router.stream_names[0], undelivered)
+        elif undelivered:
+            logger.warning("%s records could not be delivered to %s" % (len(undelivered),
+                                                                         ",".join(stream_router.stream_names)))
         leftover = []
 
     return leftover
@@ -151,6 +194,6 @@ if __name__ == '__main__':
         input_file = sys.argv[1]
         with open(input_file, 'r') as f:
             data = f.read()
-        event = json.loads(data)
+        log_event = json.loads(data)
 
     lambda_handler(log_event, None)
\ No newline at end of file
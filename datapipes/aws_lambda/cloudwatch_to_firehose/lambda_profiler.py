@@ -0,0 +1,245 @@
+"""
+    Opt-in profiling of Lambda invocations.
+
+    Handlers decorated with @profiled() are profiled on a sample of their invocations: cProfile stats, and the
+    top allocations and peak memory from tracemalloc (Python 3 only). Each sampled invocation writes a .prof file
+    (pstats format) and a .json summary to LAMBDA_PROFILE_DIR, or under LAMBDA_PROFILE_S3_PREFIX of
+    LAMBDA_PROFILE_S3_BUCKET.
+
+    Profiling is decided when the handler is decorated: when LAMBDA_PROFILE_SAMPLE_RATE is 0 (the default) the
+    handler is returned as is, so there is no overhead at all. Changing the environment of a Lambda function
+    starts new containers, which pick up the new rate.
+
+    The profiles of many invocations are merged and summarized with:
+        python lambda_profiler.py /tmp/lambda_profiles/naboo_preprocessor --top 30
+        python lambda_profiler.py s3://bucket/lambda_profiles/naboo_preprocessor --sort tottime
+
+    The module lives in cloudwatch_to_firehose and is linked into the other Lambda packages.
+"""
+from __future__ import print_function
+
+import argparse
+import cProfile
+import functools
+import json
+import logging
+import os
+import pstats
+import random
+import shutil
+import sys
+import tempfile
+import time
+import uuid
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+# environment variables
+profile_sample_rate = float(os.environ.get('LAMBDA_PROFILE_SAMPLE_RATE', 0))
+profile_dir = os.environ.get('LAMBDA_PROFILE_DIR', '/tmp/lambda_profiles')
+profile_s3_bucket = os.environ.get('LAMBDA_PROFILE_S3_BUCKET')
+profile_s3_prefix = os.environ.get('LAMBDA_PROFILE_S3_PREFIX', 'lambda_profiles')
+profile_top_allocations = int(os.environ.get('LAMBDA_PROFILE_TOP_ALLOCATIONS', 25))
+profile_tracemalloc_frames = int(os.environ.get('LAMBDA_PROFILE_TRACEMALLOC_FRAMES', 1))
+
+logger = logging.getLogger()
+
+
+def profiled(name=None, sample_rate=None):
+    """
+    Decorator profiling a sample of the invocations of a handler.
+
+    :param name: Name the profiles are grouped by, the module of the handler by default
+    :param sample_rate: Share of the invocations profiled, 0 to 1. Defaults to LAMBDA_PROFILE_SAMPLE_RATE
+    :return: The decorator
+    """
+    rate = profile_sample_rate if sample_rate is None else sample_rate
+
+    def decorator(handler):
+        if rate <= 0:
+            return handler
+
+        profile_name = name or handler.__module__.split('.')[-1]
+
+        @functools.wraps(handler)
+        def wrapper(event, context):
+            if rate < 1 and random.random() >= rate:
+                return handler(event, context)
+            return _profile(profile_name, handler, event, context)
+
+        return wrapper
+
+    return decorator
+
+
+def _profile(name, handler, event, context):
+    tracing = tracemalloc is not None and not tracemalloc.is_tracing()
+    if tracing:
+        tracemalloc.start(profile_tracemalloc_frames)
+
+    profile = cProfile.Profile()
+    started = time.time()
+    profile.enable()
+    try:
+        return handler(event, context)
+    finally:
+        profile.disable()
+        duration = time.time() - started
+        snapshot, peak = None, None
+        if tracing:
+            snapshot = tracemalloc.take_snapshot()
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+
+        # a profile that can not be written must not fail the invocation
+        try:
+            _write_profile(name, context, profile, duration, snapshot, peak)
+        except Exception as e:
+            logger.warning("Failed to write the profile of %s: %s" % (name, e))
+
+
+def _write_profile(name, context, profile, duration, snapshot, peak):
+    request_id = getattr(context, 'aws_request_id', None) or uuid.uuid4().hex
+    stem = '%s-%s' % (time.strftime('%Y%m%dT%H%M%S', time.gmtime()), request_id)
+
+    summary = {
+        'name': name,
+        'request_id': request_id,
+        'duration_seconds': round(duration, 6),
+        'peak_traced_bytes': peak,
+        'top_allocations': []
+    }
+    if snapshot is not None:
+        snapshot = snapshot.filter_traces([tracemalloc.Filter(False, tracemalloc.__file__)])
+        for stat in snapshot.statistics('lineno')[:profile_top_allocations]:
+            frame = stat.traceback[0]
+            summary['top_allocations'].append({'location': '%s:%s' % (frame.filename, frame.lineno),
+                                               'size': stat.size, 'count': stat.count})
+
+    local_dir = os.path.join(profile_dir, name)
+    if not os.path.isdir(local_dir):
+        try:
+            os.makedirs(local_dir)
+        except OSError:
+            if not os.path.isdir(local_dir):
+                raise
+
+    prof_path = os.path.join(local_dir, stem + '.prof')
+    json_path = os.path.join(local_dir, stem + '.json')
+    profile.dump_stats(prof_path)
+    with open(json_path, 'w') as f:
+        json.dump(summary, f, indent=2)
+
+    if profile_s3_bucket:
+        import boto3
+
+        s3 = boto3.client('s3')
+        for path in (prof_path, json_path):
+            s3.upload_file(path, profile_s3_bucket, '/'.join([profile_s3_prefix.rstrip('/'), name,
+                                                              os.path.basename(path)]))
+            os.remove(path)
+        logger.info("Profile of %s written to s3://%s/%s/%s" % (name, profile_s3_bucket, profile_s3_prefix, name))
+    else:
+        logger.info("Profile of %s written to %s" % (name, prof_path))
+
+
+def _download_profiles(location, local_dir):
+    """
+    :param location: s3://bucket/prefix
+    :return: Local paths of the downloaded profiles
+    """
+    import boto3
+
+    bucket, _, prefix = location[len('s3://'):].partition('/')
+    s3 = boto3.client('s3')
+    paths = []
+    for page in s3.get_paginator('list_objects_v2').paginate(Bucket=bucket, Prefix=prefix):
+        for item in page.get('Contents', []):
+            if item['Key'].endswith(('.prof', '.json')):
+                path = os.path.join(local_dir, item['Key'].replace('/', '_'))
+                s3.download_file(bucket, item['Key'], path)
+                paths.append(path)
+    return paths
+
+
+def _list_profiles(locations, local_dir):
+    paths = []
+    for location in locations:
+        if location.startswith('s3://'):
+            paths.extend(_download_profiles(location, local_dir))
+        elif os.path.isdir(location):
+            for root, _, names in os.walk(location):
+                paths.extend(os.path.join(root, n) for n in sorted(names) if n.endswith(('.prof', '.json')))
+        else:
+            paths.append(location)
+    return paths
+
+
+def summarize(locations, top=30, sort='cumulative', stream=None):
+    """
+    Merge the profiles of many invocations and print the hottest functions and allocation sites.
+
+    :param locations: Profile files, directories or s3://bucket/prefix locations
+    :param top: Number of functions and allocation sites printed
+    :param sort: pstats sort key, e.g. cumulative or tottime
+    :param stream: Output stream, stdout by default
+    :return: Number of invocations merged
+    """
+    stream = stream or sys.stdout
+    local_dir = tempfile.mkdtemp(prefix='lambda_profiles')
+    try:
+        paths = _list_profiles(locations, local_dir)
+        prof_paths = [p for p in paths if p.endswith('.prof')]
+        summaries = []
+        for path in paths:
+            if path.endswith('.json'):
+                with open(path) as f:
+                    summaries.append(json.load(f))
+
+        if not prof_paths:
+            print("No profiles found.", file=stream)
+            return 0
+
+        durations = sorted(s['duration_seconds'] for s in summaries)
+        print("%s invocations" % len(prof_paths), file=stream)
+        if durations:
+            print("duration p50 %.3fs, max %.3fs" % (durations[len(durations) // 2], durations[-1]), file=stream)
+
+        stats = pstats.Stats(prof_paths[0], stream=stream)
+        for path in prof_paths[1:]:
+            stats.add(path)
+        # one header line per profile file is noise once merged
+        stats.files = []
+        stats.sort_stats(sort).print_stats(top)
+
+        allocations = {}
+        for summary in summaries:
+            for allocation in summary.get('top_allocations', []):
+                total = allocations.setdefault(allocation['location'], {'size': 0, 'count': 0, 'invocations': 0})
+                total['size'] += allocation['size']
+                total['count'] += allocation['count']
+                total['invocations'] += 1
+
+        if allocations:
+            print("Top allocations, summed over the invocations where they were in the top:", file=stream)
+            print("%14s %10s %6s  location" % ('bytes', 'blocks', 'calls'), file=stream)
+            for location, total in sorted(allocations.items(), key=lambda a: -a[1]['size'])[:top]:
+                print("%14d %10d %6d  %s" % (total['size'], total['count'], total['invocations'], location),
+                      file=stream)
+
+        return len(prof_paths)
+    finally:
+        shutil.rmtree(local_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Merge and summarize Lambda invocation profiles.')
+    parser.add_argument('locations', nargs='+', help='Profile files, directories or s3://bucket/prefix')
+    parser.add_argument('--top', type=int, default=30)
+    parser.add_argument('--sort', default='cumulative', help='pstats sort key, e.g. cumulative or tottime')
+    args = parser.parse_args()
+
+    summarize(args.locations, top=args.top, sort=args.sort)
@@ -0,0 +1,111 @@
+"""
+    Declarative log filters.
+
+    A filter config is compiled once, at cold start, into the cheapest predicates that implement it, and applied
+    before any per-line extraction work:
+    {
+        "log_groups": ["*"],                        # globs, a payload is kept if its log group matches one
+        "log_streams": ["hibiki-prod", "naboo-*"],  # globs, a payload is kept if its log stream matches one
+        "exclude_substrings": ["health_check"],     # a line is dropped if it contains one
+        "exclude_patterns": ["QUERY (OK|ERROR)"],   # regular expressions, a line is dropped if one matches
+        "exclude_levels": ["debug"],                # a line is dropped if it is logged with one, e.g. "[debug]"
+        "exclude_paths": ["/health_check", "/api/system/*"]  # globs on the "path" field of response logs
+    }
+    Missing or empty entries do not filter anything.
+
+    The LOG_FILTER_CONFIG environment variable (a JSON object) replaces the preprocessor's default config.
+"""
+from __future__ import print_function
+
+import fnmatch
+import json
+import os
+import re
+
+# Substring checks are cheaper than a regular expression up to a handful of substrings
+MAX_SUBSTRING_CHECKS = 2
+
+
+def load_filter_config(default_config):
+    """
+    :param default_config: The preprocessor's filter config
+    :return: The config from LOG_FILTER_CONFIG if set, the default config otherwise.
+    """
+    config = os.environ.get('LOG_FILTER_CONFIG')
+    return json.loads(config) if config else default_config
+
+
+def _glob_to_regex(globs):
+    return re.compile('|'.join('(?:%s)' % fnmatch.translate(g) for g in globs))
+
+
+def _path_glob_to_regex(glob):
+    # the path is matched in the raw line, where it may be quoted with escaped quotes, e.g. in FluentD envelopes
+    return re.escape(glob).replace(r'\*', '[^"\\\\]*') + r'\\?"'
+
+
+class LogFilter(object):
+
+    def __init__(self, config):
+        """
+        :param config: A filter config, see the module documentation
+        """
+        self.config = config
+        self.accepts_stream = self._compile_stream_predicate(config.get('log_groups'), config.get('log_streams'))
+        self.drops = self._compile_line_predicate(config)
+
+    @staticmethod
+    def _compile_stream_predicate(log_groups, log_streams):
+        group_regex = _glob_to_regex(log_groups) if log_groups and '*' not in log_groups else None
+        stream_regex = _glob_to_regex(log_streams) if log_streams and '*' not in log_streams else None
+
+        if stream_regex is None and group_regex is None:
+            return lambda log_group, log_stream: True
+
+        def accepts_stream(log_group, log_stream):
+            """
+            :return: True if the payload of this log group and stream should be processed.
+            """
+            if group_regex is not None and not (log_group and group_regex.match(log_group)):
+                return False
+            if stream_regex is not None and not (log_stream and stream_regex.match(log_stream)):
+                return False
+            return True
+
+        return accepts_stream
+
+    @staticmethod
+    def _compile_line_predicate(config):
+        substrings = list(config.get('exclude_substrings') or [])
+        patterns = list(config.get('exclude_patterns') or [])
+        levels = config.get('exclude_levels') or []
+        paths = config.get('exclude_paths') or []
+
+        if levels:
+            patterns.append(r'\[(?:%s)\]' % '|'.join(re.escape(level) for level in levels))
+        if paths:
+            patterns.append(r'\\?"path\\?"\s*:\s*\\?"(?:%s)' % '|'.join(_path_glob_to_regex(p) for p in paths))
+
+        if not patterns and not substrings:
+            return lambda line: False
+
+        if not patterns and len(substrings) <= MAX_SUBSTRING_CHECKS:
+            if len(substrings) == 1:
+                substring = substrings[0]
+                return lambda line: substring in line
+            return lambda line: any(s in line for s in substrings)
+
+        # a single alternation is scanned once, in C, whatever the number of excludes
+        regex = re.compile('|'.join(['(?:%s)' % p for p in patterns] + [re.escape(s) for s in substrings]))
+        search = regex.search
+        return lambda line: search(line) is not None
+
+
+def compile_filter(default_config):
+    """
+    :param default_config: The preprocessor's filter config, replaced by LOG_FILTER_CONFIG if set
+    :return: LogFilter, with
+        - accepts_stream(log_group, log_stream): True if a payload should be processed
+        - drops(line): True if a line should be skipped before extraction
+    """
+    return LogFilter(load_filter_config(default_config))
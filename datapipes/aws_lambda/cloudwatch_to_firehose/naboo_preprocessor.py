@@ -1,27 +1,55 @@
 from __future__ import print_function
 
 import json
-import zlib
 import boto3
 import os
 import logging
-import base64
+
+try:
+    from backpressure import DeliveryBudget
+    from cloudwatch_logs import decode_payload
+    from dead_letter import DeadLetterBatch
+    from event_time import event_time_field
+    from lambda_profiler import profiled
+    from log_filter import compile_filter
+    from stream_router import StreamRouter
+except ImportError:
+    from .backpressure import DeliveryBudget
+    from .cloudwatch_logs import decode_payload
+    from .dead_letter import DeadLetterBatch
+    from .event_time import event_time_field
+    from .lambda_profiler import profiled
+    from .log_filter import compile_filter
+    from .stream_router import StreamRouter
 
 # environment variables
 log_config = {
     'response_log=': {
         'stream_name': os.environ.get('RESPONSE_DELIVERY_STREAM_NAME', "NabooDevResponseToS3"),
+        'shard_strategy': os.environ.get('RESPONSE_SHARD_STRATEGY', 'round_robin'),
+        'shard_key': os.environ.get('RESPONSE_SHARD_KEY'),
         'batch_size': os.environ.get('DELIVERY_STREAM_BATCH_SIZE', 499)
     },
     'feed_event=': {
         'stream_name': os.environ.get('EVENT_TRACKING_DELIVERY_STREAM_NAME', "NabooDevFeedEventToS3"),
+        'shard_strategy': os.environ.get('EVENT_TRACKING_SHARD_STRATEGY', 'round_robin'),
+        'shard_key': os.environ.get('EVENT_TRACKING_SHARD_KEY'),
         'batch_size': os.environ.get('DELIVERY_STREAM_BATCH_SIZE', 499)
     },
 }
 log_stream_name = os.environ.get('LOG_STREAM_NAME', "test-stream")
 debug_mode = os.environ.get('DEBUG_MODE', "False")
+# prefix the records with their event time, see event_time.py. Only for streams delivered through a partitioner
+# that strips it, like naboo_partitioner
+event_time_field_enabled = os.environ.get('EVENT_TIME_FIELD', "False") == "True"
+
+stream_routers = dict((t, StreamRouter.from_config(c)) for t, c in log_config.items())
 
 HEALTH_CHECK = 'health_check'
+log_filter = compile_filter({
+    'log_streams': [log_stream_name],
+    'exclude_substrings': [HEALTH_CHECK]
+})
 firehose = boto3.client('firehose', region_name='us-west-2')
 
 logging.basicConfig()
@@ -72,22 +100,24 @@ def extract_controller_json_str(log_line):
     }
     :param log_line: a JSON string log line sent from ASG
     :return: A tuple or None if not found. Returns tag for the json, and the json part of the line.
+             The json part is None if the tagged json is invalid, so the caller can dead-letter the line.
     """
 
     json_log = (None, None)
 
-    if HEALTH_CHECK not in log_line:
-        tag = log_has_tags_of_interest(log_config.keys(), log_line)
+    tag = log_has_tags_of_interest(log_config.keys(), log_line)
 
-        if tag:
-            (_, _, json_str) = log_line.partition(tag)
+    if tag:
+        (log_prefix, _, json_str) = log_line.partition(tag)
 
-            # make sure it's a valid json
-            try:
-                json.loads(json_str)
-                json_log = (tag, json_str + "\n")
-            except ValueError:
-                logger.warn("Invalid json found: " + log_line)
+        # make sure it's a valid json
+        try:
+            record = json.loads(json_str)
+            if event_time_field_enabled:
+                json_str = event_time_field(record, log_prefix) + json_str
+            json_log = (tag, json_str + "\n")
+        except ValueError:
+            json_log = (tag, None)
 
     return json_log
 
@@ -107,6 +137,7 @@ def log_has_tags_of_interest(tags, line):
     return None
 
 
+@profiled()
 def lambda_handler(event, context):
     """
     :param event:
@@ -123,19 +154,22 @@ def lambda_handler(event, context):
         return
 
     stream = event['awslogs']['data']
-    # TODO: data stream is not being chunked under python 3.6
-    payload = json.loads(zlib.decompress(base64.b64decode(stream), 32 + zlib.MAX_WBITS).decode('utf-8'))
+    payload = decode_payload(stream)
     records = dict((t, []) for t in log_config.keys())
 
-    if not payload["logStream"] or log_stream_name != payload["logStream"]:
+    if not log_filter.accepts_stream(payload.get("logGroup"), payload.get("logStream")):
         return
 
-    extract_and_push_records(records, payload)
-    flush_records(records)
+    dead_letters = DeadLetterBatch('naboo')
+    budget = DeliveryBudget('naboo', context)
+    extract_and_push_records(records, payload, dead_letters, budget)
+    flush_records(records, budget)
+    dead_letters.flush(firehose)
+    budget.flush()
     return True
 
 
-def extract_and_push_records(records, payload):
+def extract_and_push_records(records, payload, dead_letters=None, budget=None):
     """
     loop through every log event within the event log, extract the actual log message, reformat into compatible
     format and push to firehose
@@ -171,22 +205,38 @@ def extract_and_push_records(records, payload):
                     ...
                 ]
         }
+    :param dead_letters: DeadLetterBatch collecting tagged lines with invalid json, and the untagged lines
+        directly following them. Invalid lines are dropped if not given.
+    :param budget: DeliveryBudget of the invocation, bounding retries of throttled records and keeping the
+        undelivered ones
     :return:
     """
+    if dead_letters is None:
+        dead_letters = DeadLetterBatch('naboo')
+
     for log_event in payload['logEvents']:
+        if log_filter.drops(log_event['message']):
+            continue
+
         json_log = extract_controller_json_str(log_event['message'])
 
         if all(json_log):
             logger.debug("====" + str(json_log))
+            dead_letters.close()
             (tag, json_str) = json_log
             records[tag].append({'Data': json_str})
             records[tag] = write_records(
-                log_config[tag]['stream_name'],
+                stream_routers[tag],
                 records[tag],
-                log_config[tag]['batch_size'])
+                log_config[tag]['batch_size'],
+                budget)
+        elif json_log[0]:
+            dead_letters.add(json_log[0], log_event['message'], payload, log_event)
+        else:
+            dead_letters.add_continuation(log_event['message'])
 
 
-def flush_records(records):
+def flush_records(records, budget=None):
     """
     If there's leftover records after the pre-processing, send all of them in a batch to firehose
     before exiting the pipeline
@@ -200,23 +250,27 @@ def flush_records(records):
               }
            ]
         }
+    :param budget: DeliveryBudget of the invocation
     :return:
     """
     if records is not []:
         for tag in log_config.keys():
             write_records(
-                log_config[tag]['stream_name'],
+                stream_routers[tag],
                 records[tag],
-                0)
+                0,
+                budget)
 
 
-def write_records(stream_name, records, batch_size):
+def write_records(stream_router, records, batch_size, budget=None):
     leftover = records
     if len(records) > int(batch_size):
-        firehose.put_record_batch(
-            DeliveryStreamName=stream_name,
-            Records=records
-        )
+        undelivered = stream_router.put_record_batch(firehose, records, budget)
+        if undelivered and budget is not None:
+            budget.spill(stream_router.stream_names[0], undelivered)
+        elif undelivered:
+            logger.warning("%s records could not be delivered to %s" % (len(undelivered),
+                                                                         ",".join(stream_router.stream_names)))
         leftover = []
 
     return leftover
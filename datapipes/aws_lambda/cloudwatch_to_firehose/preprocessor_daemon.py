@@ -0,0 +1,287 @@
+"""
+    Long-running preprocessor daemon.
+
+    Runs the tag extraction and batching of a preprocessor next to the application instead of behind CloudWatch
+    Logs, shipping continuously to the same delivery streams. Lines are read from stdin, tailed log files or a
+    local TCP socket, and handed to the preprocessor's extract_controller_json_str as is: galaxy expects the
+    FluentD envelope format (one JSON envelope per line), naboo and doubledouble expect raw log lines.
+
+    Batches are flushed when they reach the batch size, the Firehose request size limit, or the flush interval.
+    Memory is bounded by the line queue and the number of batches in flight; readers wait when the queue is full.
+
+    Usage:
+        tail -F /var/log/naboo.log | python preprocessor_daemon.py naboo --stdin
+        python preprocessor_daemon.py naboo --file /var/log/naboo.log --file /var/log/naboo-worker.log
+        python preprocessor_daemon.py galaxy --listen 127.0.0.1:24224
+"""
+from __future__ import print_function
+
+import argparse
+import asyncio
+import functools
+import importlib
+import logging
+import os
+import signal
+import socket
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    from backpressure import DeliveryBudget
+    from dead_letter import DeadLetterBatch, FIREHOSE_MAX_BATCH_BYTES, FIREHOSE_MAX_BATCH_RECORDS
+except ImportError:
+    from .backpressure import DeliveryBudget
+    from .dead_letter import DeadLetterBatch, FIREHOSE_MAX_BATCH_BYTES, FIREHOSE_MAX_BATCH_RECORDS
+
+logging.basicConfig()
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+_STOP = object()
+
+
+class PreprocessorDaemon(object):
+
+    def __init__(self, preprocessor, flush_interval=1.0, max_queue_lines=10000, max_in_flight=4,
+                 poll_interval=0.25):
+        """
+        :param preprocessor: The preprocessor module, e.g. naboo_preprocessor
+        :param flush_interval: Maximum seconds a record is buffered before it is shipped
+        :param max_queue_lines: Lines read but not yet extracted before readers wait
+        :param max_in_flight: Batches being shipped concurrently before extraction waits
+        :param poll_interval: Seconds between reads of a tailed file at its end
+        """
+        self.preprocessor = preprocessor
+        self.flush_interval = flush_interval
+        self.max_queue_lines = max_queue_lines
+        self.max_in_flight = max_in_flight
+        self.poll_interval = poll_interval
+        self.source = preprocessor.__name__.split('.')[-1].replace('_preprocessor', '')
+        self.payload = {'logGroup': self.source, 'logStream': socket.gethostname()}
+        self.budget = DeliveryBudget(self.source)
+        self.stats = {'lines': 0, 'dropped': 0, 'records': 0, 'batches': 0, 'dead_letters': 0, 'spilled': 0}
+        self.executor = ThreadPoolExecutor(max_workers=max_in_flight)
+        self.queue = None
+        self.in_flight = None
+        self.stopping = False
+
+    def run(self, stdin=False, files=(), listen=None):
+        """
+        Run until stdin is exhausted or SIGINT/SIGTERM is received, then ship everything left.
+
+        :param stdin: Read lines from stdin
+        :param files: Paths of log files to tail
+        :param listen: (host, port) to accept newline delimited lines on
+        """
+        asyncio.run(self._run(stdin, files, listen))
+
+    async def _run(self, stdin, files, listen):
+        loop = asyncio.get_event_loop()
+        self.queue = asyncio.Queue(maxsize=self.max_queue_lines)
+        self.in_flight = asyncio.Semaphore(self.max_in_flight)
+
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, self.stop)
+
+        readers = [asyncio.ensure_future(self._tail(path)) for path in files]
+        server = None
+        if listen:
+            server = await asyncio.start_server(self._handle_connection, listen[0], listen[1])
+        if stdin:
+            readers.append(asyncio.ensure_future(self._read_stdin()))
+
+        batcher = asyncio.ensure_future(self._batch_lines())
+        if stdin and not files and not server:
+            await readers[-1]
+            self.stop()
+        else:
+            while not self.stopping:
+                await asyncio.sleep(self.poll_interval)
+
+        for reader in readers:
+            reader.cancel()
+        if server:
+            server.close()
+            await server.wait_closed()
+        await self.queue.put(_STOP)
+        await batcher
+        self.executor.shutdown(wait=True)
+        logger.info("Preprocessor daemon stopped: %s" % self.stats)
+
+    def stop(self):
+        self.stopping = True
+
+    async def _read_stdin(self):
+        loop = asyncio.get_event_loop()
+        reader = asyncio.StreamReader()
+        await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), sys.stdin)
+        await self._read_stream(reader)
+
+    async def _handle_connection(self, reader, writer):
+        try:
+            await self._read_stream(reader)
+        finally:
+            writer.close()
+
+    async def _read_stream(self, reader):
+        while not self.stopping:
+            line = await reader.readline()
+            if not line:
+                return
+            await self.queue.put(line.decode('utf-8', 'replace').rstrip('\n'))
+
+    async def _tail(self, path):
+        """
+        Follow a log file like tail -F: start at its end, reopen it when it is rotated or truncated.
+        """
+        f, inode = None, None
+        while not self.stopping:
+            if f is None:
+                try:
+                    f = open(path, 'rb')
+                    inode = os.fstat(f.fileno()).st_ino
+                    f.seek(0, os.SEEK_END)
+                except (IOError, OSError):
+                    await asyncio.sleep(self.poll_interval)
+                    continue
+
+            line = f.readline()
+            if line.endswith(b'\n'):
+                await self.queue.put(line.decode('utf-8', 'replace').rstrip('\n'))
+                continue
+
+            # partial or no line, go back and wait for the rest
+            f.seek(-len(line), os.SEEK_CUR)
+            await asyncio.sleep(self.poll_interval)
+            try:
+                stat = os.stat(path)
+                if stat.st_ino != inode or stat.st_size < f.tell():
+                    f.close()
+                    f = open(path, 'rb')
+                    inode = os.fstat(f.fileno()).st_ino
+            except (IOError, OSError):
+                pass
+
+        if f is not None:
+            f.close()
+
+    async def _batch_lines(self):
+        loop = asyncio.get_event_loop()
+        log_config = self.preprocessor.log_config
+        extract = self.preprocessor.extract_controller_json_str
+        # galaxy filters the log of its FluentD envelopes, a raw line is the envelope
+        line_filter = None if getattr(self.preprocessor, 'filters_in_extraction', False) else \
+            self.preprocessor.log_filter
+        records = dict((t, []) for t in log_config.keys())
+        sizes = dict((t, 0) for t in log_config.keys())
+        batch_sizes = dict((t, min(int(c['batch_size']) + 1, FIREHOSE_MAX_BATCH_RECORDS))
+                           for t, c in log_config.items())
+        dead_letters = DeadLetterBatch(self.source)
+        deadline = loop.time() + self.flush_interval
+
+        while True:
+            try:
+                line = self.queue.get_nowait()
+            except asyncio.QueueEmpty:
+                try:
+                    line = await asyncio.wait_for(self.queue.get(), max(0.0, deadline - loop.time()))
+                except asyncio.TimeoutError:
+                    line = None
+
+            if line is _STOP:
+                break
+
+            if line is not None and line_filter is not None and line_filter.drops(line):
+                self.stats['dropped'] += 1
+            elif line is not None:
+                self.stats['lines'] += 1
+                try:
+                    json_log = extract(line)
+                except ValueError:
+                    json_log = (None, None)
+
+                if all(json_log):
+                    dead_letters.close()
+                    (tag, json_str) = json_log
+                    records[tag].append({'Data': json_str})
+                    sizes[tag] += len(json_str)
+                    if len(records[tag]) >= batch_sizes[tag] or sizes[tag] >= FIREHOSE_MAX_BATCH_BYTES // 2:
+                        await self._ship(tag, records[tag])
+                        records[tag], sizes[tag] = [], 0
+                elif json_log[0]:
+                    dead_letters.add(json_log[0], line, self.payload, {'timestamp': int(time.time() * 1000)})
+                else:
+                    dead_letters.add_continuation(line)
+
+            if loop.time() >= deadline:
+                for tag in log_config.keys():
+                    if records[tag]:
+                        await self._ship(tag, records[tag])
+                        records[tag], sizes[tag] = [], 0
+                await self._flush_side_outputs(dead_letters)
+                deadline = loop.time() + self.flush_interval
+
+        for tag in log_config.keys():
+            if records[tag]:
+                await self._ship(tag, records[tag])
+
+        # wait for the batches in flight
+        for _ in range(self.max_in_flight):
+            await self.in_flight.acquire()
+        await self._flush_side_outputs(dead_letters)
+
+    async def _ship(self, tag, batch):
+        await self.in_flight.acquire()
+        self.stats['records'] += len(batch)
+        self.stats['batches'] += 1
+
+        stream_router = self.preprocessor.stream_routers[tag]
+        future = asyncio.get_event_loop().run_in_executor(
+            self.executor, self.preprocessor.write_records, stream_router, batch, 0, self.budget)
+        future.add_done_callback(functools.partial(self._shipped, stream_router, batch))
+
+    def _shipped(self, stream_router, batch, future):
+        self.in_flight.release()
+        # e.g. a missing delivery stream: the batch is spilled like undelivered records, to be replayed once fixed
+        if future.exception():
+            logger.error("Failed to ship batch: %s" % future.exception())
+            self.budget.spill(stream_router.stream_names[0], batch)
+
+    async def _flush_side_outputs(self, dead_letters):
+        """
+        Flush the records spilled by the batches shipped so far, then dead letters.
+        """
+        loop = asyncio.get_event_loop()
+        if self.budget.spilled:
+            self.stats['spilled'] += await loop.run_in_executor(self.executor, self.budget.flush)
+        if len(dead_letters):
+            self.stats['dead_letters'] += len(dead_letters)
+            await loop.run_in_executor(self.executor, dead_letters.flush, self.preprocessor.firehose)
+
+
+def _host_port(value):
+    host, _, port = value.rpartition(':')
+    return host or '127.0.0.1', int(port)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run a preprocessor as a long-running daemon.')
+    parser.add_argument('preprocessor', choices=['naboo', 'galaxy', 'doubledouble'])
+    parser.add_argument('--stdin', action='store_true', help='Read lines from stdin')
+    parser.add_argument('--file', action='append', default=[], help='Log file to tail, may be repeated')
+    parser.add_argument('--listen', type=_host_port, help='host:port to accept lines on')
+    parser.add_argument('--flush-interval', type=float, default=1.0, help='Seconds between flushes')
+    parser.add_argument('--max-queue-lines', type=int, default=10000, help='Lines buffered before readers wait')
+    parser.add_argument('--max-in-flight', type=int, default=4, help='Batches shipped concurrently')
+    args = parser.parse_args()
+
+    if not (args.stdin or args.file or args.listen):
+        parser.error('one of --stdin, --file or --listen is required')
+
+    module = importlib.import_module(args.preprocessor + '_preprocessor')
+    PreprocessorDaemon(module,
+                       flush_interval=args.flush_interval,
+                       max_queue_lines=args.max_queue_lines,
+                       max_in_flight=args.max_in_flight).run(stdin=args.stdin, files=args.file, listen=args.listen)
@@ -0,0 +1,143 @@
+"""
+    Re-run dead letters written by the preprocessors.
+
+    Truncated lines are stitched back together with the untagged lines that followed them, validated again, and
+    the recovered records are sent in bulk to the delivery streams of the preprocessor's log_config.
+
+    Usage:
+        python reprocess_dead_letters.py naboo /tmp/dead_letter
+        python reprocess_dead_letters.py galaxy s3://loop-logs/dead_letter/source=galaxy/year=2018 --dry-run
+"""
+from __future__ import print_function
+
+import argparse
+import importlib
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+
+try:
+    from dead_letter import read_dead_letters, firehose_batches
+except ImportError:
+    from .dead_letter import read_dead_letters, firehose_batches
+
+logging.basicConfig()
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+FLUENTD_LOG_KEY = 'log'
+
+
+def _unwrap(message):
+    """
+    Galaxy dead letters keep the FluentD envelope of each line, everything else is the raw log line.
+    """
+    if message.startswith('{'):
+        try:
+            envelope = json.loads(message)
+            if isinstance(envelope, dict) and FLUENTD_LOG_KEY in envelope:
+                return envelope[FLUENTD_LOG_KEY]
+        except ValueError:
+            pass
+    return message
+
+
+def recover_json_str(letter):
+    """
+    Try to rebuild the json of a dead letter, appending its continuation lines one at a time until the json
+    after the tag is valid.
+
+    :param letter: A dead letter, see DeadLetterBatch
+    :return: The json string with a trailing newline, None if it can not be recovered.
+    """
+    (_, _, json_str) = _unwrap(letter['message']).partition(letter['tag'])
+    parts = [_unwrap(m) for m in letter.get('continuation', [])]
+
+    for i in range(len(parts) + 1):
+        if i:
+            json_str = json_str.rstrip("\n") + parts[i - 1]
+        try:
+            json.loads(json_str)
+            return json_str.rstrip("\n") + "\n"
+        except ValueError:
+            continue
+
+    return None
+
+
+def _local_path(path):
+    """
+    Download an s3://bucket/prefix location to a temporary directory.
+
+    :return: (local path, temporary directory to remove or None)
+    """
+    if not path.startswith('s3://'):
+        return path, None
+
+    import boto3
+    bucket_name, _, prefix = path[len('s3://'):].partition('/')
+    temp_dir = tempfile.mkdtemp(prefix='dead_letter_')
+    for obj in boto3.resource('s3').Bucket(bucket_name).objects.filter(Prefix=prefix):
+        target = os.path.join(temp_dir, obj.key.replace('/', '_'))
+        obj.Object().download_file(target)
+    return temp_dir, temp_dir
+
+
+def reprocess(preprocessor, path, dry_run=False, rejects=None):
+    """
+    :param preprocessor: Module name of the preprocessor owning the dead letters, e.g. "naboo_preprocessor"
+    :param path: Dead letter file, directory or s3://bucket/prefix
+    :param dry_run: Print recovered records instead of sending them
+    :param rejects: File to write dead letters that still can not be recovered or delivered
+    :return: (recovered count, rejected count)
+    """
+    module = importlib.import_module(preprocessor)
+    recovered = dict((t, []) for t in module.log_config.keys())
+    rejected = []
+
+    local_path, temp_dir = _local_path(path)
+    try:
+        for letter in read_dead_letters(local_path):
+            json_str = recover_json_str(letter) if letter.get('tag') in recovered else None
+            if json_str:
+                recovered[letter['tag']].append(json_str)
+            else:
+                rejected.append(letter)
+    finally:
+        if temp_dir:
+            shutil.rmtree(temp_dir)
+
+    undelivered_count = 0
+    for tag, lines in recovered.items():
+        if dry_run:
+            for line in lines:
+                sys.stdout.write(line)
+            continue
+
+        for batch in firehose_batches(lines):
+            undelivered = module.stream_routers[tag].put_record_batch(module.firehose, batch)
+            undelivered_count += len(undelivered)
+            rejected.extend({'tag': tag, 'message': tag + record['Data']} for record in undelivered)
+
+    if rejects and rejected:
+        with open(rejects, 'w') as f:
+            for letter in rejected:
+                f.write(json.dumps(letter) + "\n")
+
+    recovered_count = sum(len(lines) for lines in recovered.values()) - undelivered_count
+    logger.info("Recovered %s dead letters, %s rejected" % (recovered_count, len(rejected)))
+    return recovered_count, len(rejected)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Re-run preprocessor dead letters in bulk.')
+    parser.add_argument('preprocessor', choices=['naboo', 'galaxy', 'doubledouble'])
+    parser.add_argument('path', help='Dead letter file, directory, or s3://bucket/prefix')
+    parser.add_argument('--dry-run', action='store_true', help='Print recovered records instead of sending them')
+    parser.add_argument('--rejects', help='File to write dead letters that can not be recovered')
+    args = parser.parse_args()
+
+    reprocess(args.preprocessor + '_preprocessor', args.path, dry_run=args.dry_run, rejects=args.rejects)
@@ -0,0 +1,247 @@
+from __future__ import print_function
+
+import re
+import threading
+import time
+import zlib
+import logging
+
+ROUND_ROBIN = 'round_robin'
+HASH = 'hash'
+
+# Firehose error codes, per record or per request, that mean the delivery stream is over its quota
+THROTTLING_ERROR_CODES = ('ServiceUnavailableException', 'ThrottlingException', 'LimitExceededException')
+
+logger = logging.getLogger()
+
+
+def parse_stream_names(stream_name):
+    """
+    :param stream_name: A delivery stream name, a comma separated list of names, or a list of names
+    :return: list of delivery stream names
+    """
+    if isinstance(stream_name, (list, tuple)):
+        return [s.strip() for s in stream_name if s.strip()]
+    return [s.strip() for s in stream_name.split(',') if s.strip()]
+
+
+class StreamRouter(object):
+    """
+    Distributes the batches of one tag across one or more Firehose delivery streams (shards), so a hot tag is not
+    capped by the per-stream records/s and MB/s quotas.
+
+    Strategies:
+    - round_robin: every batch goes to the next healthy shard.
+    - hash: every record goes to the shard picked by the crc32 of its key field, e.g. "request_id", so records
+      with the same key land in the same stream. The first occurrence of the key in the json is used.
+
+    A shard that throttles is skipped for an exponentially growing backoff period, and the records it rejected
+    are sent to the next healthy shard. The backoff is reset on the first clean batch.
+
+    Records are sent in windows sized AIMD style: the window grows by window_increase records after every
+    delivered request and is cut by window_decrease while throttled, with a growing pause before the rejected
+    records are retried. Routers live at module level, so the backoff and window are kept across warm
+    invocations, and are shared by the delivery threads of the preprocessor daemon: their state is changed under
+    a lock.
+    """
+
+    def __init__(self, stream_names, strategy=ROUND_ROBIN, shard_key=None, backoff_base=1.0, backoff_max=60.0,
+                 min_window=25, max_window=500, window_increase=25, window_decrease=0.5, retry_pause=0.1):
+        """
+        :param stream_names: Delivery stream name(s), see parse_stream_names
+        :param strategy: ROUND_ROBIN or HASH
+        :param shard_key: Json field used by the HASH strategy
+        :param backoff_base: Seconds a shard is skipped after its first throttled batch
+        :param backoff_max: Upper bound of the backoff in seconds
+        :param min_window: Smallest number of records per request while throttled
+        :param max_window: Largest number of records per request, the put_record_batch limit
+        :param window_increase: Records added to the window after a delivered request
+        :param window_decrease: Factor applied to the window after a throttled request
+        :param retry_pause: Seconds to wait before the first retry of throttled records, doubled on every retry
+        """
+        self.stream_names = parse_stream_names(stream_names)
+        if not self.stream_names:
+            raise Exception('At least one delivery stream is required.')
+        if strategy == HASH and not shard_key:
+            raise Exception('A shard key is required to route by hash.')
+
+        self.strategy = strategy if len(self.stream_names) > 1 else ROUND_ROBIN
+        self.shard_key = shard_key
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.min_window = min(min_window, max_window)
+        self.max_window = max_window
+        self.window_increase = window_increase
+        self.window_decrease = window_decrease
+        self.retry_pause = retry_pause
+        self.window = max_window
+        self._next = 0
+        self._lock = threading.Lock()
+        self._failures = dict((s, 0) for s in self.stream_names)
+        self._backoff_until = dict((s, 0.0) for s in self.stream_names)
+        self._shard_key_pattern = re.compile(
+            r'"%s"\s*:\s*("(?:[^"\\]|\\.)*"|[^,}\]\s]+)' % re.escape(shard_key)) if shard_key else None
+
+    @classmethod
+    def from_config(cls, config):
+        """
+        :param config: A log_config entry, e.g.
+            {
+                'stream_name': 'NabooDevResponseToS3,NabooDevResponseToS3-2',
+                'shard_strategy': 'hash',
+                'shard_key': 'request_id',
+                'batch_size': 499
+            }
+        :return: StreamRouter
+        """
+        return cls(config['stream_name'],
+                   strategy=config.get('shard_strategy') or ROUND_ROBIN,
+                   shard_key=config.get('shard_key'))
+
+    def is_healthy(self, stream_name, now=None):
+        return self._backoff_until[stream_name] <= (now or time.time())
+
+    def next_stream(self, exclude=()):
+        """
+        Pick the next healthy shard in round robin order. If every shard is backing off, the one that recovers
+        first is returned, as records are never held back.
+
+        :param exclude: Shards not to pick, unless nothing else is left
+        :return: delivery stream name
+        """
+        now = time.time()
+        count = len(self.stream_names)
+        with self._lock:
+            for i in range(count):
+                stream_name = self.stream_names[(self._next + i) % count]
+                if stream_name not in exclude and self.is_healthy(stream_name, now):
+                    self._next = (self._next + i + 1) % count
+                    return stream_name
+
+            candidates = [s for s in self.stream_names if s not in exclude] or self.stream_names
+            return min(candidates, key=lambda s: self._backoff_until[s])
+
+    def stream_for_record(self, json_str):
+        """
+        :param json_str: The record's json
+        :return: The shard owning the record's key, or the next healthy shard if the key is missing or its shard
+                 is backing off.
+        """
+        match = self._shard_key_pattern.search(json_str)
+        if match:
+            value = match.group(1)
+            stream_name = self.stream_names[(zlib.crc32(value.encode('utf-8')) & 0xffffffff) % len(self.stream_names)]
+            if self.is_healthy(stream_name):
+                return stream_name
+        return self.next_stream()
+
+    def route(self, records):
+        """
+        :param records: list of {'Data': json_str}
+        :return: list of (delivery stream name, records) tuples
+        """
+        if self.strategy != HASH:
+            return [(self.next_stream(), records)]
+
+        batches = {}
+        for record in records:
+            batches.setdefault(self.stream_for_record(record['Data']), []).append(record)
+        return list(batches.items())
+
+    def mark_throttled(self, stream_name):
+        with self._lock:
+            self._failures[stream_name] += 1
+            backoff = min(self.backoff_max, self.backoff_base * (2 ** (self._failures[stream_name] - 1)))
+            self._backoff_until[stream_name] = time.time() + backoff
+        logger.warning("Delivery stream %s throttled, backing off %.1fs" % (stream_name, backoff))
+
+    def mark_healthy(self, stream_name):
+        with self._lock:
+            self._failures[stream_name] = 0
+            self._backoff_until[stream_name] = 0.0
+
+    def _grow_window(self):
+        with self._lock:
+            self.window = min(self.max_window, self.window + self.window_increase)
+
+    def _shrink_window(self):
+        with self._lock:
+            self.window = max(self.min_window, int(self.window * self.window_decrease))
+
+    def put_record_batch(self, firehose_client, records, budget=None):
+        """
+        Send records to their shards in windows. Records rejected because a shard is throttling are retried on the
+        remaining shards, then again after a pause for as long as the budget allows.
+
+        :param firehose_client: boto3 firehose client
+        :param records: list of {'Data': json_str}
+        :param budget: DeliveryBudget bounding the retries. Records are only tried once per shard without it
+        :return: list of records that could not be delivered
+        """
+        pending = records
+        attempt, pause = 0, self.retry_pause
+        while pending:
+            size = self.window
+            window, pending = pending[:size], pending[size:]
+            rejected = self._put_window(firehose_client, window)
+            if not rejected:
+                self._grow_window()
+                continue
+
+            self._shrink_window()
+            attempt += 1
+            if budget is None or not budget.allows(attempt, pause):
+                return rejected + pending
+
+            time.sleep(pause)
+            pause *= 2
+            pending = rejected + pending
+
+        return []
+
+    def _put_window(self, firehose_client, records):
+        """
+        :return: list of records that could not be delivered to any shard
+        """
+        undelivered = []
+        for stream_name, batch in self.route(records):
+            tried = [stream_name]
+            while batch:
+                batch = self._put(firehose_client, stream_name, batch)
+                if not batch or len(tried) >= len(self.stream_names):
+                    break
+                stream_name = self.next_stream(exclude=tried)
+                tried.append(stream_name)
+            undelivered.extend(batch)
+
+        return undelivered
+
+    def _put(self, firehose_client, stream_name, batch):
+        """
+        :return: list of records rejected, by throttling or by a per record error
+        :raise: Errors of the request a retry can not fix, e.g. ResourceNotFoundException or AccessDeniedException,
+                so the invocation fails instead of spilling every record
+        """
+        try:
+            response = firehose_client.put_record_batch(DeliveryStreamName=stream_name, Records=batch)
+        except Exception as e:
+            if _error_code(e) not in THROTTLING_ERROR_CODES:
+                logger.error("Failed to deliver %s records to %s: %s" % (len(batch), stream_name, e))
+                raise
+            self.mark_throttled(stream_name)
+            return batch
+
+        if not response.get('FailedPutCount'):
+            self.mark_healthy(stream_name)
+            return []
+
+        rejected = [record for record, result in zip(batch, response['RequestResponses'])
+                    if result.get('ErrorCode')]
+        if any(r.get('ErrorCode') in THROTTLING_ERROR_CODES for r in response['RequestResponses']):
+            self.mark_throttled(stream_name)
+        return rejected
+
+
+def _error_code(error):
+    response = getattr(error, 'response', None) or {}
+    return response.get('Error', {}).get('Code')
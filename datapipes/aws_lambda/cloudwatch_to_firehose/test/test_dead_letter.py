@@ -0,0 +1,50 @@
+from datapipes.aws_lambda.cloudwatch_to_firehose.dead_letter import *
+from datapipes.aws_lambda.cloudwatch_to_firehose.reprocess_dead_letters import recover_json_str
+import unittest
+import shutil
+import tempfile
+
+
+class TestDeadLetter(unittest.TestCase):
+
+    def setUp(self):
+        self.payload = {"logGroup": "shawn-test", "logStream": "test-stream"}
+        self.log_event = {"id": "33932602058168217326485955733116808031206164863324984556",
+                          "timestamp": 1521590500949}
+        self.truncated_message = "18:12:17.594 [info] feed_event={\"ts\":\"2018-03-13T01:12:17.594577Z\",\"props\":" \
+                                 "{\"video_id\":79,"
+        self.continuation = "\"user_id\":1,\"id\":1239},\"event\":\"show_video\"}"
+        self.local_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.local_dir)
+
+    def test_flush_and_read_dead_letters(self):
+        dead_letters = DeadLetterBatch('naboo', local_dir=self.local_dir)
+        dead_letters.add('feed_event=', self.truncated_message, self.payload, self.log_event)
+        self.assertTrue(dead_letters.add_continuation(self.continuation))
+
+        # nothing is attached once a valid line closed the letter
+        dead_letters.close()
+        self.assertFalse(dead_letters.add_continuation("begin []"))
+
+        self.assertEqual(dead_letters.flush(), 1)
+        self.assertEqual(len(dead_letters), 0)
+
+        letters = list(read_dead_letters(self.local_dir))
+        self.assertEqual(len(letters), 1)
+        self.assertEqual(letters[0]["log_stream"], "test-stream")
+        self.assertEqual(letters[0]["event_id"], self.log_event["id"])
+        self.assertEqual(letters[0]["continuation"], [self.continuation])
+
+    def test_recover_json_str(self):
+        letter = {"tag": "feed_event=", "message": self.truncated_message, "continuation": [self.continuation]}
+        self.assertEqual(json.loads(recover_json_str(letter))["props"]["id"], 1239)
+
+        # return none if the continuation does not complete the json
+        letter["continuation"] = ["begin []"]
+        self.assertIsNone(recover_json_str(letter))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,44 @@
+from datapipes.aws_lambda.cloudwatch_to_firehose import naboo_preprocessor
+from datapipes.aws_lambda.cloudwatch_to_firehose.event_time import event_time_field, parse_time, split_field
+import json
+import unittest
+
+
+class TestEventTime(unittest.TestCase):
+
+    def test_parse_time(self):
+        self.assertEqual(parse_time("2018-03-13T01:12:17.594577Z"), 1520903537594)
+        self.assertEqual(parse_time("2018-03-13T01:12:17Z"), 1520903537000)
+        self.assertEqual(parse_time("2018-03-13T03:12:17.5+02:00"), 1520903537500)
+        self.assertEqual(parse_time("2018-01-11 05:24:35.918 request_id=x [info] ", anchored=False), 1515648275918)
+        self.assertIsNone(parse_time("18:12:17.594 [info] "))
+        self.assertIsNone(parse_time("2018-13-45T01:12:17Z"))
+
+    def test_event_time_field(self):
+        record = {"ts": "2018-03-13T01:12:17.594577Z", "event": "show_video"}
+        self.assertEqual(event_time_field(record), "1520903537594 2018031301\t")
+        self.assertEqual(event_time_field({"requested_at": "2017-07-31T21:27:14.326013Z"}, "18:12:17.594 [info] "),
+                         "1501536434326 2017073121\t")
+        self.assertEqual(event_time_field({}, "2018-01-11 05:24:35.918 request_id=x [info] "),
+                         "1515648275918 2018011105\t")
+        self.assertEqual(event_time_field([], "18:12:17.594 [info] "), "")
+
+    def test_split_field(self):
+        data = '{"ts":"2018-03-13T01:12:17.594577Z"}\n'
+        self.assertEqual(split_field("1520903537594 2018031301\t" + data),
+                         (1520903537594, (2018, 3, 13, 1), data))
+        self.assertEqual(split_field(data), (None, None, data))
+
+    def test_naboo_extract_with_field(self):
+        message = "18:12:17.594 [info] feed_event={\"ts\":\"2018-03-13T01:12:17.594577Z\",\"event\":\"show_video\"}"
+        enabled = naboo_preprocessor.event_time_field_enabled
+        naboo_preprocessor.event_time_field_enabled = True
+        try:
+            tag, data = naboo_preprocessor.extract_controller_json_str(message)
+        finally:
+            naboo_preprocessor.event_time_field_enabled = enabled
+
+        self.assertEqual(tag, "feed_event=")
+        epoch_ms, hour, json_str = split_field(data)
+        self.assertEqual((epoch_ms, hour), (1520903537594, (2018, 3, 13, 1)))
+        self.assertEqual(json.loads(json_str)["event"], "show_video")
@@ -0,0 +1,62 @@
+import os
+
+# galaxy creates its firehose client at import
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-west-2')
+
+from datapipes.aws_lambda.cloudwatch_to_firehose.log_filter import *
+from datapipes.aws_lambda.cloudwatch_to_firehose import galaxy_preprocessor
+import unittest
+import json
+
+
+class TestLogFilter(unittest.TestCase):
+
+    def setUp(self):
+        with open('./naboo_test_assets/sample_log_events.json') as json_data:
+            self.messages = [e["message"] for e in json.load(json_data)]
+
+        self.health_check = "2018-01-11 05:24:35.918 request_id=h660ptntri278mlr4p8l7s4hc4uftpqb [info] " \
+                            "response_log={\"status\":200,\"path\":\"/health_check\",\"params\":{}}"
+        self.fluentd_health_check = json.dumps({"log": self.health_check + "\n", "stream": "stdout"})
+
+    def test_accepts_stream(self):
+        log_filter = LogFilter({"log_streams": ["hibiki-prod", "naboo-*"]})
+        self.assertTrue(log_filter.accepts_stream("logging", "hibiki-prod"))
+        self.assertTrue(log_filter.accepts_stream("logging", "naboo-worker"))
+        self.assertFalse(log_filter.accepts_stream("logging", "hibiki-staging"))
+        self.assertFalse(log_filter.accepts_stream("logging", None))
+
+        # no stream filter accepts everything
+        self.assertTrue(LogFilter({}).accepts_stream(None, None))
+
+    def test_drops_substrings(self):
+        log_filter = LogFilter({"exclude_substrings": ["health_check"]})
+        self.assertTrue(log_filter.drops(self.health_check))
+        self.assertFalse(any(log_filter.drops(m) for m in self.messages))
+
+    def test_drops_levels_patterns_and_paths(self):
+        log_filter = LogFilter({"exclude_levels": ["debug"],
+                                "exclude_patterns": ["^begin "],
+                                "exclude_paths": ["/health_*"]})
+
+        # only the feed events are kept
+        self.assertEqual([log_filter.drops(m) for m in self.messages], [False, False, True, True, True])
+
+        # paths are matched in raw lines and in FluentD envelopes
+        self.assertTrue(log_filter.drops(self.health_check))
+        self.assertTrue(log_filter.drops(self.fluentd_health_check))
+        self.assertFalse(log_filter.drops(self.health_check.replace("/health_check", "/api/health_check")))
+
+    def test_galaxy_filters_the_log_not_the_envelope(self):
+        self.assertEqual(galaxy_preprocessor.extract_controller_json_str(self.fluentd_health_check), (None, None))
+
+        # health_check only in the envelope metadata
+        log = self.health_check.replace("/health_check", "/api/videos")
+        envelope = json.dumps({"log": log + "\n", "stream": "stdout", "container_name": "health_check-sidecar"})
+        tag, json_str = galaxy_preprocessor.extract_controller_json_str(envelope)
+        self.assertEqual(tag, "response_log=")
+        self.assertEqual(json.loads(json_str)["path"], "/api/videos")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,129 @@
+import os
+
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-west-2')
+
+from datapipes.aws_lambda.cloudwatch_to_firehose import dead_letter
+from datapipes.aws_lambda.cloudwatch_to_firehose import naboo_preprocessor
+from datapipes.aws_lambda.cloudwatch_to_firehose.backpressure import DeliveryBudget
+from datapipes.aws_lambda.cloudwatch_to_firehose.dead_letter import read_lines
+from datapipes.aws_lambda.cloudwatch_to_firehose.preprocessor_daemon import PreprocessorDaemon
+from datapipes.aws_lambda.cloudwatch_to_firehose.test.test_preprocessor_parity import RecordingFirehose
+from botocore.exceptions import ClientError
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+FEED_EVENT_STREAM = naboo_preprocessor.log_config['feed_event=']['stream_name']
+
+
+class SlowFirehose(RecordingFirehose):
+    """
+    Records the number of batches being delivered at the same time.
+    """
+
+    def __init__(self):
+        RecordingFirehose.__init__(self)
+        self.lock = threading.Lock()
+        self.active = 0
+        self.max_active = 0
+
+    def put_record_batch(self, DeliveryStreamName, Records):
+        with self.lock:
+            self.active += 1
+            self.max_active = max(self.max_active, self.active)
+        time.sleep(0.01)
+        try:
+            with self.lock:
+                return RecordingFirehose.put_record_batch(self, DeliveryStreamName, Records)
+        finally:
+            with self.lock:
+                self.active -= 1
+
+
+class MissingStreamFirehose(RecordingFirehose):
+
+    def put_record_batch(self, DeliveryStreamName, Records):
+        if DeliveryStreamName == FEED_EVENT_STREAM:
+            raise ClientError({'Error': {'Code': 'ResourceNotFoundException'}}, 'PutRecordBatch')
+        return RecordingFirehose.put_record_batch(self, DeliveryStreamName, Records)
+
+
+class TestPreprocessorDaemon(unittest.TestCase):
+
+    def setUp(self):
+        self.dead_letter_stream_name = dead_letter.dead_letter_stream_name
+        dead_letter.dead_letter_stream_name = 'DeadLetters'
+        self.firehose = naboo_preprocessor.firehose
+        self.stdin = sys.stdin
+        self.spill_dir = tempfile.mkdtemp()
+
+        self.events = ['18:12:17.594 [info] feed_event={"ts":"2018-03-13T01:12:17.594577Z","props":{"id":%s},'
+                       '"event":"show_video"}' % i for i in range(1200)]
+        self.lines = self.events + ['18:12:17.594 [info] GET /health_check',
+                                    '18:12:17.594 [info] Sent 200 in 1ms',
+                                    '18:12:17.594 [info] feed_event={"ts":']
+
+    def tearDown(self):
+        dead_letter.dead_letter_stream_name = self.dead_letter_stream_name
+        naboo_preprocessor.firehose = self.firehose
+        sys.stdin = self.stdin
+        shutil.rmtree(self.spill_dir)
+
+    def run_daemon(self, firehose, **kwargs):
+        """
+        Feed the lines to the daemon on stdin, then close it.
+        """
+        naboo_preprocessor.firehose = firehose
+        read_fd, write_fd = os.pipe()
+        sys.stdin = os.fdopen(read_fd, 'rb')
+
+        def feed():
+            with os.fdopen(write_fd, 'wb') as f:
+                for line in self.lines:
+                    f.write(line.encode('utf-8') + b'\n')
+
+        feeder = threading.Thread(target=feed)
+        feeder.start()
+        # the flush interval is longer than the test, the last records are shipped at EOF
+        daemon = PreprocessorDaemon(naboo_preprocessor, flush_interval=60, **kwargs)
+        daemon.budget = DeliveryBudget('naboo', local_dir=self.spill_dir)
+
+        queue_sizes = []
+        extract = naboo_preprocessor.extract_controller_json_str
+        naboo_preprocessor.extract_controller_json_str = lambda line: queue_sizes.append(daemon.queue.qsize()) or \
+            extract(line)
+        try:
+            daemon.run(stdin=True)
+        finally:
+            naboo_preprocessor.extract_controller_json_str = extract
+            feeder.join()
+            sys.stdin.close()
+        return daemon, queue_sizes
+
+    def test_delivers_and_flushes_at_eof(self):
+        firehose = SlowFirehose()
+        daemon, queue_sizes = self.run_daemon(firehose, max_queue_lines=10, max_in_flight=2)
+
+        delivered = firehose.records[FEED_EVENT_STREAM]
+        self.assertEqual(sorted(delivered), sorted(e.partition('feed_event=')[2] + "\n" for e in self.events))
+        # batches of 500, the last 200 records at EOF
+        self.assertEqual(daemon.stats['batches'], 3)
+        self.assertEqual(daemon.stats['dropped'], 1)
+        self.assertEqual(daemon.stats['dead_letters'], 1)
+        self.assertEqual(len(firehose.records['DeadLetters']), 1)
+
+        self.assertTrue(max(queue_sizes) <= 10)
+        self.assertTrue(firehose.max_active <= 2)
+
+    def test_spills_batches_that_fail(self):
+        daemon, _ = self.run_daemon(MissingStreamFirehose(), max_queue_lines=10, max_in_flight=2)
+
+        self.assertEqual(daemon.stats['spilled'], len(self.events))
+        self.assertEqual(len(list(read_lines(self.spill_dir))), len(self.events))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+import os
+
+# galaxy and doubledouble create their firehose client at import
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-west-2')
+
+from datapipes.aws_lambda.cloudwatch_to_firehose import dead_letter
+from datapipes.aws_lambda.cloudwatch_to_firehose import doubledouble_preprocessor
+from datapipes.aws_lambda.cloudwatch_to_firehose import galaxy_preprocessor
+from datapipes.aws_lambda.cloudwatch_to_firehose import naboo_preprocessor
+from datapipes.aws_lambda.cloudwatch_to_firehose.cloudwatch_logs import decode_payload
+import base64
+import gzip
+import io
+import json
+import unittest
+
+DEAD_LETTER_STREAM = 'DeadLetters'
+
+
+class RecordingFirehose(object):
+
+    def __init__(self):
+        self.records = {}
+
+    def put_record_batch(self, DeliveryStreamName, Records):
+        self.records.setdefault(DeliveryStreamName, []).extend(r['Data'] for r in Records)
+        return {'FailedPutCount': 0, 'RequestResponses': [{} for _ in Records]}
+
+
+class TestPreprocessorParity(unittest.TestCase):
+    """
+    The records delivered for the sample payloads, and for edge cases (non-ascii text, truncated json and its
+    continuation, untagged lines, health checks, other log streams), match the ones recorded with the Python 2
+    preprocessors, in parity_assets.
+    """
+
+    def setUp(self):
+        self.dead_letter_stream_name = dead_letter.dead_letter_stream_name
+        dead_letter.dead_letter_stream_name = DEAD_LETTER_STREAM
+
+    def tearDown(self):
+        dead_letter.dead_letter_stream_name = self.dead_letter_stream_name
+
+    def assert_parity(self, preprocessor, name):
+        with io.open('./parity_assets/%s.json' % name, encoding='utf-8') as f:
+            cases = json.load(f)
+
+        for case, expected in sorted(cases.items()):
+            firehose = RecordingFirehose()
+            original_firehose, preprocessor.firehose = preprocessor.firehose, firehose
+            try:
+                preprocessor.lambda_handler(expected['event'], None)
+            finally:
+                preprocessor.firehose = original_firehose
+
+            records = firehose.records
+            if DEAD_LETTER_STREAM in records:
+                records[DEAD_LETTER_STREAM] = [json.loads(r) for r in records[DEAD_LETTER_STREAM]]
+            self.assertEqual(records, expected['records'], '%s %s' % (name, case))
+
+    def test_naboo_parity(self):
+        self.assert_parity(naboo_preprocessor, 'naboo')
+
+    def test_galaxy_parity(self):
+        self.assert_parity(galaxy_preprocessor, 'galaxy')
+
+    def test_doubledouble_parity(self):
+        self.assert_parity(doubledouble_preprocessor, 'doubledouble')
+
+    def test_decode_payload(self):
+        payload = {'logGroup': 'naboo', 'logEvents': [{'id': '1', 'message': u'café ☕'}]}
+        compressed = io.BytesIO()
+        with gzip.GzipFile(fileobj=compressed, mode='wb') as f:
+            f.write(json.dumps(payload).encode('utf-8'))
+        data = base64.b64encode(compressed.getvalue())
+
+        self.assertEqual(decode_payload(data), payload)
+        self.assertEqual(decode_payload(data.decode('ascii')), payload)
@@ -0,0 +1,150 @@
+from datapipes.aws_lambda.cloudwatch_to_firehose.stream_router import *
+from datapipes.aws_lambda.cloudwatch_to_firehose.backpressure import DeliveryBudget
+from datapipes.aws_lambda.cloudwatch_to_firehose.dead_letter import read_lines
+from datapipes.aws_lambda.cloudwatch_to_firehose import backpressure
+from botocore.exceptions import ClientError
+import threading
+import unittest
+import os
+import shutil
+import tempfile
+
+
+class FakeFirehose(object):
+
+    def __init__(self, throttled=()):
+        self.throttled = throttled
+        self.batches = []
+
+    def put_record_batch(self, DeliveryStreamName, Records):
+        self.batches.append((DeliveryStreamName, Records))
+        error_code = 'ServiceUnavailableException' if DeliveryStreamName in self.throttled else None
+        return {
+            'FailedPutCount': len(Records) if error_code else 0,
+            'RequestResponses': [{'ErrorCode': error_code} for _ in Records]
+        }
+
+
+class TestStreamRouter(unittest.TestCase):
+
+    def setUp(self):
+        self.records = [{'Data': '{"request_id":"%s","status":200}\n' % i} for i in range(20)]
+
+    def test_round_robin(self):
+        firehose = FakeFirehose()
+        router = StreamRouter('ResponseToS3-1, ResponseToS3-2')
+
+        for _ in range(4):
+            router.put_record_batch(firehose, self.records)
+
+        self.assertEqual([s for s, _ in firehose.batches],
+                         ['ResponseToS3-1', 'ResponseToS3-2', 'ResponseToS3-1', 'ResponseToS3-2'])
+
+    def test_hash_keeps_keys_on_the_same_stream(self):
+        firehose = FakeFirehose()
+        router = StreamRouter(['ResponseToS3-1', 'ResponseToS3-2', 'ResponseToS3-3'], strategy=HASH,
+                              shard_key='request_id')
+
+        router.put_record_batch(firehose, self.records)
+        router.put_record_batch(firehose, self.records)
+
+        streams_by_record = {}
+        for stream_name, batch in firehose.batches:
+            for record in batch:
+                streams_by_record.setdefault(record['Data'], set()).add(stream_name)
+        self.assertTrue(all(len(s) == 1 for s in streams_by_record.values()))
+
+    def test_throttled_stream_backs_off(self):
+        firehose = FakeFirehose(throttled=('ResponseToS3-1',))
+        router = StreamRouter(['ResponseToS3-1', 'ResponseToS3-2'])
+
+        # rejected records are sent to the other stream
+        self.assertEqual(router.put_record_batch(firehose, self.records), [])
+        self.assertFalse(router.is_healthy('ResponseToS3-1'))
+
+        # and the throttled stream is skipped while backing off
+        firehose.batches = []
+        router.put_record_batch(firehose, self.records)
+        self.assertEqual([s for s, _ in firehose.batches], ['ResponseToS3-2'])
+
+    def test_budget_shrinks_window_and_spills(self):
+        firehose = FakeFirehose(throttled=('ResponseToS3-1',))
+        router = StreamRouter('ResponseToS3-1', min_window=5, max_window=20, retry_pause=0.001)
+        local_dir = tempfile.mkdtemp()
+        budget = DeliveryBudget('naboo', max_attempts=3, local_dir=local_dir)
+
+        try:
+            undelivered = router.put_record_batch(firehose, self.records, budget)
+            self.assertEqual(len(undelivered), len(self.records))
+            # the window is halved on every throttled request
+            self.assertEqual([len(batch) for _, batch in firehose.batches], [20, 10, 5])
+            self.assertEqual(router.window, 5)
+
+            budget.spill('ResponseToS3-1', undelivered)
+            self.assertEqual(budget.flush(), len(self.records))
+            self.assertEqual(len(list(read_lines(local_dir))), len(self.records))
+        finally:
+            shutil.rmtree(local_dir)
+
+    def test_shared_by_threads(self):
+        class FlakyFirehose(object):
+            """Throttles every third request"""
+            def __init__(self):
+                self.lock = threading.Lock()
+                self.calls = 0
+                self.delivered = []
+
+            def put_record_batch(self, DeliveryStreamName, Records):
+                with self.lock:
+                    self.calls += 1
+                    throttled = self.calls % 3 == 0
+                    if not throttled:
+                        self.delivered.extend(r['Data'] for r in Records)
+                error_code = 'ThrottlingException' if throttled else None
+                return {
+                    'FailedPutCount': len(Records) if throttled else 0,
+                    'RequestResponses': [{'ErrorCode': error_code} for _ in Records]
+                }
+
+        firehose = FlakyFirehose()
+        router = StreamRouter(['ResponseToS3-1', 'ResponseToS3-2'], min_window=5, max_window=20, backoff_base=0,
+                              retry_pause=0)
+        budget = DeliveryBudget('naboo', max_attempts=1000)
+        records = [{'Data': '{"request_id":"%s"}\n' % i} for i in range(2000)]
+        undelivered = []
+        threads = [threading.Thread(target=lambda part=part: undelivered.extend(
+            router.put_record_batch(firehose, records[part::8], budget))) for part in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(undelivered, [])
+        self.assertEqual(sorted(firehose.delivered), sorted(r['Data'] for r in records))
+        self.assertTrue(router.min_window <= router.window <= router.max_window)
+
+    def test_errors_not_fixed_by_retrying_are_raised(self):
+        class MissingStreamFirehose(object):
+            def put_record_batch(self, DeliveryStreamName, Records):
+                raise ClientError({'Error': {'Code': 'ResourceNotFoundException'}}, 'PutRecordBatch')
+
+        router = StreamRouter('ResponseToS3-1')
+        budget = DeliveryBudget('naboo', max_attempts=3)
+        self.assertRaises(ClientError, router.put_record_batch, MissingStreamFirehose(), self.records, budget)
+
+    def test_no_local_spill_on_lambda(self):
+        local_dir = tempfile.mkdtemp()
+        running_on_lambda, backpressure.running_on_lambda = backpressure.running_on_lambda, True
+        try:
+            budget = DeliveryBudget('naboo', local_dir=local_dir)
+            self.assertEqual(budget.flush(), 0)
+            budget.spill('ResponseToS3-1', self.records)
+            self.assertRaises(Exception, budget.flush)
+            self.assertEqual(os.listdir(local_dir), [])
+        finally:
+            backpressure.running_on_lambda = running_on_lambda
+            shutil.rmtree(local_dir)
+
+
+if __name__ == "__main__":
+    unittest.main()
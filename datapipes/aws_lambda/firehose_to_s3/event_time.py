@@ -0,0 +1 @@
+../cloudwatch_to_firehose/event_time.py
\ No newline at end of file
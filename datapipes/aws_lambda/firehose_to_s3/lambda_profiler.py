@@ -0,0 +1 @@
+../cloudwatch_to_firehose/lambda_profiler.py
\ No newline at end of file
@@ -7,20 +7,43 @@ import logging
 import time
 from datetime import datetime
 
+try:
+    from event_time import split_field
+    from lambda_profiler import profiled
+except ImportError:
+    from .event_time import split_field
+    from .lambda_profiler import profiled
+
 # environment variables
 S3_BUCKET = os.environ['S3_BUCKET']
 S3_PATH = os.environ['S3_PATH']
 debug_mode = os.environ.get('DEBUG_MODE', "False")
+# partition by the hour of the events, from the field the preprocessors prefix the records with (EVENT_TIME_FIELD),
+# instead of the hour they are delivered at
+partition_by_event_time = os.environ.get('PARTITION_BY_EVENT_TIME', "False") == "True"
 
 logging.basicConfig()
 logger = logging.getLogger()
 logger.setLevel(logging.DEBUG if debug_mode == "True" else logging.INFO)
 
+# created on the first invocation and reused by the warm ones
+s3 = None
+
+
+def get_s3_client():
+    global s3
+    if s3 is None:
+        s3 = boto3.client('s3')
+    return s3
+
 
+@profiled()
 def lambda_handler(event, context):
     """
     This function invokes when an incoming batch of logs passes through firehose.
-    It extracts and decodes every data string, append them together and sends to S3 bucket with partitioned file path
+    It extracts and decodes every data string, append them together and sends to S3 bucket with partitioned file path.
+    With PARTITION_BY_EVENT_TIME, records are grouped by the hour of their events, one object per hour, without
+    parsing their JSON; records without the event time field stay in the hour they are delivered at.
 
     :param event:
         In the format of:
@@ -48,20 +71,25 @@ def lambda_handler(event, context):
     :return: None
     """
 
-    s3 = boto3.client('s3')
-    json_str = ''
+    s3_client = get_s3_client()
+    date = datetime.fromtimestamp(time.time())
 
+    # the event time field is always stripped, the objects hold the records as logged
+    partitions = {}
     for record in event['records']:
-        json_str += base64.b64decode(record['data']).decode("utf-8") + "\n"
-
-    date = datetime.fromtimestamp(time.time())
+        _, event_hour, data = split_field(base64.b64decode(record['data']).decode("utf-8"))
+        partition = event_hour if partition_by_event_time and event_hour else \
+            (date.year, date.month, date.day, date.hour)
+        partitions.setdefault(partition, []).append(data + "\n")
 
-    file_path = S3_PATH + "/year=" + str(date.year) + "/month=" + str(date.month) + "/day=" + str(
-        date.day) + "/hour=" + str(date.hour) + "/minute=" + str(date.minute) + "/" + \
-        event['deliveryStreamArn'].split('/')[1] + "-" + str(date.year) + "-" + str(date.month) + "-" + str(
-        date.day) + "-" + str(date.minute) + "-" + str(date.second) + "-" + str(date.microsecond) + "-" + event[
-                    'invocationId'] + ".json"
+    # late records land in the hour of their events, under the minute they are delivered at
+    for (year, month, day, hour), lines in sorted(partitions.items()):
+        file_path = S3_PATH + "/year=" + str(year) + "/month=" + str(month) + "/day=" + str(
+            day) + "/hour=" + str(hour) + "/minute=" + str(date.minute) + "/" + \
+            event['deliveryStreamArn'].split('/')[1] + "-" + str(date.year) + "-" + str(date.month) + "-" + str(
+            date.day) + "-" + str(date.minute) + "-" + str(date.second) + "-" + str(date.microsecond) + "-" + event[
+                        'invocationId'] + ".json"
 
-    s3.put_object(ContentType="application/json", Bucket=S3_BUCKET, Key=file_path, Body=json_str)
+        s3_client.put_object(ContentType="application/json", Bucket=S3_BUCKET, Key=file_path, Body=''.join(lines))
 
-    logger.debug("Successfully sent %s records to S3:%s/%s" % (len(event["records"]), S3_BUCKET, file_path))
+        logger.debug("Successfully sent %s records to S3:%s/%s" % (len(lines), S3_BUCKET, file_path))
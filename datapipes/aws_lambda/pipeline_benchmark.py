@@ -0,0 +1,389 @@
+"""
+    End-to-end benchmark of the naboo ingestion path, run locally.
+
+    Generated CloudWatch Logs subscription payloads of naboo feed_event= and response_log= lines, with the debug
+    and health check noise of the real log stream, go through naboo_preprocessor.lambda_handler. Its Firehose
+    client is replaced by a buffer emulator flushing on size or time like a delivery stream, each flush invoking
+    naboo_partitioner.lambda_handler, whose S3 client is replaced by an in-memory stand-in (or a local directory).
+
+    Payloads are offered at a fixed rate; when the pipeline falls behind they are generated back to back, so the
+    sustained rate is what the path can take. Latency is measured from the time in the record (ts of a feed event,
+    requested_at of a response log) to the S3 write. CPU time is measured per stage.
+
+    Usage (from the repository root):
+        python -m datapipes.aws_lambda.pipeline_benchmark --rate 5000 --duration 60 --buffer-seconds 10
+"""
+from __future__ import print_function
+
+import argparse
+import base64
+import calendar
+import gzip
+import io
+import json
+import os
+import random
+import time
+import uuid
+from datetime import datetime
+
+# the partitioner reads its destination at import
+os.environ.setdefault('S3_BUCKET', 'naboo-benchmark')
+os.environ.setdefault('S3_PATH', 'naboo')
+
+from datapipes.aws_lambda.cloudwatch_to_firehose import naboo_preprocessor
+from datapipes.aws_lambda.firehose_to_s3 import naboo_partitioner
+
+# Firehose limits and defaults
+DEFAULT_BUFFER_BYTES = 5 * 1024 * 1024
+DEFAULT_BUFFER_SECONDS = 60
+
+EVENT_TYPES = ('show_video', 'engage_video', 'like_video', 'share_video')
+PATHS = ('/api/feed', '/api/videos/%d', '/api/users/%d', '/api/videos/%d/likes')
+
+
+class TrafficGenerator(object):
+    """
+    Realistic naboo log payloads, as delivered by a CloudWatch Logs subscription.
+    """
+
+    def __init__(self, events_per_payload=100, response_ratio=0.3, noise_ratio=0.2, health_check_ratio=0.05,
+                 seed=None):
+        """
+        :param events_per_payload: Log events per subscription payload
+        :param response_ratio: Share of the tagged lines that are response logs, the others are feed events
+        :param noise_ratio: Share of untagged lines, e.g. ecto query logs
+        :param health_check_ratio: Share of health check response logs, dropped by the preprocessor
+        :param seed: Random seed, for reproducible traffic
+        """
+        self.events_per_payload = events_per_payload
+        self.response_ratio = response_ratio
+        self.noise_ratio = noise_ratio
+        self.health_check_ratio = health_check_ratio
+        self.random = random.Random(seed)
+        self.next_id = 0
+        self.log_group = 'naboo'
+        self.log_stream = naboo_preprocessor.log_stream_name
+
+    @staticmethod
+    def iso_time(now):
+        return datetime.utcfromtimestamp(now).strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+
+    def feed_event(self, now):
+        r = self.random
+        props = {'video_id': r.randint(1, 50000), 'user_id': r.randint(1, 1000000), 'id': self.next_id}
+        event_type = r.choice(EVENT_TYPES)
+        if event_type == 'engage_video':
+            duration = r.randint(5, 600)
+            props.update({'duration': duration, 'watched_till': r.randint(0, duration),
+                          'completed': r.random() < 0.4, 'inserted_at': self.iso_time(now)})
+        line = json.dumps({'ts': self.iso_time(now), 'props': props, 'event': event_type}, separators=(',', ':'))
+        return '%s [info] feed_event=%s' % (datetime.utcfromtimestamp(now).strftime('%H:%M:%S.%f')[:-3], line)
+
+    def response_log(self, now, path=None):
+        r = self.random
+        request_id = uuid.UUID(int=r.getrandbits(128)).hex
+        path = path or r.choice(PATHS)
+        if '%d' in path:
+            path = path % r.randint(1, 50000)
+        line = json.dumps({
+            'status': r.choice((200, 200, 200, 200, 201, 304, 404, 500)),
+            'requested_at': self.iso_time(now),
+            'request_id': request_id,
+            'remote_ip': '10.%d.%d.%d' % (r.randint(0, 255), r.randint(0, 255), r.randint(1, 254)),
+            'path': path,
+            'params': {'page': r.randint(1, 20)},
+            'method': r.choice(('GET', 'GET', 'GET', 'POST')),
+            'duration': round(r.uniform(1, 250), 3),
+            'user_agent': 'Mozilla/5.0 (iPhone; CPU iPhone OS 11_2 like Mac OS X) AppleWebKit/604.4.7'
+        }, separators=(',', ':'))
+        return '%s request_id=%s [info] response_log=%s' % (
+            datetime.utcfromtimestamp(now).strftime('%Y-%m-%d %H:%M:%S.%f')[:-3], request_id, line)
+
+    def noise(self, now):
+        return '%s [debug] QUERY OK source="videos" db=%.1fms' % (
+            datetime.utcfromtimestamp(now).strftime('%H:%M:%S.%f')[:-3], self.random.uniform(0.1, 5))
+
+    def log_events(self, now):
+        """
+        :return: (log events, number of lines the pipeline is expected to deliver)
+        """
+        r = self.random
+        events, expected = [], 0
+        for _ in range(self.events_per_payload):
+            self.next_id += 1
+            roll = r.random()
+            if roll < self.noise_ratio:
+                message = self.noise(now)
+            elif roll < self.noise_ratio + self.health_check_ratio:
+                message = self.response_log(now, '/health_check')
+            elif r.random() < self.response_ratio:
+                message, expected = self.response_log(now), expected + 1
+            else:
+                message, expected = self.feed_event(now), expected + 1
+            events.append({'id': str(self.next_id), 'timestamp': int(now * 1000), 'message': message})
+        return events, expected
+
+    def payload(self, now=None):
+        """
+        :return: (lambda event of the CloudWatch Logs subscription, number of lines expected to be delivered)
+        """
+        now = now or time.time()
+        log_events, expected = self.log_events(now)
+        body = json.dumps({
+            'messageType': 'DATA_MESSAGE',
+            'owner': '000000000000',
+            'logGroup': self.log_group,
+            'logStream': self.log_stream,
+            'subscriptionFilters': ['LambdaStream_naboo-preprocessor'],
+            'logEvents': log_events
+        }).encode('utf-8')
+
+        compressed = io.BytesIO()
+        with gzip.GzipFile(fileobj=compressed, mode='wb') as f:
+            f.write(body)
+        return {'awslogs': {'data': base64.b64encode(compressed.getvalue()).decode('ascii')}}, expected
+
+
+class FirehoseEmulator(object):
+    """
+    Stands in for the firehose client of the preprocessor. Records are buffered per delivery stream and handed
+    to a transformation lambda, the partitioner, when the buffer reaches its size or age.
+    """
+
+    def __init__(self, handler, buffer_bytes=DEFAULT_BUFFER_BYTES, buffer_seconds=DEFAULT_BUFFER_SECONDS):
+        """
+        :param handler: Lambda handler invoked with the firehose event of each flush
+        :param buffer_bytes: Buffer size that triggers a flush
+        :param buffer_seconds: Age of the oldest buffered record that triggers a flush
+        """
+        self.handler = handler
+        self.buffer_bytes = buffer_bytes
+        self.buffer_seconds = buffer_seconds
+        self.buffers = {}
+        self.stats = {'requests': 0, 'records': 0, 'bytes': 0, 'flushes': 0, 'size_flushes': 0,
+                      'time_flushes': 0, 'final_flushes': 0}
+
+    def put_record_batch(self, DeliveryStreamName, Records):
+        buffer = self.buffers.get(DeliveryStreamName)
+        if buffer is None:
+            buffer = self.buffers[DeliveryStreamName] = {'records': [], 'bytes': 0, 'since': time.time()}
+
+        now = int(time.time() * 1000)
+        for record in Records:
+            data = record['Data']
+            data = data.encode('utf-8') if not isinstance(data, bytes) else data
+            buffer['records'].append({'recordId': uuid.uuid4().hex, 'approximateArrivalTimestamp': now,
+                                      'data': base64.b64encode(data).decode('ascii')})
+            buffer['bytes'] += len(data)
+            self.stats['bytes'] += len(data)
+
+        self.stats['requests'] += 1
+        self.stats['records'] += len(Records)
+        return {'FailedPutCount': 0, 'RequestResponses': [{'RecordId': 'local'} for _ in Records]}
+
+    def due(self, now=None):
+        """
+        :return: list of (stream name, reason) of the buffers to flush
+        """
+        now = now or time.time()
+        streams = []
+        for stream_name, buffer in self.buffers.items():
+            if not buffer['records']:
+                continue
+            if buffer['bytes'] >= self.buffer_bytes:
+                streams.append((stream_name, 'size'))
+            elif now - buffer['since'] >= self.buffer_seconds:
+                streams.append((stream_name, 'time'))
+        return streams
+
+    def flush(self, stream_name, reason='final'):
+        buffer = self.buffers.pop(stream_name)
+        event = {
+            'invocationId': str(uuid.uuid4()),
+            'deliveryStreamArn': 'arn:aws:firehose:us-west-2:000000000000:deliverystream/' + stream_name,
+            'region': 'us-west-2',
+            'records': buffer['records']
+        }
+        self.stats['flushes'] += 1
+        self.stats[reason + '_flushes'] += 1
+        self.handler(event, None)
+
+    def flush_all(self):
+        for stream_name in list(self.buffers):
+            if self.buffers[stream_name]['records']:
+                self.flush(stream_name)
+
+
+class LocalS3(object):
+    """
+    Stands in for the S3 client of the partitioner. Objects are kept in memory until drained, or written under
+    a local directory.
+    """
+
+    def __init__(self, local_dir=None):
+        self.local_dir = local_dir
+        self.pending = []
+        self.stats = {'objects': 0, 'bytes': 0}
+
+    def put_object(self, Bucket, Key, Body, **kwargs):
+        body = Body.encode('utf-8') if not isinstance(Body, bytes) else Body
+        if self.local_dir:
+            path = os.path.join(self.local_dir, Bucket, Key)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path, 'wb') as f:
+                f.write(body)
+
+        self.pending.append((time.time(), Key, body))
+        self.stats['objects'] += 1
+        self.stats['bytes'] += len(body)
+        return {}
+
+    def drain(self):
+        """
+        :return: list of (time written, key, body) since the last drain
+        """
+        objects, self.pending = self.pending, []
+        return objects
+
+
+def record_time(line):
+    """
+    :return: Epoch seconds of the time in a delivered line, None if it has none
+    """
+    try:
+        record = json.loads(line)
+    except ValueError:
+        return None
+    value = record.get('ts') or record.get('requested_at')
+    if not value:
+        return None
+    parsed = datetime.strptime(value, '%Y-%m-%dT%H:%M:%S.%fZ')
+    return calendar.timegm(parsed.timetuple()) + parsed.microsecond / 1e6
+
+
+def percentile(values, pct):
+    """
+    :param values: Sorted list
+    :param pct: 0 to 100
+    """
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(round(pct / 100.0 * (len(values) - 1))))]
+
+
+class PipelineBenchmark(object):
+
+    def __init__(self, rate=1000, duration=30, events_per_payload=100, buffer_bytes=DEFAULT_BUFFER_BYTES,
+                 buffer_seconds=DEFAULT_BUFFER_SECONDS, local_dir=None, latency_sample=1, seed=None):
+        """
+        :param rate: Log events offered per second
+        :param duration: Seconds of traffic generated
+        :param events_per_payload: Log events per CloudWatch payload
+        :param buffer_bytes: Firehose buffer size
+        :param buffer_seconds: Firehose buffer interval
+        :param local_dir: Directory the S3 objects are written to, kept in memory only by default
+        :param latency_sample: Measure the latency of one delivered line in latency_sample
+        :param seed: Random seed of the traffic
+        """
+        self.rate = rate
+        self.duration = duration
+        self.latency_sample = max(1, latency_sample)
+        self.generator = TrafficGenerator(events_per_payload, seed=seed)
+        self.s3 = LocalS3(local_dir)
+        self.firehose = FirehoseEmulator(self.invoke_partitioner, buffer_bytes, buffer_seconds)
+        self.cpu = {'generate': 0.0, 'preprocess': 0.0, 'partition': 0.0}
+        self.latencies = []
+        self.delivered = 0
+        self.expected = 0
+        self.log_events = 0
+
+    def invoke_partitioner(self, event, context):
+        start = time.process_time()
+        naboo_partitioner.lambda_handler(event, context)
+        self.cpu['partition'] += time.process_time() - start
+        self.collect()
+
+    def collect(self):
+        for written_at, _, body in self.s3.drain():
+            lines = [line for line in body.decode('utf-8').splitlines() if line]
+            self.delivered += len(lines)
+            for line in lines[::self.latency_sample]:
+                generated_at = record_time(line)
+                if generated_at is not None:
+                    self.latencies.append(written_at - generated_at)
+
+    def run(self):
+        """
+        :return: dict of the rates, latency percentiles, Firehose and S3 counts, and CPU time per stage
+        """
+        naboo_preprocessor.firehose = self.firehose
+        naboo_partitioner.s3 = self.s3
+
+        interval = self.generator.events_per_payload / float(self.rate)
+        payloads = int(self.duration / interval)
+        started = time.time()
+
+        for i in range(payloads):
+            pause = started + i * interval - time.time()
+            if pause > 0:
+                time.sleep(pause)
+
+            start = time.process_time()
+            event, expected = self.generator.payload()
+            self.cpu['generate'] += time.process_time() - start
+            self.expected += expected
+            self.log_events += self.generator.events_per_payload
+
+            start = time.process_time()
+            naboo_preprocessor.lambda_handler(event, None)
+            self.cpu['preprocess'] += time.process_time() - start
+
+            for stream_name, reason in self.firehose.due():
+                self.firehose.flush(stream_name, reason)
+
+        # records still buffered by the preprocessor are sent by its handler, only Firehose holds any
+        self.firehose.flush_all()
+        return self.report(time.time() - started)
+
+    def report(self, elapsed):
+        latencies = sorted(self.latencies)
+        pipeline_cpu = self.cpu['preprocess'] + self.cpu['partition']
+        return {
+            'elapsed_seconds': round(elapsed, 3),
+            'offered_events_per_second': self.rate,
+            'log_events': self.log_events,
+            'records_expected': self.expected,
+            'records_delivered': self.delivered,
+            'sustained_records_per_second': round(self.delivered / elapsed, 1) if elapsed else None,
+            # the rate the two lambdas could take on one core, without the traffic generation
+            'pipeline_records_per_cpu_second': round(self.delivered / pipeline_cpu, 1) if pipeline_cpu else None,
+            'latency_seconds': dict(('p%s' % p, round(percentile(latencies, p), 3) if latencies else None)
+                                    for p in (50, 90, 99, 100)),
+            'firehose': self.firehose.stats,
+            's3': self.s3.stats,
+            'cpu_seconds': dict((stage, round(seconds, 3)) for stage, seconds in self.cpu.items()),
+            'cpu_us_per_record': dict((stage, round(seconds * 1e6 / self.delivered, 1) if self.delivered else None)
+                                      for stage, seconds in self.cpu.items())
+        }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the naboo preprocessor and partitioner end to end.')
+    parser.add_argument('--rate', type=int, default=1000, help='Log events offered per second')
+    parser.add_argument('--duration', type=float, default=30, help='Seconds of traffic')
+    parser.add_argument('--events-per-payload', type=int, default=100)
+    parser.add_argument('--buffer-mb', type=float, default=DEFAULT_BUFFER_BYTES / 1024.0 / 1024.0,
+                        help='Firehose buffer size')
+    parser.add_argument('--buffer-seconds', type=float, default=DEFAULT_BUFFER_SECONDS,
+                        help='Firehose buffer interval')
+    parser.add_argument('--local-dir', help='Write the S3 objects under this directory')
+    parser.add_argument('--latency-sample', type=int, default=1, help='Measure one line in N')
+    parser.add_argument('--seed', type=int)
+    args = parser.parse_args()
+
+    benchmark = PipelineBenchmark(rate=args.rate, duration=args.duration, events_per_payload=args.events_per_payload,
+                                  buffer_bytes=int(args.buffer_mb * 1024 * 1024), buffer_seconds=args.buffer_seconds,
+                                  local_dir=args.local_dir, latency_sample=args.latency_sample, seed=args.seed)
+    print(json.dumps(benchmark.run(), indent=2, sort_keys=True))